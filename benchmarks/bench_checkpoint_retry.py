@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""Benchmark a failed run's Pub/Sub retry with and without stage checkpoints.
+
+The first attempt fails in the chosen stage, the second one is the retry of
+the same message. With checkpoints the retry resumes after the stages that
+finished, without them it starts over. ``--fail-stage upload_to_gbq_done``
+fails once the load finished, before its checkpoint is recorded, so the
+raw table shows whether the retry loaded the rows twice.
+``--fail-stage none`` measures a
+successful run and a duplicate delivery of its message instead. Both modes
+run in a fresh interpreter against local service stand-ins, and report each
+attempt's seconds, the raw table's rows and the raw files written. Run from the
+repository root:
+
+    python benchmarks/bench_checkpoint_retry.py --rows 100000 \
+        --fail-stage preprocess_data
+
+"""
+
+# built in python modules
+import argparse
+import base64
+from collections import namedtuple
+import json
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks_dir, "..", "src"))
+sys.path.insert(0, benchmarks_dir)
+
+project_id = "iconic-range-220603"  # the project main.handler traces to
+# stage to fail -> function in main that stage calls
+fail_points = {
+    "none": None,
+    "upload_raw_data_gcs": "upload_raw_data_gcs",
+    "upload_to_gbq": "upload_to_gbq",
+    "upload_to_gbq_done": "upload_to_gbq",
+    "preprocess_data": "merge_unique_records",
+    "update_watermark": "update_watermark",
+}
+# stages that fail after their work is done, before it is recorded
+fail_after = {"upload_to_gbq_done"}
+Context = namedtuple("Context", ["event_id"])
+
+
+def run_attempts(num_rows, work_dir, fail_stage, checkpointed):
+    """Runs a failing attempt and its retry of one message and measures them."""
+    from lib.bq_api_data_functions import current_partition_start
+    from lib.clients import register_client
+    from lib.data_ingestion import SOCRATA_URL_ENV_VAR
+    from lib.tracing import register_exporter
+    from local_services import (
+        FilesystemStorageClient,
+        MemoryExporter,
+        SqliteBigQueryClient,
+        run_socrata_server,
+    )
+
+    start = current_partition_start().replace(tzinfo=None)
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=run_socrata_server, args=(num_rows, start, port_queue), daemon=True
+    )
+    server.start()
+    os.environ[SOCRATA_URL_ENV_VAR] = f"http://127.0.0.1:{port_queue.get()}"
+
+    storage_client = FilesystemStorageClient(os.path.join(work_dir, "gcs"))
+    sqlite_path = os.path.join(work_dir, "bigquery.sqlite")
+    register_client("storage", storage_client)
+    register_client(
+        "bigquery", SqliteBigQueryClient(sqlite_path, project_id, storage_client)
+    )
+    register_exporter(project_id, MemoryExporter())
+
+    import main
+
+    function_name = fail_points[fail_stage]
+    if function_name is not None:
+        original = getattr(main, function_name)
+
+        def fail_once(*args, **kwargs):
+            setattr(main, function_name, original)  # the retry succeeds
+            if fail_stage in fail_after:
+                original(*args, **kwargs)
+            raise RuntimeError(f"Injected failure in {fail_stage}")
+
+        setattr(main, function_name, fail_once)
+    event = {"data": base64.b64encode(b"benchmark").decode("utf-8")}
+    # without an event id the handler does not checkpoint
+    context = Context("bench-message-1" if checkpointed else None)
+    seconds = []
+    try:
+        for _ in range(2):
+            start_time = time.perf_counter()
+            try:
+                main.handler(event, context)
+            except RuntimeError:
+                pass
+            seconds.append(round(time.perf_counter() - start_time, 3))
+    finally:
+        server.terminate()
+
+    with sqlite3.connect(sqlite_path) as connection:
+        raw_rows, final_rows = (
+            connection.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0]
+            for table in [
+                "chicago_traffic_demo__traffic_raw",
+                "chicago_traffic_demo__traffic_final",
+            ]
+        )
+    raw_files = [
+        blob.name
+        for blob in storage_client.list_blobs("chicago_traffic_raw")
+        if blob.name.endswith(".gzip")
+    ]
+    return {
+        "seconds": seconds,
+        "raw_rows": raw_rows,
+        "final_rows": final_rows,
+        "raw_files": len(raw_files),
+    }
+
+
+def run_in_subprocess(num_rows, fail_stage, checkpointed):
+    """Runs ``run_attempts`` in a fresh interpreter and returns its result."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        completed = subprocess.run(
+            [sys.executable, __file__, "--worker", str(num_rows), work_dir]
+            + ["--fail-stage", fail_stage]
+            + (["--checkpointed"] if checkpointed else []),
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument(
+        "--fail-stage", choices=sorted(fail_points), default="preprocess_data"
+    )
+    parser.add_argument("--checkpointed", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # the pipeline logs to stdout, so the result goes on the last line
+        result = run_attempts(
+            int(args.worker[0]), args.worker[1], args.fail_stage, args.checkpointed
+        )
+        print(json.dumps(result))
+        return
+
+    print(
+        f"{'mode':<14} {'attempt 1 s':>11} {'retry s':>8} {'raw rows':>9} "
+        f"{'final rows':>10} {'raw files':>9}"
+    )
+    for mode, checkpointed in [("checkpointed", True), ("restart", False)]:
+        result = run_in_subprocess(args.rows, args.fail_stage, checkpointed)
+        first, retry = result["seconds"]
+        print(
+            f"{mode:<14} {first:>11.3f} {retry:>8.3f} {result['raw_rows']:>9} "
+            f"{result['final_rows']:>10} {result['raw_files']:>9}"
+        )
+    print(f"\nrows served: {args.rows}, first attempt failed in {args.fail_stage}")
+
+
+if __name__ == "__main__":
+    main()
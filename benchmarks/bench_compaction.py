@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Benchmark reading a day of raw objects before and after compaction.
+
+Writes a day of small raw objects the way ``upload_raw_data_gcs`` names
+them into a filesystem-backed bucket, compacts the day, checks that no row
+was lost or duplicated, and times reading the day back both ways. Run from
+the repository root:
+
+    python benchmarks/bench_compaction.py --objects 288 --rows-per-object 1000
+
+"""
+
+# built in python modules
+import argparse
+from datetime import date, datetime, timedelta
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import pandas as pd  # noqa: E402
+
+from lib.clients import register_client  # noqa: E402
+from lib.compaction import compact_day, day_prefix  # noqa: E402
+from lib.data_ingestion import apply_schema, compile_schema  # noqa: E402
+from lib.schemas import schema_bq  # noqa: E402
+from local_services import FilesystemStorageClient  # noqa: E402
+from synthetic_data import make_traffic_records  # noqa: E402
+
+bucket_name = "chicago_traffic_raw"
+blob_prefix = "traffic_"
+
+
+def write_raw_objects(storage_client, day, num_objects, rows_per_object):
+    """Writes one raw object per 5 minute run of the day."""
+    bucket = storage_client.bucket(bucket_name)
+    bucket.create()
+    run_time = datetime(day.year, day.month, day.day)
+    for run in range(num_objects):
+        records = make_traffic_records(rows_per_object, seed=run, start=run_time)
+        blob = bucket.blob(f"{blob_prefix}{run_time.strftime('%Y%m%d%H%M%S')}.gzip")
+        buffer = io.BytesIO()
+        pd.DataFrame.from_records(records).to_parquet(
+            buffer, engine="pyarrow", compression="gzip"
+        )
+        buffer.seek(0)
+        blob.upload_from_file(buffer)
+        run_time += timedelta(minutes=5)
+
+
+def read_day(storage_client, blob_names):
+    """Reads objects one by one, the way a backfill replays a day."""
+    bucket = storage_client.bucket(bucket_name)
+    frames = [
+        pd.read_parquet(io.BytesIO(bucket.blob(name).download_as_bytes()))
+        for name in blob_names
+    ]
+    return pd.concat(frames, ignore_index=True)
+
+
+def timed(func, *args, **kwargs):
+    """Returns the result of a call and how long it took in seconds."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--objects", type=int, default=288)
+    parser.add_argument("--rows-per-object", type=int, default=1000)
+    args = parser.parse_args()
+
+    day = date.today()
+    with tempfile.TemporaryDirectory() as work_dir:
+        storage_client = FilesystemStorageClient(work_dir)
+        register_client("storage", storage_client)
+        write_raw_objects(storage_client, day, args.objects, args.rows_per_object)
+        raw_names = [
+            blob.name
+            for blob in storage_client.list_blobs(
+                bucket_name, prefix=day_prefix(blob_prefix, day)
+            )
+        ]
+        raw_df, raw_seconds = timed(read_day, storage_client, raw_names)
+
+        manifest, compact_seconds = timed(
+            compact_day, bucket_name, blob_prefix, day, schema_bq=schema_bq
+        )
+        part_names = [part["name"] for part in manifest["parts"]]
+        compacted_df, compacted_seconds = timed(read_day, storage_client, part_names)
+
+        # compaction casts the raw string columns to the feed schema
+        raw_keys, _ = apply_schema(raw_df, compile_schema(schema_bq))
+        key_columns = ["segmentid", "_last_updt"]
+        if len(compacted_df) != len(raw_df) or not (
+            compacted_df[key_columns]
+            .sort_values(key_columns, ignore_index=True)
+            .equals(raw_keys[key_columns].sort_values(key_columns, ignore_index=True))
+        ):
+            print("FAILED: compacted rows differ from the raw objects")
+            sys.exit(1)
+        rerun, _ = timed(
+            compact_day, bucket_name, blob_prefix, day, schema_bq=schema_bq
+        )
+        if rerun["parts"] != manifest["parts"]:
+            print("FAILED: compacting the same day again rewrote its parts")
+            sys.exit(1)
+
+        # an object landing after the day was compacted is merged into it
+        late_day = datetime(day.year, day.month, day.day, 23, 59, 59)
+        late_name = f"{blob_prefix}{late_day.strftime('%Y%m%d%H%M%S')}.gzip"
+        buffer = io.BytesIO()
+        pd.DataFrame.from_records(
+            make_traffic_records(args.rows_per_object, seed=-1, start=late_day)
+        ).to_parquet(buffer, engine="pyarrow", compression="gzip")
+        buffer.seek(0)
+        storage_client.bucket(bucket_name).blob(late_name).upload_from_file(buffer)
+        late = compact_day(bucket_name, blob_prefix, day, schema_bq=schema_bq)
+        if late["rows"] != manifest["rows"] + args.rows_per_object:
+            print("FAILED: a late object was not merged into the compacted day")
+            sys.exit(1)
+
+    print(f"{'':<12} {'objects':>8} {'read (s)':>9}")
+    print(f"{'raw':<12} {len(raw_names):>8} {raw_seconds:>9.3f}")
+    print(f"{'compacted':<12} {len(part_names):>8} {compacted_seconds:>9.3f}")
+    print(
+        f"compacted {manifest['rows']} rows in {compact_seconds:.3f}s, "
+        f"read speedup {raw_seconds / compacted_seconds:.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Benchmark the compiled schema converter against the per-column loop.
+
+Run from the repository root:
+
+    python benchmarks/bench_convert_schema.py
+
+"""
+
+# built in python modules
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import pandas as pd  # noqa: E402
+
+from lib.data_ingestion import apply_schema, compile_schema  # noqa: E402
+from lib.schemas import schema_bq, schema_df  # noqa: E402
+from synthetic_data import make_traffic_records  # noqa: E402
+
+row_counts = [2000, 100000, 1000000]
+
+
+def loop_convert(results_df, schema_df):
+    """Converts column by column in place, the converter ``apply_schema`` replaced."""
+    for column, dtype in schema_df.items():
+        results_df[column] = results_df[column].astype(dtype)
+    return results_df
+
+
+def best_of(func, repeat=3):
+    """Returns the fastest wall clock time of ``repeat`` calls in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    compiled_schema = compile_schema(schema_bq)
+    print(f"{'rows':>9} {'loop (s)':>10} {'compiled (s)':>13} {'speedup':>8}")
+    for num_rows in row_counts:
+        results_df = pd.DataFrame.from_records(make_traffic_records(num_rows))
+        # the loop converts in place, so it needs a copy to leave the input intact
+        loop_time = best_of(lambda: loop_convert(results_df.copy(), schema_df))
+        compiled_time = best_of(lambda: apply_schema(results_df, compiled_schema))
+        print(
+            f"{num_rows:>9} {loop_time:>10.3f} {compiled_time:>13.3f} "
+            f"{loop_time / compiled_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
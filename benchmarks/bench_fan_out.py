@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""Benchmark one pipeline run fanned out over 1, 2, 4... worker instances.
+
+Every worker is its own interpreter, the way every function instance is,
+pulling messages from a local queue that stands in for Pub/Sub. With one
+worker the run is not sharded, the baseline of one instance doing all the
+work. With more, the coordinator message publishes one shard per worker
+and the last worker to finish runs the final merge. The Socrata stand-in
+waits ``--latency`` seconds per request, the round trip a page takes from
+the real api. Reported per worker count: seconds from publishing the
+message to the final merge, rows per second, CPU seconds of the busiest
+worker, which is what caps one instance, and the final table's rows. Run
+from the repository root:
+
+    python benchmarks/bench_fan_out.py --rows 50000 --workers 1 2 4 --latency 1.0
+
+With ``--latency 0`` and one CPU shared by every worker, more workers
+only add the coordinator's round trip, so expect no gain there.
+
+"""
+
+# built in python modules
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks_dir, "..", "src"))
+sys.path.insert(0, benchmarks_dir)
+
+project_id = "iconic-range-220603"  # the project main.handler traces to
+
+
+def run_worker(work_dir, socrata_url, message_queue, done_queue):
+    """Serves queued messages to ``main.handler`` like one function instance."""
+    from lib.clients import register_client
+    from lib.data_ingestion import SOCRATA_URL_ENV_VAR
+    from lib.tracing import register_exporter
+    from local_services import (
+        FilesystemStorageClient,
+        LocalPublisher,
+        MemoryExporter,
+        SqliteBigQueryClient,
+        serve_subscription,
+    )
+
+    os.environ[SOCRATA_URL_ENV_VAR] = socrata_url
+    storage_client = FilesystemStorageClient(os.path.join(work_dir, "gcs"))
+    register_client("storage", storage_client)
+    register_client(
+        "bigquery",
+        SqliteBigQueryClient(
+            os.path.join(work_dir, "bigquery.sqlite"), project_id, storage_client
+        ),
+    )
+    register_client("pubsub", LocalPublisher(message_queue))
+    register_exporter(project_id, MemoryExporter())
+
+    import main
+
+    done_queue.put(("ready", None))
+    serve_subscription(
+        message_queue,
+        main.handler,
+        on_done=lambda message_id, outcome: done_queue.put((outcome, message_id)),
+    )
+    done_queue.put(("cpu_seconds", time.process_time()))
+
+
+def run_fan_out(num_rows, num_workers, latency):
+    """Runs one pipeline run on ``num_workers`` workers and measures it."""
+    from lib.bq_api_data_functions import current_partition_start
+    from lib.pipeline_specs import default_spec
+    from local_services import LocalPublisher, run_socrata_server
+
+    start = current_partition_start().replace(tzinfo=None)
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=run_socrata_server,
+        args=(num_rows, start, port_queue, latency),
+        daemon=True,
+    )
+    server.start()
+    socrata_url = f"http://127.0.0.1:{port_queue.get()}"
+
+    message_queue = multiprocessing.Queue()
+    done_queue = multiprocessing.Queue()
+    with tempfile.TemporaryDirectory() as work_dir:
+        workers = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(work_dir, socrata_url, message_queue, done_queue),
+            )
+            for _ in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for _ in workers:  # time warm instances, not interpreter start up
+                done_queue.get()
+
+            spec = dict(default_spec, shard_count=num_workers)
+            # the coordinator and every shard, or one unsharded run
+            expected = 1 + num_workers if num_workers > 1 else 1
+            start_time = time.perf_counter()
+            LocalPublisher(message_queue).publish(
+                "demo_topic", json.dumps({"pipelines": [spec]}).encode()
+            )
+            delivered = 0
+            while delivered < expected:
+                outcome, _ = done_queue.get()
+                if outcome == "dropped":
+                    raise RuntimeError("A message failed every delivery")
+                delivered += outcome == "ok"
+            seconds = time.perf_counter() - start_time
+
+            for _ in workers:
+                message_queue.put(None)
+            cpu_seconds = []
+            while len(cpu_seconds) < num_workers:
+                name, value = done_queue.get()
+                if name == "cpu_seconds":
+                    cpu_seconds.append(value)
+        finally:
+            for worker in workers:
+                worker.terminate()
+            server.terminate()
+
+        with sqlite3.connect(os.path.join(work_dir, "bigquery.sqlite")) as connection:
+            (final_rows,) = connection.execute(
+                'SELECT count(*) FROM "chicago_traffic_demo__traffic_final"'
+            ).fetchone()
+    return {
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(num_rows / seconds),
+        "busiest_cpu_seconds": round(max(cpu_seconds), 3),
+        "total_cpu_seconds": round(sum(cpu_seconds), 3),
+        "final_rows": final_rows,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--latency", type=float, default=1.0)
+    args = parser.parse_args()
+
+    results = {
+        num_workers: run_fan_out(args.rows, num_workers, args.latency)
+        for num_workers in args.workers
+    }
+    print(
+        f"{'workers':>7} {'seconds':>8} {'rows/s':>8} {'busiest cpu s':>13} "
+        f"{'total cpu s':>11} {'final rows':>10}"
+    )
+    for num_workers, result in results.items():
+        print(
+            f"{num_workers:>7} {result['seconds']:>8.3f} "
+            f"{result['rows_per_second']:>8} {result['busiest_cpu_seconds']:>13.3f} "
+            f"{result['total_cpu_seconds']:>11.3f} {result['final_rows']:>10}"
+        )
+    if any(result["final_rows"] != args.rows for result in results.values()):
+        print(f"FAILED: the final table should hold {args.rows} rows")
+        sys.exit(1)
+    print(
+        f"\nrows served: {args.rows}, {args.latency}s per api request, "
+        f"{os.cpu_count()} CPUs shared by every worker"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Benchmark cold import time of the function entry point.
+
+Imports ``main`` in a fresh interpreter with ``-X importtime``, prints the
+slowest modules by cumulative time and fails when the total goes over the
+budget. Run from the repository root:
+
+    python benchmarks/bench_import_time.py --budget-ms 250
+
+"""
+
+# built in python modules
+import argparse
+import os
+import subprocess
+import sys
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def import_times(module_name="main"):
+    """Returns (self us, cumulative us, module) rows for a cold import.
+
+    Args:
+        module_name: module to import in a fresh interpreter
+
+    Returns:
+        list object: ``rows`` ordered as python reports them
+
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        cwd=src_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in completed.stderr.splitlines():
+        if line.rstrip().endswith("| site"):
+            rows = []  # interpreter start up, not part of the entry point
+            continue
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        rows.append((int(self_us), int(cumulative_us), module.rstrip()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget-ms", type=float, default=250.0)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # the fastest of a few runs filters out noisy neighbours on the machine
+    runs = [import_times(args.module) for _ in range(args.repeat)]
+    rows = min(runs, key=lambda run: run[-1][1])
+    total_ms = rows[-1][1] / 1000
+    print(f"{'self (ms)':>10} {'cumulative (ms)':>16}  module")
+    slowest = sorted(rows, key=lambda row: -row[1])[: args.top]
+    for self_us, cumulative_us, module in slowest:
+        print(f"{self_us / 1000:>10.1f} {cumulative_us / 1000:>16.1f}  {module}")
+    print(f"cold import of {args.module}: {total_ms:.1f} ms, budget {args.budget_ms} ms")
+    if total_ms > args.budget_ms:
+        print("FAILED: cold import time is over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
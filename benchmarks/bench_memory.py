@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""Benchmark peak memory and time of the pandas, compact and Arrow ingest paths.
+
+Every row count and mode runs in a fresh interpreter. A sampler thread
+records peak RSS above the records already in memory for each step, the
+same steps the pipeline runs, and the written Parquet files are hashed to
+check that compact frames write the same bytes as wide ones. ``arrow``
+builds a pyarrow table instead of a dataframe. Run from the repository
+root:
+
+    python benchmarks/bench_memory.py --rows 100000 1000000
+
+"""
+
+# built in python modules
+import argparse
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+row_counts = [100000, 1000000]
+modes = ["wide", "compact", "arrow"]
+steps = ["create_dataframe", "convert_schema", "write_raw", "write_load"]
+
+
+class PeakRss:
+    """Samples resident memory on a thread and keeps the peak since a reset."""
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def rss(self):
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * self.page_size
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def reset(self):
+        self.peak = self.rss()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class ListClient:
+    """Stands in for the Socrata client, serving pages of a list of records."""
+
+    def __init__(self, records):
+        self.records = records
+
+    def get(self, resource_id, select=None, limit=None, offset=0, **kwargs):
+        if select is not None:
+            return [{"row_count": str(len(self.records))}]
+        return self.records[offset : offset + limit]
+
+
+def size_bytes(results_df):
+    """Returns the in-memory size of a dataframe or pyarrow table."""
+    from lib.compact_frames import frame_bytes
+
+    if hasattr(results_df, "nbytes"):
+        return results_df.nbytes
+    return frame_bytes(results_df)
+
+
+def run_steps(num_rows, mode):
+    """Runs the pipeline's in-memory steps once and measures each of them."""
+    from lib.arrow_ingest import cast_table
+    from lib.compact_frames import write_parquet
+    from lib.data_ingestion import apply_schema, compile_schema, create_results_df
+    from lib.schemas import schema_bq
+    from synthetic_data import make_traffic_records
+
+    compact = mode == "compact"
+    engine = "arrow" if mode == "arrow" else "pandas"
+    data_client = ListClient(make_traffic_records(num_rows))
+    sampler = PeakRss()
+    baseline = sampler.rss()
+    peaks = {}
+    seconds = {}
+    digests = {}
+
+    def measure(step, func):
+        sampler.reset()
+        start = time.perf_counter()
+        result = func()
+        seconds[step] = round(time.perf_counter() - start, 3)
+        time.sleep(sampler.interval * 5)  # let the sampler catch the last peak
+        peaks[step] = round((sampler.peak - baseline) / 1024**2, 1)
+        return result
+
+    results_df = measure(
+        "create_dataframe",
+        lambda: create_results_df(
+            data_client, page_size=50000, compact=compact, engine=engine
+        ),
+    )
+    if engine == "arrow":
+        results_df_transformed, _ = measure(
+            "convert_schema", lambda: cast_table(results_df, schema_bq)
+        )
+    else:
+        results_df_transformed, _ = measure(
+            "convert_schema",
+            lambda: apply_schema(
+                results_df, compile_schema(schema_bq), compact=compact
+            ),
+        )
+    for step, frame, kwargs in [
+        ("write_raw", results_df, {"compression": "gzip"}),
+        ("write_load", results_df_transformed, {"index": False}),
+    ]:
+        buffer = io.BytesIO()
+        measure(step, lambda: write_parquet(frame, buffer, **kwargs))
+        digests[step] = hashlib.sha1(buffer.getvalue()).hexdigest()
+    sampler.stop()
+    return {
+        "rows": num_rows,
+        "mode": mode,
+        "peak_mb": peaks,
+        "seconds": seconds,
+        "frame_mb": {
+            "raw": round(size_bytes(results_df) / 1024**2, 1),
+            "converted": round(size_bytes(results_df_transformed) / 1024**2, 1),
+        },
+        "digests": digests,
+    }
+
+
+def run_in_subprocess(num_rows, mode):
+    """Runs ``run_steps`` in a fresh interpreter and returns its result."""
+    completed = subprocess.run(
+        [sys.executable, __file__, "--worker", str(num_rows), mode],
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=row_counts)
+    parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # the pipeline logs to stdout, so the result goes on the last line
+        print(json.dumps(run_steps(int(args.worker[0]), args.worker[1])))
+        return
+
+    print(
+        f"{'rows':>9} {'mode':<8} {'raw MB':>7} {'conv MB':>8} "
+        + " ".join(f"{step:>20}" for step in steps)
+    )
+    for num_rows in args.rows:
+        results = {mode: run_in_subprocess(num_rows, mode) for mode in modes}
+        for mode, result in results.items():
+            print(
+                f"{num_rows:>9} {mode:<8} {result['frame_mb']['raw']:>7} "
+                f"{result['frame_mb']['converted']:>8} "
+                + " ".join(
+                    f"{result['peak_mb'][step]:>10} {result['seconds'][step]:>8.3f}s"
+                    for step in steps
+                )
+            )
+        if results["wide"]["digests"] != results["compact"]["digests"]:
+            print("FAILED: compact frames wrote different Parquet files")
+            sys.exit(1)
+    print("\nper step: peak resident MB above the fetched records, and seconds")
+
+
+if __name__ == "__main__":
+    main()
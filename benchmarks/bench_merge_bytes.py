@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Benchmark the bytes the dedupe stage scans before and after the MERGE.
+
+Fills a raw table with ``--raw-days`` of loaded rows plus today's, and a
+final table with ``--final-days`` of merged rows, in the SQLite stand-in for
+BigQuery. Then it dedupes today's rows both ways. Before: the max timestamp
+query, ``SELECT DISTINCT`` into the staging table and the ``LEFT JOIN``
+append over the whole final table. After: the one partition-pruned MERGE of
+``merge_unique_records``. Bytes are the stand-in's dry run estimates, the
+way BigQuery bills on-demand queries. Run from the repository root:
+
+    python benchmarks/bench_merge_bytes.py --rows-per-day 5000 --final-days 365
+
+"""
+
+# built in python modules
+import argparse
+import io
+import os
+import sys
+import tempfile
+from datetime import timedelta
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks_dir, "..", "src"))
+sys.path.insert(0, benchmarks_dir)
+
+from google.cloud import bigquery  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from lib.bq_api_data_functions import (  # noqa: E402
+    current_partition_start,
+    merge_unique_records,
+    query_unique_records,
+)
+from lib.clients import register_client  # noqa: E402
+from lib.data_ingestion import apply_schema, compile_schema  # noqa: E402
+from lib.query_runner import run_query, table_path  # noqa: E402
+from lib.schemas import schema_bq  # noqa: E402
+from local_services import SqliteBigQueryClient  # noqa: E402
+from synthetic_data import make_traffic_records  # noqa: E402
+
+project_id = "local-project"
+dataset_name = "chicago_traffic_demo"
+# the append that followed query_unique_records before the MERGE
+left_join_append_sql = """
+    SELECT a.* FROM {staging} a
+    LEFT JOIN {final} b
+    ON a.segmentid = b.segmentid AND a._last_updt = b._last_updt
+    WHERE b.segmentid IS NULL
+"""
+
+
+class MeteredBigQueryClient(SqliteBigQueryClient):
+    """SQLite BigQuery client keeping the dry run bytes of every statement."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scans = []
+
+    def query(self, sql, location=None, job_config=None):
+        query_job = super().query(sql, location=location, job_config=job_config)
+        if getattr(job_config, "dry_run", False):
+            self.scans.append(query_job.total_bytes_processed)
+        return query_job
+
+
+def load_days(bigquery_client, table_name, days, rows_per_day):
+    """Loads one synthetic day of rows per day offset before today in CST."""
+    compiled_schema = compile_schema(schema_bq)
+    table_ref = bigquery_client.dataset(dataset_name).table(table_name)
+    today = current_partition_start().replace(tzinfo=None)
+    for days_ago in days:
+        records = make_traffic_records(
+            rows_per_day, seed=days_ago, start=today - timedelta(days=days_ago)
+        )
+        results_df, _ = apply_schema(
+            pd.DataFrame.from_records(records), compiled_schema
+        )
+        buffer = io.BytesIO()
+        results_df.to_parquet(buffer, engine="pyarrow")
+        buffer.seek(0)
+        bigquery_client.load_table_from_file(buffer, table_ref)
+
+
+def dedupe_before(bigquery_client):
+    """Runs the three statements of the staging dedupe, returns their bytes."""
+    bigquery_client.scans = []
+    query_unique_records(project_id, dataset_name, "traffic_raw", "traffic_staging")
+    job_config = bigquery.QueryJobConfig()
+    job_config.destination = bigquery_client.dataset(dataset_name).table(
+        "traffic_final_before"
+    )
+    job_config.write_disposition = "WRITE_APPEND"
+    run_query(
+        left_join_append_sql.format(
+            staging=table_path(project_id, dataset_name, "traffic_staging"),
+            final=table_path(project_id, dataset_name, "traffic_final_before"),
+        ),
+        job_config=job_config,
+    )
+    return bigquery_client.scans
+
+
+def dedupe_after(bigquery_client):
+    """Runs the partition-pruned MERGE, returns its bytes."""
+    bigquery_client.scans = []
+    merge_unique_records(project_id, dataset_name, "traffic_raw", "traffic_final")
+    return bigquery_client.scans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows-per-day", type=int, default=5000)
+    parser.add_argument("--raw-days", type=int, default=7)
+    parser.add_argument("--final-days", type=int, default=90)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        bigquery_client = MeteredBigQueryClient(
+            os.path.join(work_dir, "bigquery.sqlite"), project_id
+        )
+        register_client("bigquery", bigquery_client)
+        for table_name in (
+            "traffic_raw",
+            "traffic_staging",
+            "traffic_final_before",
+            "traffic_final",
+        ):
+            bigquery_client.create_table(
+                bigquery.Table(
+                    bigquery_client.dataset(dataset_name).table(table_name),
+                    schema=schema_bq,
+                )
+            )
+        # raw partitions expire, today's rows are the ones to dedupe
+        load_days(
+            bigquery_client, "traffic_raw", range(args.raw_days + 1), args.rows_per_day
+        )
+        history = range(1, args.final_days + 1)
+        for table_name in ("traffic_final_before", "traffic_final"):
+            load_days(bigquery_client, table_name, history, args.rows_per_day)
+            # SQLite joins row by row, an index keeps the run short without
+            # changing the estimated bytes
+            with bigquery_client._connect() as connection:
+                connection.execute(
+                    f'CREATE INDEX "{table_name}_keys" ON '
+                    f'"{dataset_name}__{table_name}" (segmentid, _last_updt)'
+                )
+
+        before = dedupe_before(bigquery_client)
+        after = dedupe_after(bigquery_client)
+
+    print(
+        f"{args.rows_per_day} rows per day, {args.raw_days} raw days, "
+        f"{args.final_days} final days"
+    )
+    print(f"{'':<8} {'MB scanned':>11}  per statement")
+    for label, scans in (("before", before), ("after", after)):
+        per_statement = ", ".join(f"{scan / 1e6:.2f}" for scan in scans)
+        print(f"{label:<8} {sum(scans) / 1e6:>11.2f}  {per_statement}")
+    print(f"scanned {sum(before) / sum(after):.1f}x fewer bytes with the MERGE")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""Benchmark ``main.handler`` end to end against local service stand-ins.
+
+Every row count runs in a fresh interpreter with its own Socrata server
+process, filesystem bucket and SQLite database, so peak RSS is the
+pipeline's alone. Results are saved per commit under benchmarks/results,
+compare them with ``--baseline``. Run from the repository root:
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --rows 2000 100000 \
+        --baseline benchmarks/results/pipeline_<commit>.json
+
+``--message`` sends a Pub/Sub message, e.g. pipeline specs that switch on
+batched loads, instead of the scheduler's plain text trigger.
+
+"""
+
+# built in python modules
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(benchmarks_dir, "..", "src")
+results_dir = os.path.join(benchmarks_dir, "results")
+sys.path.insert(0, src_dir)
+sys.path.insert(0, benchmarks_dir)
+
+row_counts = [2000, 100000, 1000000]
+project_id = "iconic-range-220603"  # the project main.handler traces to
+
+
+def run_pipeline(num_rows, work_dir, message="benchmark"):
+    """Runs one cold invocation of ``main.handler`` and measures it.
+
+    Args:
+        num_rows: number of rows the Socrata stand-in serves
+        work_dir: directory for the bucket folders and SQLite database
+        message: Pub/Sub message data the handler is triggered with
+
+    Returns:
+        dict object: ``result``
+
+    """
+    from lib.bq_api_data_functions import current_partition_start
+    from lib.clients import register_client
+    from lib.data_ingestion import SOCRATA_URL_ENV_VAR
+    from lib.tracing import register_exporter
+    from local_services import (
+        FilesystemStorageClient,
+        MemoryExporter,
+        SqliteBigQueryClient,
+        run_socrata_server,
+    )
+
+    # rows are dated today, so the partition-pruned merge picks them up
+    start = current_partition_start().replace(tzinfo=None)
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=run_socrata_server, args=(num_rows, start, port_queue), daemon=True
+    )
+    server.start()
+    os.environ[SOCRATA_URL_ENV_VAR] = f"http://127.0.0.1:{port_queue.get()}"
+
+    storage_client = FilesystemStorageClient(os.path.join(work_dir, "gcs"))
+    register_client("storage", storage_client)
+    register_client(
+        "bigquery",
+        SqliteBigQueryClient(
+            os.path.join(work_dir, "bigquery.sqlite"), project_id, storage_client
+        ),
+    )
+    exporter = MemoryExporter()
+    register_exporter(project_id, exporter)
+
+    import main
+
+    event = {"data": base64.b64encode(message.encode("utf-8")).decode("utf-8")}
+    start_time = time.perf_counter()
+    try:
+        main.handler(event, None)
+    finally:
+        seconds = time.perf_counter() - start_time
+        server.terminate()
+    return {
+        "rows": num_rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(num_rows / seconds),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "stage_seconds": {
+            name: round(stage_seconds, 3)
+            for name, stage_seconds in exporter.span_seconds().items()
+        },
+    }
+
+
+def run_in_subprocess(num_rows, message):
+    """Runs ``run_pipeline`` in a fresh interpreter and returns its result."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        completed = subprocess.run(
+            [sys.executable, __file__, "--worker", str(num_rows), work_dir]
+            + ["--message", message],
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    """Returns the short hash of the checked out commit, or ``unknown``."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=benchmarks_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results, baseline=None):
+    """Prints totals and stage latencies, with changes against a baseline."""
+    baseline_runs = {run["rows"]: run for run in (baseline or {}).get("runs", [])}
+    for run in results["runs"]:
+        before = baseline_runs.get(run["rows"])
+        change = ""
+        if before:
+            change = f" ({run['seconds'] / before['seconds'] - 1:+.0%} vs baseline)"
+        print(
+            f"\n{run['rows']} rows: {run['seconds']:.3f}s{change}, "
+            f"{run['rows_per_second']} rows/s, peak RSS {run['peak_rss_mb']} MB"
+        )
+        for name, seconds in sorted(
+            run["stage_seconds"].items(), key=lambda item: -item[1]
+        ):
+            line = f"  {name:<28} {seconds:>8.3f}s"
+            if before and name in before["stage_seconds"]:
+                line += f" {seconds - before['stage_seconds'][name]:>+8.3f}s"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=row_counts)
+    parser.add_argument("--baseline", help="results file saved by an earlier run")
+    parser.add_argument("--output", help="defaults to results/pipeline_<commit>.json")
+    parser.add_argument("--message", default="benchmark", help="Pub/Sub message data")
+    parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # the pipeline logs to stdout, so the result goes on the last line
+        result = run_pipeline(int(args.worker[0]), args.worker[1], args.message)
+        print(json.dumps(result))
+        return
+
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "message": args.message,
+        "runs": [run_in_subprocess(num_rows, args.message) for num_rows in args.rows],
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    output = args.output or os.path.join(results_dir, f"pipeline_{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"\nSaved results to: {output}")
+
+
+if __name__ == "__main__":
+    main()
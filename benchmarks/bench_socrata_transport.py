@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Benchmark fetching every page with the sodapy, pooled and CSV transports.
+
+One Socrata stand-in process serves the same synthetic rows to every
+transport. Each transport runs in a fresh interpreter and fetches the feed
+several times in a row, the first call standing in for a cold start and the
+rest for warm invocations that reuse the shared client. Wall time, CPU time
+of the fetching process, connections opened and body bytes sent by the
+server are reported per call. Run from the repository root:
+
+    python benchmarks/bench_socrata_transport.py --rows 100000 --calls 3
+
+"""
+
+# built in python modules
+import argparse
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks_dir, "..", "src"))
+sys.path.insert(0, benchmarks_dir)
+
+transports = ["sodapy", "pooled", "csv"]
+
+
+def server_stats(socrata_url, reset=False):
+    """Returns the stand-in's counters, less the stats request's connection."""
+    query = "?reset=1" if reset else ""
+    with urllib.request.urlopen(f"{socrata_url}/stats{query}") as response:
+        stats = json.loads(response.read())
+    stats["connections"] = stats.get("connections", 0) - 1
+    return stats
+
+
+def run_calls(transport, num_calls, engine):
+    """Fetches the feed ``num_calls`` times with one transport and measures it."""
+    from lib.data_ingestion import (
+        SOCRATA_URL_ENV_VAR,
+        create_results_df,
+        get_data_client,
+    )
+    from lib.schemas import schema_bq
+
+    socrata_url = os.environ[SOCRATA_URL_ENV_VAR]
+    calls = []
+    for _ in range(num_calls):
+        server_stats(socrata_url, reset=True)
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        # the client is shared, so later calls reuse it like warm invocations
+        data_client, data_format = get_data_client(transport)
+        results_df = create_results_df(
+            data_client,
+            engine=engine,
+            data_format=data_format,
+            schema_bq=schema_bq,
+        )
+        cpu_seconds = time.process_time() - start_cpu
+        seconds = time.perf_counter() - start_time
+        stats = server_stats(socrata_url)
+        calls.append(
+            {
+                "rows": len(results_df),
+                "seconds": round(seconds, 3),
+                "cpu_seconds": round(cpu_seconds, 3),
+                "connections": stats.get("connections", 0),
+                "requests": stats.get("requests", 0),
+                "sent_mb": round(stats.get("sent_bytes", 0) / 1024**2, 2),
+                "raw_mb": round(stats.get("raw_bytes", 0) / 1024**2, 2),
+            }
+        )
+    return calls
+
+
+def run_in_subprocess(transport, num_calls, engine, socrata_url):
+    """Runs ``run_calls`` in a fresh interpreter and returns its result."""
+    from lib.data_ingestion import SOCRATA_URL_ENV_VAR
+
+    completed = subprocess.run(
+        [sys.executable, __file__, "--worker", transport]
+        + ["--calls", str(num_calls), "--engine", engine],
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+        env={**os.environ, SOCRATA_URL_ENV_VAR: socrata_url},
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--calls", type=int, default=3)
+    parser.add_argument("--engine", choices=["pandas", "arrow"], default="pandas")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # the pipeline logs to stdout, so the result goes on the last line
+        print(json.dumps(run_calls(args.worker, args.calls, args.engine)))
+        return
+
+    from local_services import run_socrata_server
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=run_socrata_server,
+        args=(args.rows, datetime(2019, 4, 2, 15, 0), port_queue),
+        daemon=True,
+    )
+    server.start()
+    socrata_url = f"http://127.0.0.1:{port_queue.get()}"
+    try:
+        results = {
+            transport: run_in_subprocess(
+                transport, args.calls, args.engine, socrata_url
+            )
+            for transport in transports
+        }
+    finally:
+        server.terminate()
+
+    print(
+        f"{'transport':<9} {'call':>4} {'rows':>8} {'seconds':>8} {'cpu s':>7} "
+        f"{'conns':>6} {'reqs':>5} {'sent MB':>8} {'raw MB':>7}"
+    )
+    for transport, calls in results.items():
+        for number, call in enumerate(calls, start=1):
+            print(
+                f"{transport:<9} {number:>4} {call['rows']:>8} "
+                f"{call['seconds']:>8.3f} {call['cpu_seconds']:>7.3f} "
+                f"{call['connections']:>6} {call['requests']:>5} "
+                f"{call['sent_mb']:>8} {call['raw_mb']:>7}"
+            )
+    row_counts = {calls[0]["rows"] for calls in results.values()}
+    if len(row_counts) != 1:
+        print(f"FAILED: transports fetched different row counts {row_counts}")
+        sys.exit(1)
+    print("\ncall 1 is a cold start, later calls reuse the shared client")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,771 @@
+#!/usr/bin/env python
+"""Local stand-ins for Socrata, Google Cloud Storage, BigQuery and Pub/Sub.
+
+This module is responsible for:
+-Serving synthetic 8v9j-bter records over HTTP the way Socrata pages them,
+ as JSON or CSV, gzipped on request, and counting requests, connections and
+ bytes on the wire
+-Storing blobs as files under a local directory, one folder per bucket
+-Running the pipeline's BigQuery SQL against SQLite tables named
+ ``<dataset_name>__<table_name>``, the same as ``lib.loaders.sqlite_loader``,
+ keeping each table's layout for drift checks, and answering dry runs with
+ the bytes BigQuery would bill for the partitions each statement reads
+-Collecting finished trace spans in memory
+-Queueing published Pub/Sub messages and delivering them to a background
+ function, in worker threads or worker processes
+
+The clients only implement the calls the lib modules make, and are plugged
+in with ``lib.clients.register_client`` and ``lib.tracing.register_exporter``.
+
+"""
+
+# built in python modules
+import base64
+from collections import Counter, namedtuple
+from concurrent.futures import Future
+import contextlib
+import csv
+from datetime import datetime, timezone
+import fcntl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import itertools
+import gzip
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, urlparse
+
+from google.api_core.exceptions import Conflict, PreconditionFailed
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+from opencensus.trace.exporters import base
+import pandas as pd
+
+from lib.loaders import bq_to_sqlite_types
+from synthetic_data import make_traffic_records
+
+LocalContext = namedtuple("LocalContext", ["event_id"])  # what handlers read
+SQLITE_TIMEOUT = 60  # seconds a connection waits on another stage's write
+# table layouts live in the database, so every worker process sees them
+LAYOUTS_DDL = (
+    "CREATE TABLE IF NOT EXISTS _table_layouts (name TEXT PRIMARY KEY, layout TEXT)"
+)
+
+
+def serve_socrata(records, host="127.0.0.1", port=0, latency=0.0):
+    """Starts an HTTP server answering SoQL page and count requests.
+
+    Supports ``$select=count(*) AS row_count``, the ``min`` and ``max`` of
+    ``segmentid``, ``$where`` on ``_last_updt`` and on a ``segmentid``
+    range, ``$limit`` and ``$offset``. Records are served in the order given, so
+    pass them ordered by ``segmentid``. ``/resource/<id>.csv`` serves pages
+    as CSV with every value quoted, the way the Socrata export does. Bodies
+    are gzipped when the request accepts it, and connections are kept alive.
+    ``GET /stats`` returns the requests, connections and body bytes sent
+    since the last ``GET /stats?reset=1``.
+
+    Args:
+        records: list of dicts with string values
+        host: interface to listen on
+        port: port to listen on, 0 picks a free one
+        latency: seconds every api request waits before it is answered, the
+            round trip a page takes from Socrata
+
+    Returns:
+        http.server.ThreadingHTTPServer object: ``server``, already serving
+
+    """
+
+    stats = Counter()
+    stats_lock = threading.Lock()
+
+    def count(**increments):
+        with stats_lock:
+            stats.update(increments)
+
+    class SocrataHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, as Socrata serves it
+
+        def setup(self):
+            super().setup()
+            count(connections=1)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path == "/stats":
+                with stats_lock:
+                    payload = json.dumps(dict(stats)).encode("utf-8")
+                    if params.get("reset"):
+                        stats.clear()
+                self._send(payload, "application/json", compress=False)
+                return
+            time.sleep(latency)
+            selected = records
+            where = params.get("$where", "")
+            watermark = re.search(r"_last_updt > '([^']+)'", where)
+            if watermark:  # a text column, compared as text like the api does
+                selected = [
+                    record
+                    for record in selected
+                    if record["_last_updt"] > watermark.group(1)
+                ]
+            segment_range = re.search(
+                r"segmentid >= (\d+) AND segmentid < (\d+)", where
+            )
+            if segment_range:
+                first, end = (int(value) for value in segment_range.groups())
+                selected = [
+                    record
+                    for record in selected
+                    if first <= int(record["segmentid"]) < end
+                ]
+            select = params.get("$select", "")
+            if select.startswith("count(*)"):
+                body = [{"row_count": str(len(selected))}]
+            elif select.startswith("min(segmentid)"):
+                segment_ids = [int(record["segmentid"]) for record in selected]
+                body = [{}]
+                if segment_ids:
+                    body = [
+                        {
+                            "min_id": str(min(segment_ids)),
+                            "max_id": str(max(segment_ids)),
+                        }
+                    ]
+            else:
+                offset = int(params.get("$offset", 0))
+                body = selected[offset : offset + int(params.get("$limit", 1000))]
+            if url.path.endswith(".csv"):
+                self._send(_csv_payload(body), "text/csv")
+            else:
+                self._send(json.dumps(body).encode("utf-8"), "application/json")
+
+        def _send(self, payload, content_type, compress=True):
+            raw_bytes = len(payload)
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            accept = self.headers.get("Accept-Encoding", "")
+            if compress and "gzip" in accept:
+                payload = gzip.compress(payload, compresslevel=6)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            if compress:
+                count(requests=1, raw_bytes=raw_bytes, sent_bytes=len(payload))
+
+        def log_message(self, *args):
+            pass  # one line per page drowns the benchmark output
+
+    server = ThreadingHTTPServer((host, port), SocrataHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _csv_payload(records):
+    """Returns records as CSV bytes, a header of every key and quoted values."""
+    field_names = list(dict.fromkeys(key for record in records for key in record))
+    buffer = io.StringIO()
+    writer = csv.DictWriter(
+        buffer, fieldnames=field_names, quoting=csv.QUOTE_ALL, lineterminator="\n"
+    )
+    writer.writeheader()
+    writer.writerows(records)
+    return buffer.getvalue().encode("utf-8")
+
+
+def run_socrata_server(num_rows, start, port_queue, latency=0.0):
+    """Builds synthetic records and serves them until the process is stopped.
+
+    Meant as a ``multiprocessing.Process`` target, so the records and the
+    server's CPU time stay out of the pipeline process being measured.
+
+    Args:
+        num_rows: number of records to serve
+        start: earliest ``_last_updt`` value
+        port_queue: multiprocessing queue the listening port is put on
+        latency: seconds every api request waits before it is answered
+
+    """
+    records = make_traffic_records(num_rows, start=start)
+    server = serve_socrata(records, latency=latency)
+    port_queue.put(server.server_address[1])
+    threading.Event().wait()
+
+
+class FilesystemBlob:
+    """Blob stored as a file, see ``google.cloud.storage.Blob``."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+        self.path = os.path.join(bucket.root, name)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def upload_from_file(self, file_obj, size=None, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as blob_file:
+            shutil.copyfileobj(file_obj, blob_file)
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, "rb") as file_obj:
+            self.upload_from_file(file_obj)
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if if_generation_match == 0:  # create only, atomic across processes
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            try:
+                blob_fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                raise PreconditionFailed(f"Object exists: {self.name}") from None
+            with os.fdopen(blob_fd, "wb") as blob_file:
+                blob_file.write(data)
+            return
+        if if_generation_match is not None:
+            with self.bucket.locked():  # compare and replace across processes
+                self._check_generation(if_generation_match)
+                temp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(temp_path, "wb") as blob_file:
+                    blob_file.write(data)
+                os.replace(temp_path, self.path)
+            return
+        self.upload_from_file(io.BytesIO(data))
+
+    @property
+    def generation(self):
+        # the file's modification time, in nanoseconds, changes on every write
+        return os.stat(self.path).st_mtime_ns if self.exists() else None
+
+    def _check_generation(self, if_generation_match):
+        if self.generation != if_generation_match:
+            raise PreconditionFailed(f"Generation changed: {self.name}")
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if self.exists() else None
+
+    def delete(self):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        os.remove(self.path)
+
+    def download_as_bytes(self, if_generation_match=None):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        with self.bucket.locked():
+            if if_generation_match is not None:
+                self._check_generation(if_generation_match)
+            with open(self.path, "rb") as blob_file:
+                return blob_file.read()
+
+
+class FilesystemBucket:
+    """Bucket stored as a directory, see ``google.cloud.storage.Bucket``."""
+
+    def __init__(self, client, name):
+        self.name = name
+        self.location = None
+        self.path = f"/b/{name}"
+        self.root = os.path.join(client.root, name)
+
+    def __repr__(self):
+        return f"<FilesystemBucket: {self.name}>"
+
+    def exists(self):
+        return os.path.isdir(self.root)
+
+    def create(self):
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob(self, blob_name):
+        return FilesystemBlob(self, blob_name)
+
+    def get_blob(self, blob_name):
+        blob = self.blob(blob_name)
+        return blob if blob.exists() else None
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Holds a lock on the bucket directory, shared by every process."""
+        os.makedirs(self.root, exist_ok=True)
+        root_fd = os.open(self.root, os.O_RDONLY)
+        try:
+            fcntl.flock(root_fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(root_fd)  # releases the lock
+
+    def list_blobs(self, prefix=""):
+        if not self.exists():
+            return []
+        names = []
+        for directory, _, files in os.walk(self.root):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                names.append(os.path.relpath(path, self.root).replace(os.sep, "/"))
+        return [self.blob(name) for name in sorted(names) if name.startswith(prefix)]
+
+
+class FilesystemStorageClient:
+    """Storage client keeping every bucket under one local directory.
+
+    Args:
+        root: directory holding one folder per bucket
+
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def bucket(self, bucket_name):
+        return FilesystemBucket(self, bucket_name)
+
+    def list_blobs(self, bucket_name, prefix=""):
+        return self.bucket(bucket_name).list_blobs(prefix=prefix)
+
+
+class LocalJob:
+    """Finished job carrying the attributes ``lib.job_metrics`` reads."""
+
+    _job_ids = itertools.count(1)
+
+    def __init__(
+        self,
+        rows=None,
+        output_rows=None,
+        num_dml_affected_rows=None,
+        total_bytes_processed=None,
+    ):
+        self.job_id = f"local_{next(self._job_ids)}"
+        self.rows = rows or []
+        self.output_rows = output_rows
+        self.num_dml_affected_rows = num_dml_affected_rows
+        # SQLite does not meter scans, only dry runs report estimated bytes
+        self.total_bytes_processed = total_bytes_processed
+        self.state = "DONE"
+        self.error_result = None
+
+    def result(self):
+        return self.rows
+
+
+table_path_pattern = re.compile(r"`(?:[\w-]+\.)?(\w+)\.(\w+)`")
+# a table path and its alias, the keywords that can follow a path are no alias
+table_reference_pattern = re.compile(
+    table_path_pattern.pattern
+    + r"(?:\s+(?:AS\s+)?(?!(?:WHERE|LEFT|JOIN|INNER|ON|USING|WHEN)\b)(\w+))?"
+)
+# a filter on the partitioning field, qualified by a table alias or not
+partition_filter_pattern = re.compile(r"(?:(\w+)\.)?_last_updt\s*>=\s*@(\w+)")
+# BigQuery only syntax rewritten into SQLite, applied in order
+sql_rewrites = [
+    # `project.dataset.table` -> "dataset__table"
+    (table_path_pattern, r'"\1__\2"'),
+    (re.compile(r"TIMESTAMP\(DATETIME ('[^']*')\)"), r"\1"),
+    (
+        re.compile(r"TIMESTAMP\(CURRENT_DATE\('([+-]\d{2}):\d{2}'\)\)"),
+        r"date('now', '\1 hours')",
+    ),
+    (re.compile(r"@(\w+)"), r":\1"),  # named query parameters
+]
+merge_pattern = re.compile(
+    r"MERGE\s+(?P<target>\S+)\s+AS\s+(?P<target_alias>\w+)\s+"
+    r"USING\s+(?P<source>\(.*\))\s+AS\s+(?P<source_alias>\w+)\s+"
+    r"ON\s+(?P<condition>.*?)\s+WHEN NOT MATCHED THEN\s+INSERT ROW",
+    re.S,
+)
+
+
+def translate_sql(sql):
+    """Rewrites the pipeline's BigQuery SQL into SQLite.
+
+    ``MERGE ... WHEN NOT MATCHED THEN INSERT ROW`` becomes an
+    ``INSERT ... WHERE NOT EXISTS`` with the same match condition.
+
+    Args:
+        sql: BigQuery standard SQL
+
+    Returns:
+        string object: ``sqlite_sql``
+
+    """
+    for pattern, replacement in sql_rewrites:
+        sql = pattern.sub(replacement, sql)
+    merge = merge_pattern.search(sql)
+    if merge:
+        sql = (
+            f"INSERT INTO {merge['target']} "
+            f"SELECT * FROM {merge['source']} AS {merge['source_alias']} "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {merge['target']} AS "
+            f"{merge['target_alias']} WHERE {merge['condition']})"
+        )
+    return sql.strip().rstrip(";")
+
+
+def _sqlite_value(value):
+    """Returns a query parameter as SQLite stores it, timestamps in UTC text."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def _python_value(value):
+    """Returns a SQLite result value, parsing timestamp text into datetimes."""
+    if isinstance(value, str) and re.match(r"\d{4}-\d{2}-\d{2}[ T]\d{2}:", value):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class SqliteBigQueryClient:
+    """BigQuery client running loads and queries against one SQLite file.
+
+    Args:
+        sqlite_path: database file, shared with ``lib.loaders.sqlite_loader``
+        project: project id used for references
+        storage_client: optional ``FilesystemStorageClient`` that
+            ``gs://`` load job sources are read from
+        dry_run_bytes: optional dict of ``<dataset_name>__<table_name>`` to
+            the bytes a dry run reports for every statement reading it,
+            instead of the bytes estimated from the table's rows
+
+    """
+
+    def __init__(
+        self,
+        sqlite_path,
+        project="local-project",
+        storage_client=None,
+        dry_run_bytes=None,
+    ):
+        self.sqlite_path = sqlite_path
+        self.project = project
+        self.storage_client = storage_client
+        self.dry_run_bytes = dry_run_bytes or {}
+        self._datasets = set()
+        self._jobs = {}  # job id -> LocalJob, for get_job on a resumed run
+        self.table_updates = []  # (table name, fields) of every update_table
+
+    def _connect(self):
+        return sqlite3.connect(self.sqlite_path, timeout=SQLITE_TIMEOUT)
+
+    def _read_layout(self, connection, table_name):
+        """Returns a table's api representation, kept for every process."""
+        connection.execute(LAYOUTS_DDL)
+        found = connection.execute(
+            "SELECT layout FROM _table_layouts WHERE name = ?", (table_name,)
+        ).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def _write_layout(self, connection, table):
+        connection.execute(LAYOUTS_DDL)
+        connection.execute(
+            "INSERT OR REPLACE INTO _table_layouts VALUES (?, ?)",
+            (self._table_name(table), json.dumps(table.to_api_repr())),
+        )
+
+    def _finish(self, job):
+        self._jobs[job.job_id] = job
+        return job
+
+    @staticmethod
+    def _table_name(table_ref):
+        return f"{table_ref.dataset_id}__{table_ref.table_id}"
+
+    def dataset(self, dataset_name):
+        return bigquery.DatasetReference(self.project, dataset_name)
+
+    def get_dataset(self, dataset_ref):
+        if dataset_ref.dataset_id not in self._datasets:
+            raise NotFound(f"Dataset not found: {dataset_ref.dataset_id}")
+        return bigquery.Dataset(dataset_ref)
+
+    def create_dataset(self, dataset):
+        self._datasets.add(dataset.dataset_id)
+        return dataset
+
+    def get_table(self, table_ref):
+        table_name = self._table_name(table_ref)
+        with self._connect() as connection:
+            found = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (table_name,),
+            ).fetchone()
+            if not found:
+                raise NotFound(f"Table not found: {table_name}")
+            (num_rows,) = connection.execute(
+                f'SELECT count(*) FROM "{table_name}"'
+            ).fetchone()
+            layout = self._read_layout(connection, table_name)
+        if layout is not None:
+            table = bigquery.Table.from_api_repr(layout)
+        else:  # created by lib.loaders.sqlite_loader, no layout kept
+            table = bigquery.Table(table_ref)
+        table._properties["numRows"] = str(num_rows)
+        return table
+
+    def _add_columns(self, table):
+        """Adds the table's schema fields its SQLite table does not have."""
+        table_name = self._table_name(table)
+        with self._connect() as connection:
+            columns = {
+                row[1]
+                for row in connection.execute(f'PRAGMA table_info("{table_name}")')
+            }
+            for field in table.schema:
+                if field.name not in columns:
+                    connection.execute(
+                        f'ALTER TABLE "{table_name}" ADD COLUMN '
+                        f'"{field.name}" {bq_to_sqlite_types[field.field_type]}'
+                    )
+
+    def create_table(self, table):
+        columns = ", ".join(
+            f'"{field.name}" {bq_to_sqlite_types[field.field_type]}'
+            for field in table.schema
+        )
+        with self._connect() as connection:
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self._table_name(table)}" ({columns})'
+            )
+            self._write_layout(connection, table)
+        return table
+
+    def update_table(self, table, fields):
+        table_name = self._table_name(table)
+        if "schema" in fields:
+            self._add_columns(table)
+        with self._connect() as connection:
+            self._write_layout(connection, table)
+        self.table_updates.append((table_name, list(fields)))
+        return self.get_table(table)
+
+    def load_table_from_file(
+        self, file_obj, table_ref, job_id=None, location=None, job_config=None
+    ):
+        if job_id in self._jobs:
+            raise Conflict(f"Already Exists: Job {self.project}:{job_id}")
+        results_df = pd.read_parquet(file_obj)
+        with self._connect() as connection:
+            results_df.to_sql(
+                self._table_name(table_ref),
+                connection,
+                if_exists="append",
+                index=False,
+            )
+        load_job = LocalJob(output_rows=len(results_df))
+        if job_id is not None:
+            load_job.job_id = job_id
+        return self._finish(load_job)
+
+    def load_table_from_uri(
+        self, source_uris, destination, job_id=None, location=None, job_config=None
+    ):
+        if job_id in self._jobs:
+            raise Conflict(f"Already Exists: Job {self.project}:{job_id}")
+        if isinstance(source_uris, str):
+            source_uris = [source_uris]
+        output_rows = 0
+        for source_uri in source_uris:
+            bucket_name, _, blob_name = source_uri[len("gs://") :].partition("/")
+            blob = self.storage_client.bucket(bucket_name).blob(blob_name)
+            load_job = self.load_table_from_file(
+                io.BytesIO(blob.download_as_bytes()), destination
+            )
+            output_rows += load_job.output_rows
+        load_job = LocalJob(output_rows=output_rows)
+        if job_id is not None:
+            load_job.job_id = job_id
+        return self._finish(load_job)
+
+    def _scan_bytes(self, connection, table_name, since=None):
+        """Returns the bytes BigQuery bills for reading a table's rows.
+
+        Strings count 2 bytes plus their UTF-8 length and every other
+        non-null value 8. With ``since`` only rows in the partitions from
+        that ``_last_updt`` on are counted, as a pruned scan reads.
+        """
+        columns = {
+            row[1]: row[2]
+            for row in connection.execute(f'PRAGMA table_info("{table_name}")')
+        }
+        if not columns:
+            return 0
+        layout = self._read_layout(connection, table_name) or {}
+        field_types = {
+            field["name"]: field["type"]
+            for field in layout.get("schema", {}).get("fields", [])
+        }
+        sizes = []
+        for column, declared_type in columns.items():
+            # tables of lib.loaders.sqlite_loader keep no layout
+            field_type = field_types.get(column, declared_type)
+            if field_type in ("STRING", "TEXT"):
+                sizes.append(f'COALESCE(2 + length(CAST("{column}" AS BLOB)), 0)')
+            else:
+                sizes.append(f'8 * ("{column}" IS NOT NULL)')
+        sizes = " + ".join(sizes)
+        sql = f'SELECT COALESCE(sum({sizes}), 0) FROM "{table_name}"'
+        if since is None:
+            return connection.execute(sql).fetchone()[0]
+        # partitions are days, so the whole day of ``since`` is read
+        return connection.execute(
+            f"{sql} WHERE _last_updt >= date(?)", (since,)
+        ).fetchone()[0]
+
+    def _dry_run_bytes(self, sql, parameters):
+        """Returns the bytes a statement's table references would scan.
+
+        A table is pruned by a ``_last_updt >= @parameter`` filter on its
+        alias, or an unqualified one following its reference.
+        """
+        references = list(table_reference_pattern.finditer(sql))
+        aliases = {reference[3]: reference for reference in references}
+        since = {}
+        for partition_filter in partition_filter_pattern.finditer(sql):
+            alias, parameter = partition_filter.groups()
+            if alias is not None:
+                reference = aliases.get(alias)
+            else:
+                preceding = [
+                    reference
+                    for reference in references
+                    if reference.start() < partition_filter.start()
+                ]
+                reference = preceding[-1] if preceding else None
+            if reference is not None:
+                since[reference.start()] = parameters[parameter]
+        estimated_bytes = 0
+        with self._connect() as connection:
+            for reference in references:
+                table_name = f"{reference[1]}__{reference[2]}"
+                if table_name in self.dry_run_bytes:
+                    estimated_bytes += self.dry_run_bytes[table_name]
+                else:
+                    estimated_bytes += self._scan_bytes(
+                        connection, table_name, since.get(reference.start())
+                    )
+        return estimated_bytes
+
+    def get_job(self, job_id, location=None):
+        if job_id not in self._jobs:
+            raise NotFound(f"Not found: Job {self.project}:{job_id}")
+        return self._jobs[job_id]
+
+    def query(self, sql, location=None, job_config=None):
+        parameters = {
+            parameter.name: _sqlite_value(parameter.value)
+            for parameter in getattr(job_config, "query_parameters", None) or []
+        }
+        if getattr(job_config, "dry_run", False):
+            return LocalJob(total_bytes_processed=self._dry_run_bytes(sql, parameters))
+        sqlite_sql = translate_sql(sql)
+        destination = getattr(job_config, "destination", None)
+        with self._connect() as connection:
+            if destination is not None:  # query results saved to a table
+                destination_name = self._table_name(destination)
+                if job_config.write_disposition == "WRITE_TRUNCATE":
+                    connection.execute(f'DELETE FROM "{destination_name}"')
+                sqlite_sql = f'INSERT INTO "{destination_name}" {sqlite_sql}'
+            cursor = connection.execute(sqlite_sql, parameters)
+            if cursor.description is None:
+                return self._finish(LocalJob(num_dml_affected_rows=cursor.rowcount))
+            Row = namedtuple(
+                "Row", [column[0] for column in cursor.description], rename=True
+            )
+            rows = [Row(*map(_python_value, row)) for row in cursor.fetchall()]
+        return self._finish(LocalJob(rows=rows))
+
+
+class MemoryExporter(base.Exporter):
+    """Trace exporter keeping every finished span in memory."""
+
+    def __init__(self):
+        self.span_datas = []
+
+    def emit(self, span_datas):
+        self.span_datas.extend(span_datas)
+
+    def export(self, span_datas):
+        self.emit(span_datas)
+
+    def span_seconds(self):
+        """Returns the duration of every span by name, in seconds."""
+        durations = {}
+        for span_data in self.span_datas:
+            start, end = (
+                datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%fZ")
+                for time in (span_data.start_time, span_data.end_time)
+            )
+            durations[span_data.name] = (end - start).total_seconds()
+        return durations
+
+
+class LocalPublisher:
+    """Pub/Sub publisher putting messages on a queue instead of a topic.
+
+    Args:
+        message_queue: ``queue.Queue`` for workers in this process, or a
+            ``multiprocessing.Queue`` shared with worker processes
+
+    """
+
+    def __init__(self, message_queue):
+        self.message_queue = message_queue
+
+    @staticmethod
+    def topic_path(project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic, data, **attributes):
+        message_id = uuid.uuid4().hex
+        self.message_queue.put((message_id, data, 1))
+        future = Future()
+        future.set_result(message_id)
+        return future
+
+
+def serve_subscription(message_queue, handler, max_attempts=5, on_done=None):
+    """Delivers queued messages to a background function until None arrives.
+
+    A message whose invocation raised is put back on the queue, so it is
+    redelivered with the same id, possibly to another worker, the way
+    Pub/Sub retries a failed background function.
+
+    Args:
+        message_queue: queue a ``LocalPublisher`` publishes to
+        handler: background function, e.g. ``main.handler``
+        max_attempts: deliveries of a message before it is dropped
+        on_done: optional callable given each message id and its outcome,
+            ``ok``, ``retry`` or ``dropped``
+
+    """
+    while True:
+        delivery = message_queue.get()
+        if delivery is None:
+            return
+        message_id, data, attempt = delivery
+        event = {"data": base64.b64encode(data).decode("utf-8")}
+        try:
+            handler(event, LocalContext(message_id))
+            outcome = "ok"
+        except Exception:
+            outcome = "retry" if attempt < max_attempts else "dropped"
+            if outcome == "retry":
+                message_queue.put((message_id, data, attempt + 1))
+        if on_done is not None:
+            on_done(message_id, outcome)
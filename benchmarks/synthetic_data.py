@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Synthetic Chicago traffic records in the shape of the 8v9j-bter api.
+
+Every value is a string, the same as the JSON sodapy returns, so the
+records can be fed to ``pd.DataFrame.from_records`` or served by a fake
+Socrata endpoint.
+
+"""
+
+# built in python modules
+import random
+from datetime import datetime, timedelta
+
+directions = ["EB", "WB", "NB", "SB"]
+headings = ["N", "S", "E", "W"]
+streets = ["Pulaski", "Western", "Ashland", "Halsted", "Cicero", "Kedzie"]
+
+
+def make_traffic_records(num_rows, seed=0, start=datetime(2019, 4, 2, 15, 0)):
+    """Returns ``num_rows`` synthetic traffic segment records.
+
+    Args:
+        num_rows: number of records to build
+        seed: random seed so runs are repeatable
+        start: earliest ``_last_updt`` value
+
+    Returns:
+        list object: ``records`` of dicts with string values
+
+    """
+    rng = random.Random(seed)
+    records = []
+    for segmentid in range(1, num_rows + 1):
+        last_updt = start + timedelta(seconds=rng.randrange(0, 86400))
+        records.append(
+            {
+                "_direction": rng.choice(directions),
+                "_fromst": rng.choice(streets),
+                "_last_updt": last_updt.strftime("%Y-%m-%d %H:%M:%S.0"),
+                "_length": f"{rng.uniform(0.1, 1.5):.2f}",
+                "_lif_lat": f"{rng.uniform(41.6, 42.0):.9f}",
+                "_lit_lat": f"{rng.uniform(41.6, 42.0):.9f}",
+                "_lit_lon": f"{rng.uniform(-87.9, -87.5):.9f}",
+                "_strheading": rng.choice(headings),
+                "_tost": rng.choice(streets),
+                "_traffic": str(rng.randrange(-1, 45)),
+                "segmentid": str(segmentid),
+                "start_lon": f"{rng.uniform(-87.9, -87.5):.9f}",
+                "street": rng.choice(streets),
+            }
+        )
+        if rng.random() < 0.1:  # comments are mostly missing in the api
+            records[-1]["_comments"] = "Outside City Limits"
+    return records
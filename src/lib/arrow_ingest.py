@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""Module which ingests api records into Arrow tables without pandas.
+
+This module is responsible for:
+-Building a ``pyarrow.Table`` from api records a column at a time
+-Parsing a page of the api's CSV export straight into a typed table
+-Deriving the target Arrow schema from a BigQuery schema, once per schema
+-Casting every column of a table to that schema in Arrow, coercing values
+ that fail to cast into nulls the same way ``apply_schema`` does
+
+A table goes to the GCS Parquet writer and the BigQuery Parquet load as
+is, so nothing is copied into a dataframe on the way. Switch it on per
+pipeline with ``"ingest_engine": "arrow"``.
+
+"""
+
+# built in python modules
+import csv
+from functools import lru_cache
+import io
+
+from lib.helper_functions import lazy_import, set_logger
+
+logger = set_logger(__name__)
+
+# arrow modules, imported on first use
+pa = lazy_import("pyarrow")
+pc = lazy_import("pyarrow.compute")
+pa_csv = lazy_import("pyarrow.csv")
+
+# BigQuery data types mapped to the Arrow types they are loaded from
+bq_to_arrow_types = {
+    "STRING": "string",
+    "TIMESTAMP": "timestamp[us]",
+    "FLOAT": "float64",
+    "INTEGER": "int64",
+}
+
+
+def is_arrow_table(results_df):
+    """Returns True if the rows are held in a ``pyarrow.Table``."""
+    return type(results_df).__module__.startswith("pyarrow")
+
+
+def records_to_table(records):
+    """Builds an Arrow table from api records, one column at a time.
+
+    Columns keep the order in which their keys first appear, the same as
+    ``pd.DataFrame.from_records``, and keys missing from a record are null.
+
+    Args:
+        records: list of dicts, e.g. rows returned by sodapy
+
+    Returns:
+        pyarrow.Table object: ``results_table``
+
+    """
+    column_names = dict.fromkeys(key for record in records for key in record)
+    columns = {}
+    for column_name in column_names:
+        columns[column_name] = pa.array(
+            [record.get(column_name) for record in records]
+        )
+    results_table = pa.table(columns)
+    logger.info(f"Built an arrow table of {results_table.nbytes} bytes")
+    return results_table
+
+
+def column_max(results_table, column_name, value_type=None):
+    """Returns the largest value of a column as a Python object.
+
+    Args:
+        results_table: pyarrow table
+        column_name: name of the column
+        value_type: optional Arrow type the column is cast to first
+
+    Returns:
+        object: ``max_value``, None if every value is null
+
+    """
+    column = results_table[column_name]
+    if value_type is not None:
+        column = column.cast(value_type)
+    return pc.max(column).as_py()
+
+
+@lru_cache(maxsize=None)
+def _compile_arrow_schema(fields):
+    """Returns an Arrow schema for hashable (name, type) fields."""
+    return pa.schema(
+        [
+            (name, pa.type_for_alias(bq_to_arrow_types[field_type]))
+            for name, field_type in fields
+        ]
+    )
+
+
+def arrow_schema(schema_bq):
+    """Returns the Arrow schema a BigQuery schema is loaded from, once per schema.
+
+    Args:
+        schema_bq: list of google.cloud.bigquery.SchemaField
+
+    Returns:
+        pyarrow.Schema object: ``schema``
+
+    """
+    return _compile_arrow_schema(
+        tuple((field.name, field.field_type) for field in schema_bq)
+    )
+
+
+def _coerce_cast(column, target_type):
+    """Casts distinct values one at a time, turning failures into nulls."""
+    encoded = column.combine_chunks().dictionary_encode()
+    cast_values = []
+    for value in encoded.dictionary:
+        try:
+            cast_values.append(value.cast(target_type).as_py())
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            cast_values.append(None)
+    return pa.array(cast_values, type=target_type).take(encoded.indices)
+
+
+def cast_table(results_table, schema_bq, errors="coerce"):
+    """Converts every column in one pass to match BigQuery destination table.
+
+    The Arrow counterpart of ``data_ingestion.apply_schema``: columns keep
+    the schema order, columns missing from the api are null, and a column
+    with values that fail to cast is cast again value by value.
+
+    Args:
+        results_table: pyarrow table fetched from the api
+        schema_bq: list of google.cloud.bigquery.SchemaField
+        errors: ``coerce`` turns unparseable values into nulls,
+            ``raise`` fails on the first one
+
+    Returns:
+        pyarrow.Table object: ``results_table_transformed``
+        &
+        dict object: ``cast_failures`` of column name to failed row index
+
+    """
+    schema = arrow_schema(schema_bq)
+    columns = []
+    cast_failures = {}
+    for field in schema:
+        if field.name not in results_table.column_names:
+            # the api omits fields that are null in every returned row
+            columns.append(pa.nulls(results_table.num_rows, type=field.type))
+            continue
+        column = results_table[field.name]
+        try:
+            columns.append(column.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            if errors == "raise":
+                raise
+            converted = _coerce_cast(column, field.type)
+            failed = pc.and_(converted.is_null(), column.combine_chunks().is_valid())
+            cast_failures[field.name] = pc.indices_nonzero(failed).to_pylist()
+            columns.append(converted)
+    results_table_transformed = pa.Table.from_arrays(columns, schema=schema)
+    if cast_failures:
+        failure_counts = {name: len(rows) for name, rows in cast_failures.items()}
+        logger.warning(f"Rows failed to cast per column: {failure_counts}")
+    logger.info("Updated schema to match BigQuery destination table")
+    return results_table_transformed, cast_failures
+
+
+def read_csv_table(body, schema_bq):
+    """Parses a page of Socrata CSV into a table typed by the BigQuery schema.
+
+    Schema columns are parsed straight into their Arrow types by the
+    multithreaded CSV reader, every other column is kept as strings. Empty
+    values are null, the same as fields the JSON api leaves out. If a value
+    does not parse, the page is read as strings and cast with
+    ``cast_table``, which turns the failures into nulls.
+
+    Args:
+        body: bytes of one CSV page, starting with the header row
+        schema_bq: list of google.cloud.bigquery.SchemaField
+
+    Returns:
+        pyarrow.Table object: ``results_table``
+
+    """
+    header = next(csv.reader([body[: body.find(b"\n")].decode("utf-8")]), [])
+    schema = arrow_schema(schema_bq)
+    column_types = {
+        name: schema.field(name).type if name in schema.names else pa.string()
+        for name in header
+    }
+    read_options = {
+        "convert_options": pa_csv.ConvertOptions(
+            column_types=column_types,
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=True,
+        )
+    }
+    try:
+        return pa_csv.read_csv(io.BytesIO(body), **read_options)
+    except pa.ArrowInvalid as e:
+        logger.warning(f"CSV page did not parse into the schema, casting: {e}")
+    string_types = {name: pa.string() for name in header}
+    read_options["convert_options"].column_types = string_types
+    results_table = pa_csv.read_csv(io.BytesIO(body), **read_options)
+    typed_table, _ = cast_table(results_table, schema_bq)
+    for name in results_table.column_names:  # keep columns outside the schema
+        if name not in typed_table.column_names:
+            typed_table = typed_table.append_column(name, results_table[name])
+    return typed_table
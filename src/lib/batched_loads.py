@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""Module which batches raw appends into fewer, larger BigQuery load jobs.
+
+This module is responsible for:
+-Staging each run's converted rows as a Parquet object under a
+ date-partitioned ``staged/<table_name>/dt=YYYY-MM-DD/`` prefix in GCS
+-Tracking staged objects that are not loaded yet in a manifest
+-Loading every pending object in one load job once enough rows are pending
+ or the oldest one is old enough
+
+A run every 5 minutes appends 288 times a day to the raw table. Flushing
+every ``FLUSH_AGE_SECONDS`` keeps rows at most that stale while loading a
+fraction as often, far below the per-table load job quota.
+
+The manifest is only written if nobody wrote it since it was read, so
+overlapping runs and shard workers never drop each other's objects. The
+flush job id is saved in the manifest before the job starts and kept until
+the job is done, so a run that crashed or lost track of the job mid-flush
+is picked up by the next one instead of loading the same objects twice.
+
+"""
+
+# built in python modules
+from datetime import datetime, timezone
+import hashlib
+import time
+import uuid
+
+from lib.clients import get_bigquery_client, get_storage_client
+from lib.data_ingestion import upload_parquet_buffer
+from lib.helper_functions import _getToday, lazy_import, set_logger
+from lib.state_store import update_state
+
+logger = set_logger(__name__)
+
+# gcp modules, imported on first use to keep cold starts short
+bigquery = lazy_import("google.cloud.bigquery")
+
+STAGED_PREFIX = "staged"  # folder of Parquet objects waiting to be loaded
+MANIFEST_NAME = "load_manifest.json"  # state object under the feed's prefix
+FLUSH_ROWS = 500000  # pending rows that trigger a load job
+FLUSH_AGE_SECONDS = 900  # pending age that triggers a load job, freshness target
+
+
+def stage_rows(results_df, bucket_name, table_name, blob_prefix):
+    """Writes converted rows to a date-partitioned Parquet object in GCS.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table with converted schema
+        bucket_name: bucket the object is written to
+        table_name: table the rows will be loaded into
+        blob_prefix: start of the file name
+
+    Returns:
+        string object: ``source_uri``
+
+    """
+    day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    # the random suffix keeps overlapping runs from overwriting each other
+    file_name = f"{blob_prefix}{_getToday()}_{uuid.uuid4().hex[:8]}.parquet"
+    blob_name = f"{STAGED_PREFIX}/{table_name}/dt={day}/{file_name}"
+    blob = get_storage_client().bucket(bucket_name).blob(blob_name)
+    upload_parquet_buffer(results_df, blob, index=False)
+    return f"gs://{bucket_name}/{blob_name}"
+
+
+def should_flush(
+    manifest, flush_rows=FLUSH_ROWS, flush_age_seconds=FLUSH_AGE_SECONDS
+):
+    """Returns True if the pending objects are many or old enough to load.
+
+    Args:
+        manifest: dict with a ``pending`` list of staged objects
+        flush_rows: pending rows that trigger a load job
+        flush_age_seconds: age of the oldest pending object that triggers one
+
+    Returns:
+        bool: ``flush``
+
+    """
+    pending = manifest.get("pending", [])
+    if not pending:
+        return False
+    pending_rows = sum(staged["rows"] for staged in pending)
+    oldest_age = time.time() - min(staged["staged_at"] for staged in pending)
+    return pending_rows >= flush_rows or oldest_age >= flush_age_seconds
+
+
+def _flush_job_id(table_name, source_uris):
+    """Returns a job id unique to the table, objects and flushing entry."""
+    digest = hashlib.sha1("\n".join(source_uris).encode("utf-8")).hexdigest()
+    return f"flush_{table_name}_{digest[:16]}_{uuid.uuid4().hex[:8]}"
+
+
+def _job_failed(job_id):
+    """Returns True only if the job is known to be done with an error."""
+    from google.api_core.exceptions import NotFound
+
+    try:
+        load_job = get_bigquery_client().get_job(job_id, location="US")
+    except NotFound:  # never started, the next run starts it under its id
+        return False
+    return load_job.state == "DONE" and load_job.error_result is not None
+
+
+def _run_flush(flushing, project_id, dataset_name, table_name, schema):
+    """Starts the flush load job, or waits on it if an earlier run started it."""
+    from google.api_core.exceptions import Conflict
+
+    bigquery_client = get_bigquery_client()
+    table_ref = bigquery.TableReference.from_string(
+        f"{project_id}.{dataset_name}.{table_name}"
+    )
+    job_config = bigquery.LoadJobConfig()
+    job_config.source_format = bigquery.SourceFormat.PARQUET
+    job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+    job_config.schema = schema
+    try:
+        load_job = bigquery_client.load_table_from_uri(
+            flushing["uris"],
+            table_ref,
+            job_id=flushing["job_id"],
+            location="US",
+            job_config=job_config,
+        )
+    except Conflict:  # the job already exists, a crashed run started it
+        logger.info(f"Resuming flush job: {flushing['job_id']}")
+        load_job = bigquery_client.get_job(flushing["job_id"], location="US")
+    load_job.result()  # waits for the load job to complete
+    return load_job
+
+
+def flush_pending(
+    flushing, project_id, dataset_name, table_name, schema, bucket_name, state_path
+):
+    """Loads the flushing objects in one job and clears them from the manifest.
+
+    Only a job that is done with an error clears ``flushing``, so the next
+    run starts a new job. Any other error, e.g. a timeout waiting on the
+    job, leaves it in place and the next run waits on the same job id.
+
+    Args:
+        flushing: dict with the load ``job_id`` and the ``uris`` it loads
+        project_id: name of project where you want to upload data
+        dataset_name: name of target dataset
+        table_name: name of target table
+        schema: list of google.cloud.bigquery.SchemaField
+        bucket_name: bucket holding the manifest
+        state_path: manifest object name in the bucket
+
+    Returns:
+        google.cloud.bigquery.job.LoadJob object: ``load_job``
+
+    """
+    flushed = set(flushing["uris"])
+
+    def clear_flushing(manifest):
+        # another run may have cleared it and started a new flush already
+        if manifest.get("flushing", {}).get("job_id") == flushing["job_id"]:
+            del manifest["flushing"]
+
+    def clear_flushed(manifest):
+        clear_flushing(manifest)
+        manifest["pending"] = [
+            staged
+            for staged in manifest.get("pending", [])
+            if staged["uri"] not in flushed
+        ]
+
+    try:
+        load_job = _run_flush(flushing, project_id, dataset_name, table_name, schema)
+    except Exception:
+        if _job_failed(flushing["job_id"]):
+            # a failed job keeps failing under its id, the next run starts a new one
+            update_state(state_path, bucket_name, clear_flushing)
+        raise
+    update_state(state_path, bucket_name, clear_flushed)
+    logger.info(
+        f"Flushed {len(flushed)} staged objects, {load_job.output_rows} rows "
+        f"into: {dataset_name}.{table_name}"
+    )
+    return load_job
+
+
+def batched_load(
+    results_df,
+    project_id,
+    dataset_name,
+    table_name,
+    schema,
+    bucket_name,
+    state_prefix,
+    blob_prefix,
+    flush_rows=FLUSH_ROWS,
+    flush_age_seconds=FLUSH_AGE_SECONDS,
+):
+    """Stages rows in GCS and loads every pending object when a threshold is hit.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table with converted schema
+        project_id: name of project where you want to upload data
+        dataset_name: name of target dataset
+        table_name: name of target table
+        schema: list of google.cloud.bigquery.SchemaField
+        bucket_name: bucket holding staged objects and the manifest
+        state_prefix: the feed's state folder in the bucket
+        blob_prefix: start of the staged file names
+        flush_rows: pending rows that trigger a load job
+        flush_age_seconds: age of the oldest pending object that triggers one
+
+    Returns:
+        google.cloud.bigquery.job.LoadJob object: ``load_job`` or None if
+        nothing was flushed
+        &
+        dict object: ``batch_metrics``
+
+    """
+    state_path = f"{state_prefix}/{table_name}_{MANIFEST_NAME}"
+    source_uri = stage_rows(results_df, bucket_name, table_name, blob_prefix)
+    staged = {"uri": source_uri, "rows": len(results_df), "staged_at": time.time()}
+
+    def add_staged(manifest):
+        manifest.setdefault("pending", [])
+        if staged not in manifest["pending"]:
+            manifest["pending"].append(staged)
+        if "flushing" not in manifest and should_flush(
+            manifest, flush_rows, flush_age_seconds
+        ):
+            source_uris = [pending["uri"] for pending in manifest["pending"]]
+            # saved before the job starts, so a crashed run's job is found again
+            manifest["flushing"] = {
+                "job_id": _flush_job_id(table_name, source_uris),
+                "uris": source_uris,
+            }
+
+    manifest, _ = update_state(state_path, bucket_name, add_staged)
+    batch_metrics = {
+        "staged_objects": len(manifest["pending"]),
+        "staged_rows": sum(pending["rows"] for pending in manifest["pending"]),
+    }
+    load_job = None
+    if "flushing" in manifest:
+        flushing = manifest["flushing"]
+        # the merge has to reach back to the day the oldest flushed row was staged
+        batch_metrics["flushed_since"] = min(
+            pending["staged_at"]
+            for pending in manifest["pending"]
+            if pending["uri"] in flushing["uris"]
+        )
+        load_job = flush_pending(
+            flushing,
+            project_id,
+            dataset_name,
+            table_name,
+            schema,
+            bucket_name,
+            state_path,
+        )
+    batch_metrics["flushed"] = load_job is not None
+    logger.info(f"Batched load metrics: {batch_metrics}")
+    return load_job, batch_metrics
@@ -1,64 +1,62 @@
 #!/usr/bin/env python
-"""Module which captures number of rows in tables and runs SQL queries.
+"""Module which runs the SQL queries that accumulate unique records.
 
 This module is responsible for:
--Capturing total number of rows in a BigQuery table
 -Querying max timestamp in a date field based on rows within current date
 -Querying unique records based on the above timestamp
--Appending unique records to a final table
+-Merging unique records into a final table in one partition-pruned statement
+
+Every statement goes through ``lib.query_runner``, which passes values as
+query parameters and dry-runs it against a byte budget first.
 
 """
-# gcp modules
-from google.cloud import bigquery
+# built in python modules
+from datetime import datetime, timedelta, timezone
 
 # import logging
-from lib.helper_functions import set_logger
-
-logger = set_logger(__name__)
-
+from lib.clients import get_bigquery_client
+from lib.helper_functions import lazy_import, set_logger
+from lib.query_runner import QUERY_BYTES_BUDGET, run_query, table_path
 
-def bq_table_num_rows(dataset_name, table_name):
-    """Log total number of rows in destination bigquery table.
+# gcp modules, imported on first use to keep cold starts short
+bigquery = lazy_import("google.cloud.bigquery")
 
-    Args:
-        dataset_name: destination dataset name
-        table_name: destination table name
+logger = set_logger(__name__)
 
-    Returns:
-        Integer object: ``num_rows``
 
-    """
-    bigquery_client = (
-        bigquery.Client()
-    )  # instantiate bigquery client to interact with api
-    dataset_ref = bigquery_client.dataset(dataset_name)  # create dataset obj
-    table_ref = dataset_ref.table(table_name)  # create table obj
-    table = bigquery_client.get_table(table_ref)  # API Request
-    num_rows = table.num_rows
-    logger.info(f"Total number of rows: {table.num_rows} in {table_ref.path}")
-    return num_rows
-
-
-def query_max_timestamp(project_id, dataset_name, table_name):
+def query_max_timestamp(
+    project_id,
+    dataset_name,
+    table_name,
+    bytes_budget=QUERY_BYTES_BUDGET,
+    budget_action="refuse",
+):
     """Return the max timestamp in BigQuery table after current date in CST.
 
     Args:
         project_id: destination project id
         dataset_name: destination dataset name
         table_name: destination table name
+        bytes_budget: most bytes the query may process, None for no limit
+        budget_action: ``refuse`` or ``warn`` for a query over budget
 
     Returns:
         string object: ``max_timestamp``
 
     """
     # in central Chicago time
-    sql = f"SELECT max(_last_updt) as max_timestamp \
-            FROM `{project_id}.{dataset_name}.{table_name}` \
-            WHERE _last_updt >= TIMESTAMP(CURRENT_DATE('-06:00'))"
-    bigquery_client = bigquery.Client()  # setup the client
-    query_job = bigquery_client.query(sql)  # run the query
-    results = query_job.result()  # waits for job to complete
-    for row in results:  # returns the result
+    sql = f"""
+        SELECT max(_last_updt) AS max_timestamp
+        FROM {table_path(project_id, dataset_name, table_name)}
+        WHERE _last_updt >= @partition_start
+    """
+    query_job = run_query(
+        sql,
+        {"partition_start": current_partition_start()},
+        bytes_budget=bytes_budget,
+        budget_action=budget_action,
+    )
+    for row in query_job.result():  # returns the result
         max_timestamp = row.max_timestamp.strftime("%Y-%m-%d %H:%M:%S")
         return max_timestamp
 
@@ -71,7 +69,14 @@ def query_max_timestamp(project_id, dataset_name, table_name):
 # WRITE_APPEND: If the table already exists, BigQuery appends the data
 # WRITE_EMPTY: If the table already exists and contains data,
 # a 'duplicate' error is returned in the job result.
-def query_unique_records(project_id, dataset_name, table_name, table_name_2):
+def query_unique_records(
+    project_id,
+    dataset_name,
+    table_name,
+    table_name_2,
+    bytes_budget=QUERY_BYTES_BUDGET,
+    budget_action="refuse",
+):
     """Queries unique records from original table, saves in staging table.
 
     Unique records are filtered by filtering all records >= the max timestamp.
@@ -81,57 +86,121 @@ def query_unique_records(project_id, dataset_name, table_name, table_name_2):
         dataset_name: destination dataset name
         table_name: starting table name
         table_name_2: destination table name
+        bytes_budget: most bytes each query may process, None for no limit
+        budget_action: ``refuse`` or ``warn`` for a query over budget
+
+    Returns:
+        google.cloud.bigquery.job.QueryJob object: ``query_job``
 
     """
-    bigquery_client = bigquery.Client()
+    bigquery_client = get_bigquery_client()
     job_config = bigquery.QueryJobConfig()
     table_ref = bigquery_client.dataset(dataset_name).table(
         table_name_2
     )  # set destination table
     job_config.destination = table_ref
     job_config.write_disposition = "WRITE_TRUNCATE"
-    max_timestamp = query_max_timestamp(project_id, dataset_name, table_name)
-    sql = f"SELECT DISTINCT * FROM `{project_id}.{dataset_name}.{table_name}` \
-            WHERE _last_updt >= TIMESTAMP(DATETIME '{max_timestamp}');"
-    query_job = bigquery_client.query(
+    max_timestamp = query_max_timestamp(
+        project_id, dataset_name, table_name, bytes_budget, budget_action
+    )
+    sql = f"""
+        SELECT DISTINCT * FROM {table_path(project_id, dataset_name, table_name)}
+        WHERE _last_updt >= @max_timestamp
+    """
+    query_job = run_query(
         sql,
-        # Location must match that of the dataset(s) referenced in the query
-        # and of the destination table.
-        location="US",
+        # the max timestamp is a UTC wall time, same as TIMESTAMP(DATETIME)
+        {
+            "max_timestamp": datetime.strptime(
+                max_timestamp, "%Y-%m-%d %H:%M:%S"
+            ).replace(tzinfo=timezone.utc)
+        },
         job_config=job_config,
-    )  # API request - starts the query
-    query_job.result()
-    logger.info(f"Query results loaded to table {table_ref.path}")
+        bytes_budget=bytes_budget,
+        budget_action=budget_action,
+    )
+    logger.info(
+        f"Query results loaded to table {table_ref.path}, "
+        f"bytes processed: {query_job.total_bytes_processed}"
+    )
+    return query_job
+
 
+def current_partition_start(now=None):
+    """Returns midnight of the current date in CST as a UTC timestamp.
 
-def append_unique_records(project_id, dataset_name, table_name, table_name_2):
-    """Queries unique staging table and appends new results onto final table.
+    This matches ``TIMESTAMP(CURRENT_DATE('-06:00'))``, because
+    ``_last_updt`` displays UTC but truly represents CST.
+
+    Args:
+        now: optional aware datetime to use instead of the current time
+
+    Returns:
+        datetime object: ``partition_start``
+
+    """
+    today_cst = (now or datetime.now(timezone.utc)).astimezone(
+        timezone(timedelta(hours=-6))
+    ).date()
+    return datetime(
+        today_cst.year, today_cst.month, today_cst.day, tzinfo=timezone.utc
+    )
+
+
+def merge_unique_records(
+    project_id,
+    dataset_name,
+    table_name,
+    table_name_2,
+    partition_start=None,
+    bytes_budget=QUERY_BYTES_BUDGET,
+    budget_action="refuse",
+):
+    """Merges unique records from original table into final table in one query.
+
+    Replaces appending the staging table of ``query_unique_records`` to
+    the final table with a left join. Both tables are filtered on ``_last_updt`` so only partitions since
+    ``partition_start`` are read, and records already in the final table
+    are matched on ``segmentid`` and ``_last_updt`` and skipped.
 
     Args:
         project_id: destination project id
         dataset_name: destination dataset name
-        table_name: starting table name
+        table_name: starting table name, raw or staging
         table_name_2: destination table name
+        partition_start: earliest ``_last_updt`` to merge, defaults to
+            the current date in CST
+        bytes_budget: most bytes the merge may process, None for no limit
+        budget_action: ``refuse`` or ``warn`` for a merge over budget
+
+    Returns:
+        google.cloud.bigquery.job.QueryJob object: ``query_job``
 
     """
-    bigquery_client = bigquery.Client()
-    job_config = bigquery.QueryJobConfig()
-    table_ref = bigquery_client.dataset(dataset_name).table(
-        table_name_2
-    )  # set destination table
-    job_config.destination = table_ref
-    job_config.write_disposition = "WRITE_APPEND"
-    # left outer join to avoid appending duplicate data
-    sql = f"SELECT a.* FROM `{project_id}.{dataset_name}.{table_name}` a \
-            LEFT JOIN `{project_id}.{dataset_name}.{table_name_2}` b \
-            on a.segmentid = b.segmentid AND a._last_updt = b._last_updt \
-            WHERE b.segmentid IS NULL;"
-    query_job = bigquery_client.query(
+    if partition_start is None:
+        partition_start = current_partition_start()
+    sql = f"""
+        MERGE {table_path(project_id, dataset_name, table_name_2)} AS final
+        USING (
+            SELECT DISTINCT *
+            FROM {table_path(project_id, dataset_name, table_name)}
+            WHERE _last_updt >= @partition_start
+        ) AS source
+        ON final._last_updt >= @partition_start
+            AND final.segmentid = source.segmentid
+            AND final._last_updt = source._last_updt
+        WHEN NOT MATCHED THEN
+            INSERT ROW
+    """
+    query_job = run_query(
         sql,
-        # Location must match that of the dataset(s) referenced in the query
-        # and of the destination table.
-        location="US",
-        job_config=job_config,
-    )  # API request - starts the query
-    query_job.result()
-    logger.info(f"Query results loaded to table {table_ref.path}")
+        {"partition_start": partition_start},
+        bytes_budget=bytes_budget,
+        budget_action=budget_action,
+    )
+    logger.info(
+        f"Merged {query_job.num_dml_affected_rows} new records into table "
+        f"{dataset_name}.{table_name_2}, "
+        f"bytes processed: {query_job.total_bytes_processed}"
+    )
+    return query_job
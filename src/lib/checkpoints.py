@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Module which checkpoints finished pipeline stages so retries resume.
+
+This module is responsible for:
+-Keeping one manifest per pipeline run, keyed by the Pub/Sub message id, of
+ the stages that finished and the outputs they saved
+-Saving BigQuery jobs by reference and fetching them again on a retry
+
+Pub/Sub redelivers a message whose invocation failed, and may deliver any
+message twice. A retry reads the run's manifest and ``lib.stage_executor``
+skips every stage that already wrote its results, so rows are appended to
+the raw table once per message, never once per attempt.
+
+"""
+
+from lib.clients import get_bigquery_client
+from lib.helper_functions import set_logger
+from lib.state_store import read_state, write_state
+
+logger = set_logger(__name__)
+
+CHECKPOINT_FOLDER = "checkpoints"  # manifests live under the feed's state prefix
+
+
+def checkpoint_path(state_prefix, message_id):
+    """Returns the state object path of a run's checkpoint manifest.
+
+    Args:
+        state_prefix: folder of the feed's state objects
+        message_id: Pub/Sub message id the run was triggered by
+
+    Returns:
+        string object: ``state_path``
+
+    """
+    return f"{state_prefix}/{CHECKPOINT_FOLDER}/{message_id}.json"
+
+
+class RunCheckpoint:
+    """Manifest of the stages one run finished and the outputs they saved.
+
+    Args:
+        state_path: blob name in the bucket, or local file path
+        bucket_name: optional name of bucket holding the manifest
+
+    """
+
+    def __init__(self, state_path, bucket_name=None):
+        self.state_path = state_path
+        self.bucket_name = bucket_name
+        self.stages = read_state(state_path, bucket_name).get("stages", {})
+        if self.stages:
+            logger.info(f"Resuming run, finished stages: {sorted(self.stages)}")
+
+    def saved_values(self):
+        """Returns every value saved by the finished stages, in one dict."""
+        saved = {}
+        for values in self.stages.values():
+            saved.update(values)
+        return saved
+
+    def record(self, stage_name, values):
+        """Marks a stage as finished and saves its JSON serializable values.
+
+        Args:
+            stage_name: name of the finished stage
+            values: dict of values the stage's outputs are restored from
+
+        """
+        self.stages[stage_name] = values
+        write_state({"stages": self.stages}, self.state_path, self.bucket_name)
+
+
+def job_reference(job):
+    """Returns what a job is fetched again by, local load stats as they are.
+
+    Args:
+        job: google.cloud.bigquery job, dict of load stats, or None
+
+    Returns:
+        dict object: ``reference`` or None
+
+    """
+    if job is None or isinstance(job, dict):
+        return job
+    return {"job_id": job.job_id, "location": getattr(job, "location", None)}
+
+
+def fetch_job(reference):
+    """Returns the job a ``job_reference`` points at.
+
+    Args:
+        reference: output of ``job_reference``
+
+    Returns:
+        google.cloud.bigquery job, dict of load stats, or None: ``job``
+
+    """
+    if reference is None or "job_id" not in reference:
+        return reference
+    return get_bigquery_client().get_job(
+        reference["job_id"], location=reference["location"]
+    )
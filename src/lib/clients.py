@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Module which shares google cloud clients across lib modules.
+
+This module is responsible for:
+-Lazily building one BigQuery and one Storage client per process, and
+ sharing any other client by name the same way
+-Reusing their keep-alive HTTP sessions across warm invocations
+-Counting the clients and HTTP connections each run created
+-Swapping in stand-in clients, e.g. local fakes for offline benchmarks
+
+Cloud Functions keep module level state alive between invocations on a warm
+instance, so credential discovery and TLS handshakes only happen once.
+
+"""
+
+# built in python modules
+import threading
+
+from lib.helper_functions import lazy_import, set_logger
+
+# gcp modules, imported on first use to keep cold starts short
+bigquery = lazy_import("google.cloud.bigquery")
+storage = lazy_import("google.cloud.storage")
+
+logger = set_logger(__name__)
+
+_clients = {}  # client name -> client object, lives as long as the instance
+_lock = threading.Lock()
+_run_stats = {"clients_created": 0, "connections_at_start": 0}
+
+
+def _get_client(name, client_factory):
+    """Returns the shared client for ``name``, building it on first use."""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    with _lock:
+        if name not in _clients:  # another thread may have built it meanwhile
+            _clients[name] = client_factory()
+            _run_stats["clients_created"] += 1
+            logger.info(f"Created shared {name} client")
+        return _clients[name]
+
+
+def get_bigquery_client():
+    """Returns the process-wide ``google.cloud.bigquery.Client``."""
+    return _get_client("bigquery", bigquery.Client)
+
+
+def get_storage_client():
+    """Returns the process-wide ``google.cloud.storage.Client``."""
+    return _get_client("storage", storage.Client)
+
+
+def get_shared_client(name, client_factory):
+    """Returns the process-wide client for ``name``, built by ``client_factory``.
+
+    Lets other lib modules share their own clients the same way, e.g. one
+    Socrata client per api domain.
+
+    """
+    return _get_client(name, client_factory)
+
+
+def register_client(name, client):
+    """Replaces the shared client for ``name``, e.g. with a local stand-in.
+
+    Args:
+        name: ``bigquery`` or ``storage``
+        client: object with the methods the lib modules call on that client
+
+    """
+    with _lock:
+        _clients[name] = client
+    logger.info(f"Registered {type(client).__name__} as the shared {name} client")
+
+
+def connection_count():
+    """Returns the number of HTTP connections opened by the shared clients.
+
+    Reads ``num_connections`` from every urllib3 pool behind the clients'
+    requests sessions, so reused keep-alive connections are not counted.
+
+    Returns:
+        Integer object: ``num_connections``
+
+    """
+    num_connections = 0
+    for client in list(_clients.values()):
+        session = getattr(client, "_http_internal", None)
+        if session is None or not hasattr(session, "adapters"):
+            continue
+        for adapter in session.adapters.values():
+            pool_manager = getattr(adapter, "poolmanager", None)
+            if pool_manager is None:
+                continue
+            for key in list(pool_manager.pools.keys()):
+                pool = pool_manager.pools.get(key)
+                if pool is not None:
+                    num_connections += pool.num_connections
+    return num_connections
+
+
+def start_client_stats():
+    """Resets the per-run client counters, call once at the start of a run."""
+    _run_stats["clients_created"] = 0
+    _run_stats["connections_at_start"] = connection_count()
+
+
+def client_stats():
+    """Returns how many clients and HTTP connections this run created.
+
+    Returns:
+        dict object: ``stats``
+
+    """
+    stats = {
+        "clients_created": _run_stats["clients_created"],
+        "connections_created": connection_count()
+        - _run_stats["connections_at_start"],
+        "clients_alive": len(_clients),
+    }
+    logger.info(f"Client stats for this run: {stats}")
+    return stats
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""Module which shrinks dataframes in memory without changing what is written.
+
+This module is responsible for:
+-Storing repeated string values, e.g. directions and street names, as
+ categoricals
+-Building a compact dataframe from api records a column at a time
+-Downcasting numeric columns to the smallest dtype that holds every value
+ exactly
+-Writing compact dataframes to Parquet with their original column types, so
+ files and loads are byte for byte the same as without compaction
+-Reporting the in-memory size of a dataframe
+
+Cloud Functions share their memory tier with the /tmp tmpfs, so a smaller
+dataframe leaves more room for the buffers serialized from it.
+
+"""
+
+# built in python modules
+import json
+
+from lib.helper_functions import lazy_import, set_logger
+
+logger = set_logger(__name__)
+
+# numeric and dataframe modules, imported on first use
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+pa = lazy_import("pyarrow")
+pq = lazy_import("pyarrow.parquet")
+
+CATEGORY_MAX_RATIO = 0.5  # distinct values per row below which strings are categorized
+
+
+def frame_bytes(results_df):
+    """Returns the in-memory size of a dataframe, counting string contents.
+
+    Args:
+        results_df: pandas dataframe
+
+    Returns:
+        Integer object: ``num_bytes``
+
+    """
+    return int(results_df.memory_usage(index=True, deep=True).sum())
+
+
+def _is_plain_string(column):
+    """Returns True for object or string columns that are not categorical."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return False
+    return pd.api.types.is_object_dtype(column) or pd.api.types.is_string_dtype(
+        column
+    )
+
+
+def compact_strings(results_df, max_ratio=CATEGORY_MAX_RATIO):
+    """Stores string columns with few distinct values as categoricals.
+
+    Columns are replaced one at a time, so at most one column is held twice.
+
+    Args:
+        results_df: pandas dataframe, changed in place
+        max_ratio: distinct values per row below which a column is categorized
+
+    Returns:
+        Dataframe object: ``results_df``
+
+    """
+    num_rows = len(results_df)
+    for column_name in results_df.columns:
+        column = results_df[column_name]
+        if not num_rows or not _is_plain_string(column):
+            continue
+        if column.nunique(dropna=True) <= max_ratio * num_rows:
+            results_df[column_name] = column.astype("category")
+    return results_df
+
+
+def _is_repeated_strings(values, max_ratio):
+    """Returns True if every value is a string or None and few are distinct."""
+    if not all(value is None or isinstance(value, str) for value in values):
+        return False  # numbers or nested fields, e.g. Socrata locations
+    return len(set(values)) <= max_ratio * len(values)
+
+
+def records_to_compact_frame(records, max_ratio=CATEGORY_MAX_RATIO):
+    """Builds a dataframe from records with repeated strings categorized.
+
+    Columns are built one at a time straight from the records, so the feed
+    is never held as one wide array of strings the way
+    ``pd.DataFrame.from_records`` holds it. Columns keep the order in which
+    their keys first appear, the same as ``from_records``.
+
+    Args:
+        records: list of dicts, e.g. rows returned by sodapy
+        max_ratio: distinct values per row below which a column is categorized
+
+    Returns:
+        Dataframe object: ``results_df``
+
+    """
+    if not records:
+        return pd.DataFrame.from_records(records)
+    column_names = dict.fromkeys(key for record in records for key in record)
+    columns = {}
+    for column_name in column_names:
+        values = [record.get(column_name) for record in records]
+        if _is_repeated_strings(values, max_ratio):
+            columns[column_name] = pd.Categorical(values)
+        else:
+            columns[column_name] = pd.Series(values)
+        del values
+    results_df = pd.DataFrame(columns, copy=False)
+    logger.info(f"Built a compact dataframe of {frame_bytes(results_df)} bytes")
+    return results_df
+
+
+def downcast_numerics(results_df):
+    """Downcasts integer and float columns where no value changes.
+
+    Integers take the smallest signed type that holds their range. Floats
+    only become float32 if every value survives the round trip, which is rare
+    for coordinates, so BigQuery FLOAT columns keep their exact values.
+
+    Args:
+        results_df: pandas dataframe, changed in place
+
+    Returns:
+        Dataframe object: ``results_df``
+
+    """
+    for column_name in results_df.columns:
+        column = results_df[column_name]
+        if pd.api.types.is_integer_dtype(column):
+            results_df[column_name] = pd.to_numeric(column, downcast="integer")
+        elif column.dtype == "float64":
+            narrowed = column.astype("float32")
+            if np.array_equal(
+                narrowed.to_numpy(dtype="float64"), column.to_numpy(), equal_nan=True
+            ):
+                results_df[column_name] = narrowed
+    return results_df
+
+
+def compact_frame(results_df):
+    """Categorizes repeated strings and downcasts numerics, logging the savings.
+
+    Args:
+        results_df: pandas dataframe, changed in place
+
+    Returns:
+        Dataframe object: ``results_df``
+
+    """
+    before = frame_bytes(results_df)
+    results_df = downcast_numerics(compact_strings(results_df))
+    logger.info(
+        f"Compacted dataframe from {before} to {frame_bytes(results_df)} bytes"
+    )
+    return results_df
+
+
+def _wide_dtype(dtype):
+    """Returns the dtype a compacted column had before compaction, or None."""
+    if isinstance(dtype, pd.CategoricalDtype):
+        return dtype.categories.dtype
+    if pd.api.types.is_extension_array_dtype(dtype):
+        if pd.api.types.is_integer_dtype(dtype) and dtype != "Int64":
+            return pd.Int64Dtype()
+        return None
+    if pd.api.types.is_signed_integer_dtype(dtype) and dtype != "int64":
+        return np.dtype("int64")
+    if dtype == "float32":
+        return np.dtype("float64")
+    return None
+
+
+def to_arrow_table(results_df, index=None):
+    """Converts a dataframe to an Arrow table with its wide column types.
+
+    Categorical and downcast columns are cast back in Arrow, one column at a
+    time, and their pandas metadata is rewritten to match, so a compacted
+    dataframe converts to the same table as the original one.
+
+    Args:
+        results_df: pandas dataframe, a pyarrow table is returned as is
+        index: keep the index as a column, same as ``DataFrame.to_parquet``
+
+    Returns:
+        pyarrow.Table object: ``table``
+
+    """
+    if isinstance(results_df, pa.Table):
+        return results_df
+    from_pandas_kwargs = {}
+    if index is not None:
+        from_pandas_kwargs["preserve_index"] = index
+    table = pa.Table.from_pandas(results_df, **from_pandas_kwargs)
+    wide_dtypes = {
+        column_name: wide_dtype
+        for column_name, wide_dtype in (
+            (column_name, _wide_dtype(results_df[column_name].dtype))
+            for column_name in results_df.columns
+        )
+        if wide_dtype is not None
+    }
+    if not wide_dtypes:
+        return table
+    # an empty frame of the wide types gives their arrow types and metadata
+    wide_schema = pa.Schema.from_pandas(
+        results_df.head(0).astype(wide_dtypes), preserve_index=False
+    )
+    wide_columns = {
+        column["name"]: column
+        for column in json.loads(wide_schema.metadata[b"pandas"])["columns"]
+    }
+    for column_name in wide_dtypes:
+        position = table.schema.get_field_index(column_name)
+        field = wide_schema.field(column_name)
+        table = table.set_column(
+            position, field, table.column(position).cast(field.type)
+        )
+    pandas_metadata = json.loads(table.schema.metadata[b"pandas"])
+    pandas_metadata["columns"] = [
+        wide_columns[column["name"]] if column["name"] in wide_dtypes else column
+        for column in pandas_metadata["columns"]
+    ]
+    return table.replace_schema_metadata(
+        {**table.schema.metadata, b"pandas": json.dumps(pandas_metadata).encode()}
+    )
+
+
+def write_parquet(results_df, destination, compression="snappy", index=None, **kwargs):
+    """Writes a dataframe to Parquet with its wide column types.
+
+    Same as ``DataFrame.to_parquet(engine="pyarrow")``, which it stands in
+    for, except that compacted columns are written as their original types.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table
+        destination: file path or writable binary buffer
+        compression: Parquet compression codec
+        index: keep the index as a column, same as ``DataFrame.to_parquet``
+        **kwargs: passed to ``pyarrow.parquet.write_table``
+
+    """
+    table = to_arrow_table(results_df, index)
+    pq.write_table(table, destination, compression=compression, **kwargs)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""Module which compacts a day of small raw Parquet objects into a few large ones.
+
+This module is responsible for:
+-Listing a day's raw ``<blob_prefix><YYYYmmddHHMMSS>.gzip`` objects by prefix
+-Casting every object to the feed's schema, so objects written as strings
+ by the JSON path and typed by the CSV path merge into one typed frame
+-Merging them into large Parquet files sorted by the record keys, laid out
+ as ``compacted/<feed>/dt=YYYY-MM-DD/part-<generation>-NNNNN.parquet``
+-Writing a manifest of the sources and parts next to them, so readers and
+ backfills list one small object instead of a day of raw ones
+-Optionally deleting the raw objects once the manifest is written
+
+A day with no raw objects newer than its manifest is skipped, and late
+objects are merged into the day's existing parts, so the job is safe to
+rerun and to schedule a day late.
+
+"""
+
+# built in python modules
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import io
+import json
+
+from lib.clients import get_storage_client
+from lib.data_ingestion import apply_schema, compile_schema
+from lib.helper_functions import lazy_import, set_logger
+from lib.record_index import KEY_COLUMNS
+
+logger = set_logger(__name__)
+
+# pandas dataframe module, imported on first use
+pd = lazy_import("pandas")
+
+COMPACTED_PREFIX = "compacted"  # folder of compacted days in the raw bucket
+MANIFEST_NAME = "_manifest.json"  # manifest object in every dt= folder
+PART_ROWS = 2000000  # rows per compacted file
+ROW_GROUP_ROWS = 100000  # rows per row group, sorted so min/max stats prune
+MAX_WORKERS = 8  # raw objects downloaded at the same time
+
+
+def day_prefix(blob_prefix, day):
+    """Returns the name prefix shared by a day's raw objects.
+
+    Args:
+        blob_prefix: start of the raw file names, e.g. ``traffic_``
+        day: date of the objects
+
+    Returns:
+        string object: ``prefix``
+
+    """
+    return f"{blob_prefix}{day.strftime('%Y%m%d')}"
+
+
+def compacted_folder(blob_prefix, day):
+    """Returns the ``dt=`` folder a day of raw objects is compacted into."""
+    return f"{COMPACTED_PREFIX}/{blob_prefix.rstrip('_')}/dt={day.isoformat()}"
+
+
+def read_manifest(bucket_name, blob_prefix, day):
+    """Returns the manifest of a compacted day, or None if it was not compacted.
+
+    Args:
+        bucket_name: raw data bucket
+        blob_prefix: start of the raw file names
+        day: date of the objects
+
+    Returns:
+        dict object: ``manifest``
+
+    """
+    bucket = get_storage_client().bucket(bucket_name)
+    blob = bucket.blob(f"{compacted_folder(blob_prefix, day)}/{MANIFEST_NAME}")
+    if not blob.exists():
+        return None
+    return json.loads(blob.download_as_bytes())
+
+
+def _read_parquet_blob(blob, compiled_schema=None):
+    """Downloads a Parquet object into a dataframe, cast to the schema if given."""
+    results_df = pd.read_parquet(io.BytesIO(blob.download_as_bytes()), engine="pyarrow")
+    if compiled_schema is not None:
+        results_df, _ = apply_schema(results_df, compiled_schema)
+    return results_df
+
+
+def _write_part(results_df, blob):
+    """Writes one sorted part, returning its size in bytes."""
+    buffer = io.BytesIO()
+    results_df.to_parquet(
+        buffer,
+        engine="pyarrow",
+        compression="snappy",  # compacted days are read often, raw ones rarely
+        index=False,
+        row_group_size=ROW_GROUP_ROWS,
+    )
+    num_bytes = buffer.tell()
+    buffer.seek(0)
+    blob.upload_from_file(
+        buffer, size=num_bytes, content_type="application/octet-stream"
+    )
+    return num_bytes
+
+
+def _delete_orphan_parts(storage_client, bucket_name, folder, manifest):
+    """Deletes parts a crashed compaction wrote but never put in a manifest."""
+    referenced = {part["name"] for part in (manifest or {}).get("parts", [])}
+    for blob in storage_client.list_blobs(bucket_name, prefix=f"{folder}/part-"):
+        if blob.name not in referenced:
+            logger.info(f"Deleting orphaned part: {blob.name}")
+            blob.delete()
+
+
+def compact_day(
+    bucket_name,
+    blob_prefix,
+    day,
+    sort_columns=KEY_COLUMNS,
+    part_rows=PART_ROWS,
+    delete_sources=False,
+    schema_bq=None,
+):
+    """Merges a day's raw objects into sorted, large Parquet parts.
+
+    Args:
+        bucket_name: raw data bucket
+        blob_prefix: start of the raw file names, e.g. ``traffic_``
+        day: date of the objects, as named by ``upload_raw_data_gcs``
+        sort_columns: columns the rows are sorted by
+        part_rows: rows per compacted file
+        delete_sources: delete the raw objects once the manifest is written
+        schema_bq: list of google.cloud.bigquery.SchemaField every object is
+            cast to before merging. Without it columns keep the types they
+            were written with, which only merge cleanly from one ingest path
+
+    Returns:
+        dict object: ``manifest``, None if the day has no raw objects
+
+    """
+    storage_client = get_storage_client()
+    bucket = storage_client.bucket(bucket_name)
+    manifest = read_manifest(bucket_name, blob_prefix, day)
+    compacted_sources = set(manifest["sources"]) if manifest else set()
+    new_sources = sorted(
+        (
+            blob
+            for blob in storage_client.list_blobs(
+                bucket_name, prefix=day_prefix(blob_prefix, day)
+            )
+            if blob.name not in compacted_sources
+        ),
+        key=lambda blob: blob.name,
+    )
+    if not new_sources:
+        logger.info(f"Nothing new to compact for {day}")
+        return manifest
+    # late objects are merged into the existing parts, which still hold the
+    # earlier sources even if those were deleted
+    inputs = new_sources
+    if manifest is not None:
+        inputs = [bucket.blob(part["name"]) for part in manifest["parts"]] + inputs
+    source_names = sorted(compacted_sources | {blob.name for blob in new_sources})
+    folder = compacted_folder(blob_prefix, day)
+    _delete_orphan_parts(storage_client, bucket_name, folder, manifest)
+
+    compiled_schema = compile_schema(schema_bq) if schema_bq is not None else None
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        frames = list(
+            executor.map(lambda blob: _read_parquet_blob(blob, compiled_schema), inputs)
+        )
+    results_df = pd.concat(frames, ignore_index=True, sort=False)
+    del frames
+    results_df = results_df.sort_values(
+        [column for column in sort_columns if column in results_df.columns],
+        ignore_index=True,
+        kind="stable",
+    )
+
+    # every compaction writes new part names and only then swaps the
+    # manifest, so a crash never leaves a manifest pointing at half the rows
+    compacted_at = datetime.now(timezone.utc)
+    generation = compacted_at.strftime("%Y%m%d%H%M%S%f")
+    parts = []
+    for part_number, start in enumerate(range(0, len(results_df), part_rows)):
+        part_name = f"{folder}/part-{generation}-{part_number:05d}.parquet"
+        part_df = results_df.iloc[start : start + part_rows]
+        num_bytes = _write_part(part_df, bucket.blob(part_name))
+        parts.append({"name": part_name, "rows": len(part_df), "bytes": num_bytes})
+    previous_parts = [part["name"] for part in (manifest or {}).get("parts", [])]
+
+    manifest = {
+        "day": day.isoformat(),
+        "rows": len(results_df),
+        "sort_columns": list(sort_columns),
+        "sources": source_names,
+        "parts": parts,
+        "compacted_at": compacted_at.isoformat(),
+    }
+    bucket.blob(f"{folder}/{MANIFEST_NAME}").upload_from_string(
+        json.dumps(manifest, indent=2), content_type="application/json"
+    )
+    for part_name in previous_parts:
+        bucket.blob(part_name).delete()
+    if delete_sources:
+        for source in new_sources:
+            source.delete()
+    logger.info(
+        f"Compacted {len(source_names)} objects, {len(results_df)} rows "
+        f"into {len(parts)} parts under: gs://{bucket_name}/{folder}"
+    )
+    return manifest
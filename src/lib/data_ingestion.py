@@ -2,55 +2,488 @@
 """Module which contains functions to ingest and check data for outliers.
 
 This module is responsible for:
+-Fetching every page of Chicago traffic data concurrently from the api
+-Choosing the api client, sodapy or a pooled transport reading JSON or CSV
 -Creating a pandas dataframe using an api call to Chicago traffic data
--Uploading a pandas dataframe to a google cloud storage bucket
--Converting pandas dataframe schema
--Checking for null outliers in scope
+-Optionally keeping dataframes compact, see ``lib.compact_frames``, or
+ skipping pandas for Arrow tables, see ``lib.arrow_ingest``
+-Tracking a high-water mark of ``_last_updt`` for incremental fetches
+-Fetching only the ``segmentid`` range of one fan-out shard
+-Uploading a pandas dataframe to a google cloud storage bucket, and reading
+ it back when a retried run resumes
+-Converting pandas dataframe schema in a single compiled pass
 -Uploading a pandas dataframe to BigQuery
 
 """
 
 # built in python modules
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from lib.arrow_ingest import (
+    column_max,
+    is_arrow_table,
+    read_csv_table,
+    records_to_table,
+)
+from lib.clients import get_shared_client, get_storage_client
+from lib.compact_frames import compact_frame, records_to_compact_frame, write_parquet
+from lib.helper_functions import _getToday, call_with_retry, lazy_import, set_logger
+from lib.loaders import get_loader
+from lib.socrata_transport import SocrataTransport
+from lib.state_store import read_state, write_state
 
-# gcp modules
-from google.cloud import storage
-import pandas_gbq as gbq
-from google.cloud import bigquery
+logger = set_logger(__name__)
+
+# api and pandas dataframe modules, imported on first use
+sodapy = lazy_import("sodapy")
+pd = lazy_import("pandas")
+pa = lazy_import("pyarrow")
+pq = lazy_import("pyarrow.parquet")
+requests_adapters = lazy_import("requests.adapters")
+
+SOCRATA_DOMAIN = "data.cityofchicago.org"
+SOCRATA_URL_ENV_VAR = "PIPELINE_SOCRATA_URL"  # e.g. http://127.0.0.1:8080
+RESOURCE_ID = "8v9j-bter"  # unique id for chicago traffic data
+PAGE_SIZE = 1000  # rows requested per $limit/$offset page
+MAX_WORKERS = 4  # pages fetched at the same time
+PAGE_RETRIES = 3  # attempts per page before the fetch fails
+WATERMARK_FIELD = "_last_updt"  # field compared against the high-water mark
+SHARD_FIELD = "segmentid"  # numeric field fan-out shards are ranges of
+WATERMARK_STATE_PATH = "state/watermark.json"  # state object in the raw bucket
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024  # bytes above which uploads are chunked
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # must be a multiple of 256 KB
+TIMESTAMP_FORMAT = "ISO8601"  # api format, e.g. 2019-04-02 15:50:27.0
+
+
+def _build_socrata_client(domain):
+    """Builds an unauthenticated Socrata client for an api domain."""
+    socrata_url = os.environ.get(SOCRATA_URL_ENV_VAR)
+    if not socrata_url:
+        # Unauthenticated client only works with public data sets. Note 'None'
+        # in place of application token, and no username or password:
+        return sodapy.Socrata(domain, None)
+    scheme, _, domain = socrata_url.rstrip("/").rpartition("://")
+    session_adapter = {
+        "prefix": f"{scheme or 'https'}://",
+        "adapter": requests_adapters.HTTPAdapter(),
+    }
+    logger.info(f"Using Socrata server at: {socrata_url}")
+    return sodapy.Socrata(domain, None, session_adapter=session_adapter)
 
-# api module
-from sodapy import Socrata
 
-# pandas dataframe module
-import pandas as pd
+def socrata_client(domain=SOCRATA_DOMAIN):
+    """Returns the shared Socrata client for an api domain.
 
-from lib.helper_functions import _getToday, set_logger
+    Feeds on the same domain share one client and its HTTP session. The
+    ``PIPELINE_SOCRATA_URL`` environment variable points every client at
+    another server instead, e.g. a local stand-in for benchmarks.
 
-logger = set_logger(__name__)
+    Args:
+        domain: Socrata api domain
+
+    Returns:
+        sodapy Socrata client: ``data_client``
+
+    """
+    return get_shared_client(f"socrata:{domain}", lambda: _build_socrata_client(domain))
+
+
+def socrata_transport(domain=SOCRATA_DOMAIN):
+    """Returns the shared pooled transport for an api domain.
+
+    Same as ``socrata_client`` but a ``lib.socrata_transport.SocrataTransport``,
+    which keeps its connections open across warm invocations and can read
+    the CSV export.
+
+    Args:
+        domain: Socrata api domain
+
+    Returns:
+        SocrataTransport object: ``data_client``
+
+    """
+    base_url = os.environ.get(SOCRATA_URL_ENV_VAR) or f"https://{domain}"
+    return get_shared_client(
+        f"socrata_transport:{domain}", lambda: SocrataTransport(base_url)
+    )
+
+
+def get_data_client(transport="sodapy", domain=SOCRATA_DOMAIN):
+    """Returns the api client and page format a spec's transport asks for.
+
+    Args:
+        transport: ``sodapy``, ``pooled`` for JSON over the pooled
+            transport, or ``csv`` for its CSV export
+        domain: Socrata api domain
 
+    Returns:
+        api client: ``data_client``
+        &
+        string object: ``data_format``, ``json`` or ``csv``
+
+    """
+    if transport == "sodapy":
+        return socrata_client(domain), "json"
+    if transport not in ("pooled", "csv"):
+        raise ValueError(f"Unknown socrata transport: {transport}")
+    return socrata_transport(domain), "json" if transport == "pooled" else "csv"
+
+
+def count_api_rows(data_client, resource_id, **kwargs):
+    """Returns the total number of rows available in a Socrata resource.
+
+    Args:
+        data_client: sodapy Socrata client
+        resource_id: unique id of the Socrata dataset
+        **kwargs: extra SoQL parameters passed to ``Socrata.get``
+
+    Returns:
+        Integer object: ``row_count``
+
+    """
+    results = data_client.get(resource_id, select="count(*) AS row_count", **kwargs)
+    row_count = int(results[0]["row_count"])
+    logger.info(f"Total number of rows available in api: {row_count}")
+    return row_count
+
+
+def soql_where(watermark=None, segment_range=None):
+    """Returns the SoQL parameters selecting rows after a watermark in a shard.
+
+    Args:
+        watermark: optional ``_last_updt`` high-water mark, only rows updated
+            after it are selected
+        segment_range: optional [first, end) pair of numeric ``segmentid``
+            values, only rows in it are selected
+
+    Returns:
+        dict object: ``soql_filter``, empty when every row is selected
+
+    """
+    conditions = []
+    if watermark is not None:
+        conditions.append(f"{WATERMARK_FIELD} > '{watermark}'")
+    if segment_range is not None:
+        first, end = (int(value) for value in segment_range)
+        conditions.append(f"{SHARD_FIELD} >= {first} AND {SHARD_FIELD} < {end}")
+    return {"where": " AND ".join(conditions)} if conditions else {}
+
+
+def segment_bounds(data_client, resource_id, **kwargs):
+    """Returns the smallest and largest ``segmentid`` of a Socrata resource.
+
+    Args:
+        data_client: sodapy Socrata client or SocrataTransport
+        resource_id: unique id of the Socrata dataset
+        **kwargs: extra SoQL parameters, e.g. from ``soql_where``
 
-def create_results_df():
+    Returns:
+        tuple object: ``(min_segmentid, max_segmentid)``, None without rows
+
+    """
+    results = data_client.get(
+        resource_id,
+        select=f"min({SHARD_FIELD}) AS min_id, max({SHARD_FIELD}) AS max_id",
+        **kwargs,
+    )
+    if not results or results[0].get("min_id") is None:
+        logger.info("No rows in api to shard")
+        return None
+    bounds = int(float(results[0]["min_id"])), int(float(results[0]["max_id"]))
+    logger.info(f"{SHARD_FIELD} bounds in api: {bounds}")
+    return bounds
+
+
+def fetch_page(data_client, resource_id, offset, limit, **kwargs):
+    """Returns one page of records from a Socrata resource, with retries.
+
+    Pages are ordered by ``segmentid`` so that offsets are stable across
+    concurrent requests.
+
+    Args:
+        data_client: sodapy Socrata client
+        resource_id: unique id of the Socrata dataset
+        offset: number of rows to skip, sent as ``$offset``
+        limit: number of rows to return, sent as ``$limit``
+        **kwargs: extra SoQL parameters passed to ``Socrata.get``
+
+    Returns:
+        list object: ``records``
+
+    """
+    return call_with_retry(
+        data_client.get,
+        resource_id,
+        limit=limit,
+        offset=offset,
+        order="segmentid",
+        retries=PAGE_RETRIES,
+        logger=logger,
+        **kwargs,
+    )
+
+
+def fetch_all_pages(data_client, resource_id, page_size, max_workers, **kwargs):
+    """Fetches every page of a Socrata resource on a bounded thread pool.
+
+    Pages are put back together in offset order, so the result matches a
+    single ordered request.
+
+    Args:
+        data_client: sodapy Socrata client
+        resource_id: unique id of the Socrata dataset
+        page_size: number of rows per page
+        max_workers: maximum number of pages fetched at the same time
+        **kwargs: extra SoQL parameters passed to ``Socrata.get``
+
+    Returns:
+        list object: ``results``
+
+    """
+    row_count = count_api_rows(data_client, resource_id, **kwargs)
+    offsets = range(0, row_count, page_size)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # executor.map yields results in the order of offsets
+        pages = executor.map(
+            lambda offset: fetch_page(
+                data_client, resource_id, offset, page_size, **kwargs
+            ),
+            offsets,
+        )
+        results = [record for page in pages for record in page]
+    logger.info(f"Fetched {len(results)} rows in {len(offsets)} pages")
+    return results
+
+
+def fetch_csv_page(data_client, resource_id, offset, limit, schema_bq, **kwargs):
+    """Returns one CSV page of a Socrata resource as a typed table, with retries.
+
+    Args:
+        data_client: SocrataTransport
+        resource_id: unique id of the Socrata dataset
+        offset: number of rows to skip, sent as ``$offset``
+        limit: number of rows to return, sent as ``$limit``
+        schema_bq: list of google.cloud.bigquery.SchemaField the columns
+            are parsed into
+        **kwargs: extra SoQL parameters passed to ``get_csv``
+
+    Returns:
+        pyarrow.Table object: ``page_table``
+
+    """
+    body = call_with_retry(
+        data_client.get_csv,
+        resource_id,
+        limit=limit,
+        offset=offset,
+        order="segmentid",
+        retries=PAGE_RETRIES,
+        logger=logger,
+        **kwargs,
+    )
+    return read_csv_table(body, schema_bq)
+
+
+def fetch_all_tables(
+    data_client, resource_id, schema_bq, page_size, max_workers, **kwargs
+):
+    """Fetches every CSV page of a Socrata resource into one Arrow table.
+
+    The CSV counterpart of ``fetch_all_pages``: no records are built, each
+    page is parsed by the Arrow CSV reader as soon as it arrives.
+
+    Args:
+        data_client: SocrataTransport
+        resource_id: unique id of the Socrata dataset
+        schema_bq: list of google.cloud.bigquery.SchemaField
+        page_size: number of rows per page
+        max_workers: maximum number of pages fetched at the same time
+        **kwargs: extra SoQL parameters passed to ``get_csv``
+
+    Returns:
+        pyarrow.Table object: ``results_table``
+
+    """
+    row_count = count_api_rows(data_client, resource_id, **kwargs)
+    offsets = range(0, row_count, page_size)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = list(
+            executor.map(
+                lambda offset: fetch_csv_page(
+                    data_client, resource_id, offset, page_size, schema_bq, **kwargs
+                ),
+                offsets,
+            )
+        )
+    # pages may differ in columns the api left out, missing ones are null
+    results_table = (
+        pa.concat_tables(pages, promote_options="default") if pages else pa.table({})
+    )
+    logger.info(f"Fetched {results_table.num_rows} rows in {len(offsets)} CSV pages")
+    return results_table
+
+
+def read_watermark(state_path=WATERMARK_STATE_PATH, bucket_name=None):
+    """Returns the last saved high-water mark of ``_last_updt``.
+
+    Args:
+        state_path: blob name in the bucket, or local file path
+        bucket_name: optional name of bucket holding the state object
+
+    Returns:
+        string object: ``watermark`` or None on the first run
+
+    """
+    watermark = read_state(state_path, bucket_name).get(WATERMARK_FIELD)
+    if watermark is not None:  # saved in another format by an older version
+        watermark = format_watermark(pd.Timestamp(watermark))
+    logger.info(f"Current {WATERMARK_FIELD} watermark: {watermark}")
+    return watermark
+
+
+def format_watermark(timestamp):
+    """Returns a timestamp in the text format the feed stores ``_last_updt`` in.
+
+    ``_last_updt`` is a text column, e.g. ``2019-04-02 15:50:27.0``, so the
+    api compares the watermark to it character by character. An ISO
+    literal with a ``T`` would sort after every value of the same day.
+
+    Args:
+        timestamp: pandas Timestamp or datetime
+
+    Returns:
+        string object: ``watermark``
+
+    """
+    return f"{timestamp:%Y-%m-%d %H:%M:%S}.{timestamp.microsecond // 100000}"
+
+
+def latest_watermark(results_df):
+    """Returns the max ``_last_updt`` in the dataframe in the feed's format.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table fetched from the api
+
+    Returns:
+        string object: ``watermark`` or None if the dataframe is empty
+
+    """
+    if len(results_df) == 0:
+        return None
+    if is_arrow_table(results_df):
+        max_updt = column_max(results_df, WATERMARK_FIELD, "timestamp[us]")
+    else:
+        max_updt = pd.to_datetime(results_df[WATERMARK_FIELD]).max()
+    return format_watermark(max_updt)
+
+
+def write_watermark(watermark, state_path=WATERMARK_STATE_PATH, bucket_name=None):
+    """Saves a ``_last_updt`` value as the new high-water mark.
+
+    Args:
+        watermark: string from ``latest_watermark``
+        state_path: blob name in the bucket, or local file path
+        bucket_name: optional name of bucket holding the state object
+
+    """
+    write_state({WATERMARK_FIELD: watermark}, state_path, bucket_name)
+    logger.info(f"New {WATERMARK_FIELD} watermark: {watermark}")
+
+
+def update_watermark(results_df, state_path=WATERMARK_STATE_PATH, bucket_name=None):
+    """Saves the max ``_last_updt`` in the dataframe as the new high-water mark.
+
+    Call this only after the rows have been loaded, so a failed run fetches
+    the same rows again on retry.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table fetched from the api
+        state_path: blob name in the bucket, or local file path
+        bucket_name: optional name of bucket holding the state object
+
+    Returns:
+        string object: ``watermark`` or None if the dataframe is empty
+
+    """
+    watermark = latest_watermark(results_df)
+    if watermark is None:
+        logger.info("No new rows, watermark unchanged")
+        return None
+    write_watermark(watermark, state_path, bucket_name)
+    return watermark
+
+
+def create_results_df(
+    data_client=None,
+    page_size=PAGE_SIZE,
+    max_workers=MAX_WORKERS,
+    watermark=None,
+    resource_id=RESOURCE_ID,
+    compact=False,
+    engine="pandas",
+    data_format="json",
+    schema_bq=None,
+    segment_range=None,
+):
     """Create a dataframe based on JSON from the Chicago traffic API
 
     Args:
-        None
+        data_client: optional sodapy Socrata client, defaults to
+            ``socrata_client()``
+        resource_id: unique id of the Socrata dataset
+        page_size: number of rows per page
+        max_workers: maximum number of pages fetched at the same time
+        watermark: optional ``_last_updt`` high-water mark, only rows updated
+            after it are fetched
+        compact: store repeated strings as categoricals
+        engine: ``pandas`` for a dataframe, ``arrow`` for a pyarrow table
+        data_format: ``json`` records, or ``csv`` pages parsed by Arrow,
+            which needs a ``SocrataTransport`` client
+        schema_bq: list of google.cloud.bigquery.SchemaField CSV columns
+            are parsed into, required for ``csv``
+        segment_range: optional [first, end) ``segmentid`` range of a
+            fan-out shard, only rows in it are fetched
 
     Returns:
-        Dataframe object: ``results_df``
+        Dataframe object: ``results_df``, a pyarrow table for ``arrow``
 
     """
     try:
-        # First 2000 results, returned as JSON from API / converted to Python list of
-        # dictionaries by sodapy.
-        # Unauthenticated client only works with public data sets. Note 'None'
-        # in place of application token, and no username or password:
-        data_client = Socrata("data.cityofchicago.org", None)
-        results = data_client.get(
-            "8v9j-bter", limit=2000
-        )  # unique id for chicago traffic data
+        # Every page of results, returned as JSON from API / converted to Python
+        # list of dictionaries by sodapy.
+        if data_client is None:
+            data_client = socrata_client()
+        soql_filter = soql_where(watermark, segment_range)
+        if data_format == "csv":
+            results_df = fetch_all_tables(
+                data_client,
+                resource_id,
+                schema_bq,
+                page_size,
+                max_workers,
+                **soql_filter,
+            )
+            if engine != "arrow":
+                results_df = results_df.to_pandas()
+                if compact:
+                    results_df = compact_frame(results_df)
+            logger.info("Successfully created a pandas dataframe!")
+            return results_df
+        results = fetch_all_pages(
+            data_client, resource_id, page_size, max_workers, **soql_filter
+        )
 
         # Convert to pandas DataFrame
-        results_df = pd.DataFrame.from_records(results)
+        if engine == "arrow":
+            results_df = records_to_table(results)
+        elif compact:
+            results_df = records_to_compact_frame(results)
+        else:
+            results_df = pd.DataFrame.from_records(results)
+        del results  # every value is copied into the dataframe
         logger.info("Successfully created a pandas dataframe!")
 
         return results_df
@@ -68,31 +501,99 @@ def create_results_df():
 # This is a local disk mount point known as a "tmpfs" volume in which data
 # written to the volume is stored in memory.
 # Note that it will consume memory resources provisioned for the function.
-def upload_raw_data_gcs(results_df, bucket_name):
+# The in memory mode skips the tmpfs copy and streams a buffer to the blob.
+def upload_raw_data_gcs(
+    results_df, bucket_name, in_memory=True, blob_prefix="traffic_", blob_suffix=""
+):
     """Upload dataframe into google cloud storage bucket.
 
-    Deletes file in temp directory after upload.
+    By default the parquet file is serialized into an in memory buffer and
+    streamed to the blob, large buffers use a chunked resumable upload.
+    With ``in_memory=False`` the file is written to /tmp first and the
+    temp directory is emptied after upload.
 
     Args:
         results_df: pandas dataframe
         bucket_name: name of bucket to upload data towards
+        in_memory: skip the /tmp file and upload from a buffer
+        blob_prefix: start of the file name, keeps feeds in one bucket apart
+        blob_suffix: end of the file name before the extension, keeps fan-out
+            shards uploading in the same second apart
+
+    Returns:
+        string object: ``source_file_name``
 
     """
     # Write the DataFrame to GCS (Google Cloud Storage)
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     # .from_service_account_json('service_account.json') #authenticate service account
     bucket = storage_client.bucket(bucket_name)  # capture bucket details
     timestamp = _getToday()
-    source_file_name = "traffic_" + timestamp + ".gzip"  # create the file name
+    # create the file name
+    source_file_name = blob_prefix + timestamp + blob_suffix + ".gzip"
+    if in_memory:
+        blob = bucket.blob(source_file_name)  # define the binary large object(blob)
+        upload_parquet_buffer(results_df, blob)
+        logger.info(f"Successfully uploaded parquet gzip file into: {bucket}")
+        return source_file_name
     temp_path = "/tmp"
     os.chdir(temp_path)  # change to tmp path
     # blob.upload_from_string(results_df.to_parquet(source_file_name, engine = 'pyarrow', compression = 'gzip'),content_type='gzip')
-    results_df.to_parquet(source_file_name, engine="pyarrow", compression="gzip")
+    write_parquet(results_df, source_file_name, compression="gzip")
     # blob = bucket.blob(os.path.basename(source_file_name)) #define the path to the file
     blob = bucket.blob(source_file_name)  # define the binary large object(blob)
     blob.upload_from_filename(source_file_name)  # upload to bucket
     logger.info(f"Successfully uploaded parquet gzip file into: {bucket}")
     delete_temp_dir()
+    return source_file_name
+
+
+def upload_parquet_buffer(results_df, blob, index=None):
+    """Serializes a dataframe to gzip parquet in memory and uploads it to a blob.
+
+    Buffers larger than ``RESUMABLE_THRESHOLD`` are sent as a resumable
+    upload in ``UPLOAD_CHUNK_SIZE`` chunks, smaller ones in a single request.
+
+    Args:
+        results_df: pandas dataframe
+        blob: google.cloud.storage.Blob to upload towards
+        index: write the dataframe index, False for files BigQuery loads
+
+    Returns:
+        Integer object: ``num_bytes`` uploaded
+
+    """
+    buffer = io.BytesIO()
+    write_parquet(results_df, buffer, compression="gzip", index=index)
+    num_bytes = buffer.tell()
+    if num_bytes > RESUMABLE_THRESHOLD:
+        blob.chunk_size = UPLOAD_CHUNK_SIZE  # forces a chunked resumable upload
+    buffer.seek(0)
+    blob.upload_from_file(
+        buffer, size=num_bytes, content_type="application/octet-stream"
+    )
+    logger.info(f"Uploaded {num_bytes} bytes to: {blob.name}")
+    return num_bytes
+
+
+def read_raw_data_gcs(bucket_name, blob_name, engine="pandas"):
+    """Reads the rows of a raw parquet file back from the bucket.
+
+    Args:
+        bucket_name: name of bucket holding the file
+        blob_name: file name returned by ``upload_raw_data_gcs``
+        engine: ``pandas`` for a dataframe, ``arrow`` for a pyarrow table
+
+    Returns:
+        Dataframe object: ``results_df``, a pyarrow table for ``arrow``
+
+    """
+    blob = get_storage_client().bucket(bucket_name).blob(blob_name)
+    results_table = pq.read_table(io.BytesIO(blob.download_as_bytes()))
+    logger.info(f"Read {results_table.num_rows} rows back from: {blob_name}")
+    if engine == "arrow":
+        return results_table
+    return results_table.to_pandas()
 
 
 def delete_temp_dir():
@@ -120,82 +621,135 @@ def delete_temp_dir():
         logger.warning(f"{temp_path} directory is NOT empty")
 
 
-# https://stackoverflow.com/questions/21886742/convert-pandas-dtypes-to-bigquery-type-representation
-# https://stackoverflow.com/questions/44953463/pandas-google-bigquery-schema-mismatch-makes-the-upload-fail
-# http://pbpython.com/pandas_dtypes.html
-def convert_schema(results_df, schema_df):
-    """Converts data types in dataframe to match BigQuery destination table.
+def _parse_string(column, errors):
+    """Returns a string column unchanged, no copy is made."""
+    return column, None
 
-    Args:
-        results_df: pandas dataframe
-        schema_df: schema to convert towards
+
+def _parse_timestamp(column, errors):
+    """Parses a timestamp column, inferring the format only if the fast path fails.
 
     Returns:
-        Dataframe Object: ``results_df_transformed``
+        tuple object: ``(parsed, failed)``, failed is None on the fast path
 
     """
-    for (
-        k,
-        v,
-    ) in (
-        schema_df.items()
-    ):  # for each column name in the dictionary, convert the data type in the dataframe
-        results_df[k] = results_df[k].astype(v)
-    results_df_transformed = results_df
-    logger.info("Updated schema to match BigQuery destination table")
-    return results_df_transformed
+    try:
+        return pd.to_datetime(column, format=TIMESTAMP_FORMAT, cache=True), None
+    except (ValueError, TypeError):
+        parsed = pd.to_datetime(column, errors=errors, cache=True)
+        return parsed, parsed.isna() & column.notna()
+
+
+def _parse_float(column, errors):
+    """Parses a numeric column into float64, coercing only if the fast path fails.
+
+    Returns:
+        tuple object: ``(parsed, failed)``, failed is None on the fast path
+
+    """
+    try:
+        return column.astype("float64"), None
+    except (ValueError, TypeError):
+        parsed = pd.to_numeric(column, errors=errors).astype("float64", copy=False)
+        return parsed, parsed.isna() & column.notna()
+
+
+def _parse_integer(column, errors):
+    """Parses a numeric column into int64, nullable Int64 if nulls remain.
+
+    Returns:
+        tuple object: ``(parsed, failed)``, failed is None on the fast path
+
+    """
+    try:
+        return column.astype("int64"), None
+    except (ValueError, TypeError):
+        parsed = pd.to_numeric(column, errors=errors)
+        failed = parsed.isna() & column.notna()
+        return parsed.astype("Int64"), failed
+
+
+# BigQuery data types mapped to the parser used to convert towards them
+bq_type_parsers = {
+    "STRING": _parse_string,
+    "TIMESTAMP": _parse_timestamp,
+    "FLOAT": _parse_float,
+    "INTEGER": _parse_integer,
+}
 
 
-def check_nulls(results_df_transformed):
-    """Creates list of column names if any nulls in the columns.
+@lru_cache(maxsize=None)
+def _compile_fields(fields):
+    """Returns (column name, parser) pairs for hashable (name, type) fields."""
+    return tuple((name, bq_type_parsers[field_type]) for name, field_type in fields)
+
+
+def compile_schema(schema_bq):
+    """Compiles a BigQuery schema into column parsers, once per schema.
 
     Args:
-        results_df_transformed: pandas dataframe with converted schema
+        schema_bq: list of google.cloud.bigquery.SchemaField
 
     Returns:
-        list object: ``null_columns``
+        tuple object: ``compiled_schema`` of (column name, parser) pairs
+
     """
-    null_columns = []
-    check_bool = (
-        results_df_transformed.isnull().any()
-    )  # returns a boolean True/False for every column in dataframe if it contains nulls
-    for (
-        k,
-        v,
-    ) in (
-        check_bool.items()
-    ):  # for each column in check_bool having nulls, print the name of the column
-        if check_bool[v] is False:
-            null_columns.append(k)
-    logger.info(f"These are the null columns: {null_columns}")
-    return null_columns
+    return _compile_fields(
+        tuple((field.name, field.field_type) for field in schema_bq)
+    )
+
 
+def apply_schema(results_df, compiled_schema, errors="coerce", compact=False):
+    """Converts every column in one pass to match BigQuery destination table.
 
-def check_null_outliers(null_columns, nulls_expected):
-    """Creates list of any outlier null columns.
+    The caller's dataframe is left untouched, and unchanged columns are
+    shared with the new dataframe instead of copied.
 
     Args:
-        null_columns: current list of null columns in pandas dataframe
-        nulls_expected: list of nulls in scope
+        results_df: pandas dataframe
+        compiled_schema: output of ``compile_schema``
+        errors: ``coerce`` turns unparseable values into nulls,
+            ``raise`` fails on the first one
+        compact: categorize repeated strings and downcast numerics the
+            BigQuery type still holds exactly
 
     Returns:
-        list object: ``null_outliers``
+        Dataframe Object: ``results_df_transformed``
+        &
+        dict object: ``cast_failures`` of column name to failed row index
 
     """
-    null_outliers = (
-        []
-    )  # empty list to collect list of columns that are not expected to be null
-    # if any columns in the nulls expected mismatch the nulls collected, append to null_outliers
-    if any(x not in nulls_expected for x in null_columns):
-        null_outliers.append(x)
-    logger.info(f"These are the outlier null columns: {null_outliers}")
-    return null_outliers
+    converted_columns = {}
+    cast_failures = {}
+    for column_name, parser in compiled_schema:
+        if column_name in results_df:
+            column = results_df[column_name]
+        else:  # the api omits fields that are null in every returned row
+            column = pd.Series(None, index=results_df.index, dtype="object")
+        converted, failed = parser(column, errors)
+        if failed is not None and failed.any():
+            cast_failures[column_name] = results_df.index[failed.to_numpy()]
+        converted_columns[column_name] = converted
+    results_df_transformed = pd.DataFrame(converted_columns, copy=False)
+    if compact:
+        results_df_transformed = compact_frame(results_df_transformed)
+    if cast_failures:
+        failure_counts = {name: len(rows) for name, rows in cast_failures.items()}
+        logger.warning(f"Rows failed to cast per column: {failure_counts}")
+    logger.info("Updated schema to match BigQuery destination table")
+    return results_df_transformed, cast_failures
 
 
-# figure out the nullable vs. required mode schema mismatch
 # https://cloud.google.com/bigquery/docs/pandas-gbq-migration#loading_a_pandas_dataframe_to_a_table
-# https://github.com/pydata/pandas-gbq/issues/133#issuecomment-411119426
-def upload_to_gbq(results_df_transformed, project_id, dataset_name, table_name):
+def upload_to_gbq(
+    results_df_transformed,
+    project_id,
+    dataset_name,
+    table_name,
+    schema,
+    loader=None,
+    job_id=None,
+):
     """Uploads data into bigquery and appends if data already exists.
 
     Args:
@@ -203,25 +757,21 @@ def upload_to_gbq(results_df_transformed, project_id, dataset_name, table_name):
         project_id: name of project where you want to upload data
         dataset_name: name of target dataset
         table_name: name of target table
+        schema: destination table schema, e.g. ``schemas.schema_bq``
+        loader: optional loader name from ``lib.loaders``, e.g. ``sqlite``
+        job_id: optional load job id fixed per run, so a retry never loads twice
+
+    Returns:
+        load job, or load stats for local loaders: ``load_job``
 
     """
-    bigquery_client = bigquery.Client()
-    dataset_ref = bigquery_client.dataset(dataset_name)
-    table_ref = dataset_ref.table(table_name)
-    # job_config = bigquery.job.LoadJobConfig() #configure how the data loads into bigquery
-    # job_config.write_disposition = 'WRITE_TRUNCATE' #if table exists, append to it
-    # job_config.ignoreUnknownValues = 'T' #ignore columns that don't match destination schema
-    # job_config.schema_update_options ='ALLOW_FIELD_ADDITION'
-    # TODO: bad request due to schema mismatch with an index field
-    # https://github.com/googleapis/google-cloud-python/issues/5572
-    # bigquery_client.load_table_from_dataframe(results_df_transformed,
-    # table_ref, num_retries = 5, job_config = job_config).result()
-    gbq.to_gbq(
+    load_job = get_loader(loader)(
         results_df_transformed,
-        dataset_name + "." + table_name,
         project_id,
-        if_exists="append",
-        location="US",
-        progress_bar=True,
+        dataset_name,
+        table_name,
+        schema,
+        job_id=job_id,
     )
-    logger.info(f"Data uploaded into: {table_ref.path}")
+    logger.info(f"Data uploaded into: {project_id}.{dataset_name}.{table_name}")
+    return load_job
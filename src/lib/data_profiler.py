@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""Module which profiles a converted dataframe for data quality checks.
+
+This module is responsible for:
+-Computing null counts, min/max, distinct-count estimates and out of range
+ coordinates for every column in one vectorized pass
+-Computing the same profile over a pyarrow table with Arrow compute kernels
+-Building per-column thresholds from the columns where nulls are expected
+-Listing the columns that break their thresholds
+-Flattening the profile into trace span attributes
+
+"""
+
+from lib.helper_functions import lazy_import, set_logger
+
+logger = set_logger(__name__)
+
+# numeric modules, imported on first use to keep cold starts short
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+pc = lazy_import("pyarrow.compute")
+pa_types = lazy_import("pyarrow.types")
+
+DISTINCT_SKETCH_SIZE = 1024  # k in the k-minimum-values distinct estimate
+
+# rough bounding box around Chicago, coordinates outside it are outliers
+coordinate_ranges = {
+    "_lif_lat": (41.6, 42.1),
+    "_lit_lat": (41.6, 42.1),
+    "_lit_lon": (-88.0, -87.5),
+    "start_lon": (-88.0, -87.5),
+}
+
+
+def estimate_distinct(column):
+    """Estimates the number of distinct values with a k-minimum-values sketch.
+
+    Values are hashed to uint64 in one vectorized call. Short columns and
+    columns with only a handful of repeated values are counted exactly.
+
+    Args:
+        column: pandas series
+
+    Returns:
+        Integer object: ``distinct_count``
+
+    """
+    hashes = pd.util.hash_pandas_object(column.dropna(), index=False).to_numpy()
+    if len(hashes) <= DISTINCT_SKETCH_SIZE:
+        return len(np.unique(hashes))
+    # every distinct hash below the k-th smallest value is in this slice
+    smallest = np.unique(
+        np.partition(hashes, DISTINCT_SKETCH_SIZE)[:DISTINCT_SKETCH_SIZE]
+    )
+    num_smallest = len(smallest)
+    if num_smallest < 16:
+        return len(np.unique(hashes))  # heavy repeats, few values to count
+    kth_smallest = smallest[-1] / np.float64(2**64)
+    return int((num_smallest - 1) / kth_smallest)
+
+
+def build_thresholds(columns, nulls_expected, max_null_fraction=0.0):
+    """Builds per-column thresholds from the columns where nulls are expected.
+
+    Args:
+        columns: column names in the dataframe
+        nulls_expected: tuple of column names allowed to be null
+        max_null_fraction: share of nulls tolerated in every other column
+
+    Returns:
+        dict object: ``thresholds`` of column name to threshold dict
+
+    """
+    thresholds = {}
+    for column in columns:
+        if column in nulls_expected:
+            null_fraction = 1.0
+        else:
+            null_fraction = max_null_fraction
+        thresholds[column] = {
+            "max_null_fraction": null_fraction,
+            "range": coordinate_ranges.get(column),
+        }
+    return thresholds
+
+
+def profile_dataframe(results_df_transformed, thresholds):
+    """Profiles every column in one vectorized pass and checks thresholds.
+
+    Args:
+        results_df_transformed: pandas dataframe with converted schema
+        thresholds: output of ``build_thresholds``
+
+    Returns:
+        dict object: ``profile`` of column name to column statistics
+        &
+        list object: ``violations`` of column names breaking thresholds
+
+    """
+    num_rows = len(results_df_transformed)
+    null_counts = results_df_transformed.isna().sum()
+    comparable_df = results_df_transformed.select_dtypes(
+        include=["number", "datetime"]
+    )
+    minimums = comparable_df.min()
+    maximums = comparable_df.max()
+    profile = {}
+    violations = []
+    for column in results_df_transformed.columns:
+        column_threshold = thresholds.get(column, {})
+        column_profile = {
+            "nulls": int(null_counts[column]),
+            "distinct": estimate_distinct(results_df_transformed[column]),
+        }
+        if column in comparable_df:
+            column_profile["min"] = str(minimums[column])
+            column_profile["max"] = str(maximums[column])
+        value_range = column_threshold.get("range")
+        if value_range is not None:
+            values = results_df_transformed[column]
+            column_profile["out_of_range"] = int(
+                (~values.between(*value_range) & values.notna()).sum()
+            )
+        if _breaks_threshold(column_profile, column_threshold, num_rows):
+            violations.append(column)
+        profile[column] = column_profile
+    logger.info(f"Data quality violations: {violations}")
+    return profile, violations
+
+
+def _breaks_threshold(column_profile, column_threshold, num_rows):
+    """Returns True if a column has too many nulls or out of range values."""
+    null_fraction = column_profile["nulls"] / num_rows if num_rows else 0.0
+    return null_fraction > column_threshold.get("max_null_fraction", 1.0) or (
+        column_profile.get("out_of_range", 0) > 0
+    )
+
+
+def profile_table(results_table_transformed, thresholds):
+    """Profiles every column of a pyarrow table, the same as ``profile_dataframe``.
+
+    Distinct counts are exact, Arrow hashes a column in one kernel call.
+
+    Args:
+        results_table_transformed: pyarrow table with converted schema
+        thresholds: output of ``build_thresholds``
+
+    Returns:
+        dict object: ``profile`` of column name to column statistics
+        &
+        list object: ``violations`` of column names breaking thresholds
+
+    """
+    num_rows = results_table_transformed.num_rows
+    profile = {}
+    violations = []
+    for column in results_table_transformed.column_names:
+        column_threshold = thresholds.get(column, {})
+        values = results_table_transformed[column]
+        column_profile = {
+            "nulls": values.null_count,
+            "distinct": pc.count_distinct(values, mode="only_valid").as_py(),
+        }
+        if (
+            pa_types.is_integer(values.type)
+            or pa_types.is_floating(values.type)
+            or pa_types.is_timestamp(values.type)
+        ):
+            min_max = pc.min_max(values)
+            column_profile["min"] = str(min_max["min"].as_py())
+            column_profile["max"] = str(min_max["max"].as_py())
+        value_range = column_threshold.get("range")
+        if value_range is not None:
+            in_range = pc.and_(
+                pc.greater_equal(values, value_range[0]),
+                pc.less_equal(values, value_range[1]),
+            )
+            column_profile["out_of_range"] = pc.sum(pc.invert(in_range)).as_py() or 0
+        if _breaks_threshold(column_profile, column_threshold, num_rows):
+            violations.append(column)
+        profile[column] = column_profile
+    logger.info(f"Data quality violations: {violations}")
+    return profile, violations
+
+
+def profile_attributes(profile):
+    """Flattens a profile into ``<column>.<statistic>`` span attributes.
+
+    Args:
+        profile: output of ``profile_dataframe``
+
+    Returns:
+        dict object: ``attributes``
+
+    """
+    return {
+        f"{column}.{statistic}": value
+        for column, column_profile in profile.items()
+        for statistic, value in column_profile.items()
+    }
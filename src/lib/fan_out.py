@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Module which fans one pipeline run out over many function instances.
+
+This module is responsible for:
+-Splitting a feed's ``segmentid`` range into one shard per worker
+-Publishing one Pub/Sub message per shard, which ``main.handler`` runs as a
+ worker on its own function instance
+-Collecting the report every worker writes once its shard is loaded
+-Letting exactly one worker, the one that sees every report, run the final
+ merge and advance the watermark
+
+One instance that fetches, converts and loads every row is capped by its
+CPU and memory. A coordinator run only plans and publishes the shards,
+every worker loads its own shard into the raw table, and the final stage
+runs once after all of them. Switch it on per pipeline with
+``"shard_count"``.
+
+"""
+
+# built in python modules
+import json
+
+from lib.clients import get_shared_client, get_storage_client
+from lib.helper_functions import lazy_import, set_logger
+from lib.state_store import read_state, write_state
+
+# gcp modules, imported on first use to keep cold starts short
+pubsub_v1 = lazy_import("google.cloud.pubsub_v1")
+
+logger = set_logger(__name__)
+
+SHARD_FOLDER = "shards"  # run folders live under the feed's state prefix
+REPORT_PREFIX = "report-"  # one report per shard, ``report-<index>.json``
+FINAL_CLAIM_NAME = "final.json"  # created once, by the worker running the final stage
+
+
+def shard_ranges(min_id, max_id, shard_count):
+    """Splits an inclusive ``segmentid`` range into ranges of equal width.
+
+    Args:
+        min_id: smallest ``segmentid``
+        max_id: largest ``segmentid``
+        shard_count: number of ranges wanted, fewer if there are fewer ids
+
+    Returns:
+        list object: ``ranges`` of [first, end) pairs covering every id
+
+    """
+    num_ids = max_id - min_id + 1
+    shard_count = max(1, min(shard_count, num_ids))
+    bounds = [min_id + num_ids * index // shard_count for index in range(shard_count)]
+    bounds.append(max_id + 1)
+    return [[first, end] for first, end in zip(bounds, bounds[1:])]
+
+
+def shard_folder(state_prefix, run_id):
+    """Returns the state folder a fan-out run's reports are written to."""
+    return f"{state_prefix}/{SHARD_FOLDER}/{run_id}"
+
+
+def shard_specs(spec, run_id, ranges, watermark):
+    """Returns one worker spec per shard of a coordinator's spec.
+
+    Every worker fetches rows after the coordinator's watermark, so the
+    shards together cover exactly the rows one instance would have fetched.
+
+    Args:
+        spec: pipeline spec as the coordinator received it
+        run_id: id of the fan-out run, shared by its shards
+        ranges: list of [first, end) ``segmentid`` pairs
+        watermark: ``_last_updt`` high-water mark read by the coordinator
+
+    Returns:
+        list object: ``specs``, each with a ``shard`` dict
+
+    """
+    return [
+        dict(
+            spec,
+            shard={
+                "run_id": run_id,
+                "index": index,
+                "count": len(ranges),
+                "segment_range": segment_range,
+                "watermark": watermark,
+            },
+        )
+        for index, segment_range in enumerate(ranges)
+    ]
+
+
+def publish_specs(project_id, topic, specs):
+    """Publishes one message per spec, in the format ``main.handler`` reads.
+
+    Args:
+        project_id: project of the topic
+        topic: name of the topic the pipeline function is triggered by
+        specs: list of JSON serializable pipeline specs
+
+    Returns:
+        list object: ``message_ids``
+
+    """
+    publisher = get_shared_client("pubsub", lambda: pubsub_v1.PublisherClient())
+    topic_path = publisher.topic_path(project_id, topic)
+    # the publisher batches messages, so wait only after every one is queued
+    futures = [
+        publisher.publish(topic_path, json.dumps({"pipelines": [spec]}).encode())
+        for spec in specs
+    ]
+    message_ids = [future.result() for future in futures]
+    logger.info(f"Published {len(message_ids)} shard messages to {topic_path}")
+    return message_ids
+
+
+def report_shard(bucket_name, state_prefix, shard, report):
+    """Writes a worker's report and returns every report once all are in.
+
+    Each worker writes its report before it lists the others, so the last
+    one to finish always sees every report.
+
+    Args:
+        bucket_name: name of bucket holding the feed's state objects
+        state_prefix: folder of the feed's state objects
+        shard: ``shard`` dict of the worker's spec
+        report: JSON serializable dict of what the shard loaded
+
+    Returns:
+        list object: ``reports`` in shard order, None while shards are missing
+
+    """
+    folder = shard_folder(state_prefix, shard["run_id"])
+    report_path = f"{folder}/{REPORT_PREFIX}{shard['index']}.json"
+    write_state(report, report_path, bucket_name)
+    report_paths = [
+        blob.name
+        for blob in get_storage_client().list_blobs(
+            bucket_name, prefix=f"{folder}/{REPORT_PREFIX}"
+        )
+    ]
+    if len(report_paths) < shard["count"]:
+        logger.info(f"{len(report_paths)} of {shard['count']} shards reported")
+        return None
+    report_paths.sort(key=lambda path: int(path.rsplit("-", 1)[1].split(".")[0]))
+    return [read_state(path, bucket_name) for path in report_paths]
+
+
+def claim_final_stage(bucket_name, state_prefix, run_id, claimant):
+    """Returns True if this worker is the one that runs the final stage.
+
+    The claim object is only created if it does not exist yet, so when two
+    workers see every report at once, one of them wins. A retry of the
+    winner's message finds its own claim and runs the final stage again.
+
+    Args:
+        bucket_name: name of bucket holding the feed's state objects
+        state_prefix: folder of the feed's state objects
+        run_id: id of the fan-out run
+        claimant: id of the worker's message
+
+    Returns:
+        bool: ``True`` if the final stage is this worker's to run
+
+    """
+    from google.api_core.exceptions import PreconditionFailed
+
+    blob = (
+        get_storage_client()
+        .bucket(bucket_name)
+        .blob(f"{shard_folder(state_prefix, run_id)}/{FINAL_CLAIM_NAME}")
+    )
+    try:
+        blob.upload_from_string(
+            json.dumps({"claimant": claimant}),
+            content_type="application/json",
+            if_generation_match=0,  # create only, never replace
+        )
+    except PreconditionFailed:
+        owner = json.loads(blob.download_as_bytes()).get("claimant")
+        if owner != claimant:
+            logger.info(f"Final stage of run {run_id} is claimed by {owner}")
+            return False
+    logger.info(f"Running the final stage of run {run_id}")
+    return True
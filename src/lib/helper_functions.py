@@ -2,7 +2,8 @@
 """Module with miscellaneous utility functions.
 
 This module contains a function to capture the current datetime stamp,
-and configures logging format.
+configures logging format, retries flaky calls with backoff, and defers
+heavy imports until they are first used.
 
 This module can be used to add more helper functions as needed.
 
@@ -11,8 +12,10 @@ This module can be used to add more helper functions as needed.
 # built in python modules
 
 from datetime import datetime
+import importlib
 import logging
 import sys
+import time
 
 
 def _getToday():
@@ -20,6 +23,37 @@ def _getToday():
     return datetime.now().strftime("%Y%m%d%H%M%S")
 
 
+class _LazyModule:
+    """Stand-in for a module that imports the real one on first attribute use."""
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            # import_module holds the import lock, so threads racing to the
+            # first use all get the same fully initialized module
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, attribute)
+
+
+def lazy_import(module_name):
+    """Returns a module that is only imported when first used.
+
+    Keeps heavy dependencies such as pandas or the google cloud clients off
+    the cold start import path of the function entry point.
+
+    Args:
+        module_name: dotted module name, e.g. ``google.cloud.bigquery``
+
+    Returns:
+        module-like object: ``module``
+
+    """
+    return _LazyModule(module_name)
+
+
 def set_logger(__name__):
     """Configures logger for all modules and returns logger object"""
     logger = logging.getLogger(__name__)
@@ -32,3 +66,31 @@ def set_logger(__name__):
 
     logger.addHandler(stream_handler)
     return logger
+
+
+def call_with_retry(func, *args, retries=3, backoff=0.5, logger=None, **kwargs):
+    """Calls a function and retries it with exponential backoff on failure.
+
+    Args:
+        func: callable to run
+        *args: positional arguments passed to ``func``
+        retries: total number of attempts before the error is raised
+        backoff: seconds to wait before the first retry, doubled on each retry
+        logger: optional logger used to report failed attempts
+        **kwargs: keyword arguments passed to ``func``
+
+    Returns:
+        Return value of ``func``
+
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries:
+                raise e
+            if logger is not None:
+                logger.warning(
+                    f"Attempt {attempt} of {retries} failed, retrying: {e}"
+                )
+            time.sleep(backoff * 2 ** (attempt - 1))
@@ -2,18 +2,56 @@
 """Module which creates data pipeline storage infrastructure
 
 This module has functions that create a raw data bucket
-in google cloud storage, and creates dataset-table pairs.
+in google cloud storage, and creates dataset-table pairs through
+``ensure_infrastructure``.
+
+Tables are described by a declarative ``TableSpec`` of their schema,
+partitioning, clustering, partition expiration and partition filter
+requirement. ``reconcile_table`` creates a missing table from its spec,
+and compares an existing one with it, patching what drifted in a single
+``update_table`` call.
+
+Verified resources are remembered in a registry for the life of a warm
+instance, so repeat invocations skip the existence probes until the TTL
+expires or a NotFound error forgets them.
 
 """
-# gcp modules
-from google.cloud import storage
-from google.cloud import bigquery
+# built in python modules
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import time
 
 # import logging
-from lib.helper_functions import set_logger
+from lib.clients import get_bigquery_client, get_storage_client
+from lib.helper_functions import lazy_import, set_logger
 
 logger = set_logger(__name__)
 
+# gcp modules, imported on first use to keep cold starts short
+bigquery = lazy_import("google.cloud.bigquery")
+
+INFRA_TTL_SECONDS = 3600  # how long a verified resource is trusted
+_verified_resources = {}  # resource path -> time it was last verified
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+# Layout of one table. Layout fields left None are not managed, so an
+# existing table keeps whatever it has, and an empty clustering_fields
+# removes clustering.
+TableSpec = namedtuple(
+    "TableSpec",
+    [
+        "table_name",
+        "description",
+        "schema",
+        "partition_by",  # datetime field partitioned by day
+        "clustering_fields",  # up to four fields, in filter order
+        "partition_expiration_days",  # partitions older than this are deleted
+        "require_partition_filter",  # queries must filter on partition_by
+    ],
+    defaults=(None, None, None, None),
+)
+
 
 def create_bucket(bucket_name):
     """Creates a bucket if not detected
@@ -26,7 +64,7 @@ def create_bucket(bucket_name):
           OR ``Bucket already exists: <bucket path>``
 
     """
-    client = storage.Client()
+    client = get_storage_client()
     # authenticate service account
     # .from_service_account_json('service_account.json')
     bucket = client.bucket(bucket_name)  # capture bucket details
@@ -38,117 +76,266 @@ def create_bucket(bucket_name):
         logger.info(f"Bucket already exists: {bucket.path}")
 
 
-def dataset_exists(client, dataset_reference):
-    """Return if a table exists.
+def create_dataset(dataset_name):
+    """Creates a new dataset if not detected.
 
     Args:
-        client (google.cloud.bigquery.client.Client):
-            A client to connect to the BigQuery API.
-        table_reference (google.cloud.bigquery.table.TableReference):
-            A reference to the table to look for.
+        dataset_name: Name of dataset to be created
 
     Returns:
-        bool: ``True`` if the table exists, ``False`` otherwise.
+        ``Created new dataset: <dataset path>``
+          OR ``Dataset already exists: <dataset path>``
 
     """
     from google.cloud.exceptions import NotFound
 
+    # reuse the shared client
+    bigquery_client = get_bigquery_client()
+
+    # Create a DatasetReference using a chosen dataset ID.
+    dataset_ref = bigquery_client.dataset(
+        dataset_name
+    )  # The project defaults to the Client's project if not specified.
+
+    # Construct a full Dataset object to send to the API.
+    dataset = bigquery.Dataset(dataset_ref)
+
+    # Specify the geographic location where the dataset should reside.
+    dataset.location = "US"
+
+    # Send the dataset to the API for creation only if it is not found,
+    # create_dataset raises Conflict if it already exists within the project.
     try:
-        client.get_dataset(dataset_reference)
-        return True
+        bigquery_client.get_dataset(dataset_ref)
+        logger.info(f"Dataset already exists: {dataset_ref.path}")
     except NotFound:
-        return False
+        dataset = bigquery_client.create_dataset(dataset)  # API request
+        logger.info(f"Created new dataset: {dataset_ref.path}")
 
 
-def table_exists(client, table_reference):
-    """Return if a table exists.
+def build_table(table_ref, spec):
+    """Returns a table object laid out as its spec describes.
 
     Args:
-        client (google.cloud.bigquery.client.Client):
-            A client to connect to the BigQuery API.
-        table_reference (google.cloud.bigquery.table.TableReference):
-            A reference to the table to look for.
+        table_ref: google.cloud.bigquery.table.TableReference
+        spec: ``TableSpec`` of the table
 
     Returns:
-        bool: ``True`` if the table exists, ``False`` otherwise.
+        google.cloud.bigquery.table.Table object: ``table``
 
     """
-    from google.cloud.exceptions import NotFound
+    table = bigquery.Table(table_ref, schema=spec.schema)
+    table.description = spec.description  # set on create, saves an update call
+    if spec.partition_by is not None:
+        table.time_partitioning = _time_partitioning(spec)
+    if spec.clustering_fields:
+        table.clustering_fields = list(spec.clustering_fields)
+    if spec.require_partition_filter is not None:
+        table.require_partition_filter = spec.require_partition_filter
+    return table
+
+
+def _time_partitioning(spec):
+    """Returns day partitioning on the spec's field, with its expiration."""
+    expiration_days = spec.partition_expiration_days
+    return bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.DAY,  # day is the only supported type
+        field=spec.partition_by,
+        expiration_ms=expiration_days * MS_PER_DAY if expiration_days else None,
+    )
+
+
+def table_drift(table, spec):
+    """Sets the patchable layout an existing table drifted from on the table.
+
+    Schema fields missing from the table are appended, the only schema
+    change BigQuery makes in place. Changed field types or modes, fields
+    outside the spec and a different partitioning field cannot be patched
+    and are returned as problems instead.
 
-    try:
-        client.get_table(table_reference)
-        return True
-    except NotFound:
-        return False
+    Args:
+        table: google.cloud.bigquery.table.Table fetched from the api
+        spec: ``TableSpec`` of the table
+
+    Returns:
+        list object: ``fields`` of table properties to pass to
+        ``update_table``
+        &
+        list object: ``problems`` describing drift that needs a migration
+
+    """
+    fields = []
+    problems = []
+    existing_fields = {field.name: field for field in table.schema}
+    added_fields = []
+    for field in spec.schema or []:
+        existing = existing_fields.pop(field.name, None)
+        if existing is None:
+            added_fields.append(field)
+        elif (existing.field_type, existing.mode) != (field.field_type, field.mode):
+            problems.append(
+                f"{field.name} is {existing.field_type} {existing.mode}, "
+                f"not {field.field_type} {field.mode}"
+            )
+    if existing_fields and spec.schema:
+        problems.append(f"fields not in the schema: {sorted(existing_fields)}")
+    if added_fields:
+        table.schema = list(table.schema) + added_fields
+        fields.append("schema")
+
+    if spec.partition_by is not None:
+        partitioning = table.time_partitioning
+        if partitioning is None or partitioning.field != spec.partition_by:
+            problems.append(
+                f"partitioned on {partitioning and partitioning.field}, "
+                f"not {spec.partition_by}"
+            )
+        elif spec.partition_expiration_days is not None and (
+            partitioning.expiration_ms != _time_partitioning(spec).expiration_ms
+        ):
+            table.time_partitioning = _time_partitioning(spec)
+            fields.append("time_partitioning")
+    if spec.clustering_fields is not None:
+        clustering_fields = list(spec.clustering_fields) or None
+        if (table.clustering_fields or None) != clustering_fields:
+            table.clustering_fields = clustering_fields
+            fields.append("clustering_fields")
+    if spec.require_partition_filter is not None and (
+        bool(table.require_partition_filter) != spec.require_partition_filter
+    ):
+        table.require_partition_filter = spec.require_partition_filter
+        fields.append("require_partition_filter")
+    if spec.description is not None and table.description != spec.description:
+        table.description = spec.description
+        fields.append("description")
+    return fields, problems
 
 
 # https://cloud.google.com/bigquery/docs/python-client-migration#update_a_table
-def create_dataset_table(dataset_name, table_name, table_desc, schema, partition_by):
-    """Creates a new dataset and/or table if not detected.
+def reconcile_table(dataset_name, spec):
+    """Creates a table from its spec, or patches the layout it drifted from.
+
+    Every patchable difference is sent in one ``update_table`` call. Drift
+    that needs a migration is logged, not raised, so loads keep running
+    against the table as it is.
 
     Args:
-        dataset_name: Name of dataset to be created
-        table_name: Name of table to be created within dataset
-        table_desc: table descriptions
-        schema: table schema with data types
-        partition_by: Which datetime field to partition by
+        dataset_name: name of dataset holding the table
+        spec: ``TableSpec`` of the table
 
     Returns:
-        ``Created new dataset: <dataset path>``
-          OR ``Dataset already exists: <dataset path>``
-        &
-        ``Created empty table partitioned on column: partition_by``
-          OR ``Table already exists: <table path>``
+        list object: ``fields`` that were patched, None if it was created
 
     """
-    # setup the client
-    bigquery_client = bigquery.Client()
+    from google.cloud.exceptions import NotFound
 
-    # Create a DatasetReference using a chosen dataset ID.
-    dataset_ref = bigquery_client.dataset(
-        dataset_name
-    )  # The project defaults to the Client's project if not specified.
+    bigquery_client = get_bigquery_client()
+    table_ref = bigquery_client.dataset(dataset_name).table(spec.table_name)
+    try:
+        table = bigquery_client.get_table(table_ref)
+    except NotFound:
+        bigquery_client.create_table(build_table(table_ref, spec))
+        logger.info(f"Created table {table_ref.path} from its spec")
+        return None
+
+    fields, problems = table_drift(table, spec)
+    if problems:
+        logger.warning(f"Table {table_ref.path} needs a migration: {problems}")
+    if fields:
+        bigquery_client.update_table(table, fields)
+        logger.info(f"Patched drifted layout of table {table_ref.path}: {fields}")
+    else:
+        logger.info(f"No patchable drift in table: {table_ref.path}")
+    return fields
 
-    # Construct a full Dataset object to send to the API.
-    dataset = bigquery.Dataset(dataset_ref)
 
-    # Specify the geographic location where the dataset should reside.
-    dataset.location = "US"
+def _is_verified(resource_path):
+    """Returns True if the resource was verified within the TTL."""
+    verified_at = _verified_resources.get(resource_path)
+    return verified_at is not None and (
+        time.monotonic() - verified_at < INFRA_TTL_SECONDS
+    )
 
-    # Send the dataset to the API for creation.
-    # Raises google.api_core.exceptions.
-    # Conflict if the Dataset already exists within the project.
-    if (
-        dataset_exists(bigquery_client, dataset_ref) is False
-    ):  # checks if dataset not found
-        dataset = bigquery_client.create_dataset(dataset)  # API request
-        logger.info(f"Created new dataset: {dataset_ref.path}")
-    else:
-        logger.info(f"Dataset already exists: {dataset_ref.path}")
 
-    # Create an empty table
-    table_ref = dataset_ref.table(
-        table_name
-    )  # construct a full table object to send to the api
-
-    if table_exists(bigquery_client, table_ref) is False:
-        table = bigquery.Table(table_ref, schema=schema)
-        table.time_partitioning = bigquery.TimePartitioning(
-            type_=bigquery.TimePartitioningType.DAY,
-            field=partition_by,  # day is the only supported type for now
-        )  # name of column to use for partitioning
-        table = bigquery_client.create_table(table)
-        assert table.table_id == table_name  # checks if table_id matches
-
-        # update the table description
-        table.description = table_desc
-        table = bigquery_client.update_table(table, ["description"])
-        assert (
-            table.description == table_desc
-        )  # checks if table description matches the update
-        logger.info(
-            f"Created empty table partitioned \
-              on column: {table.time_partitioning.field}"
-        )
+def forget_infrastructure(resource_path=None):
+    """Forgets verified resources so the next run checks them again.
+
+    Call this after a NotFound error, e.g. when a table was deleted
+    while the instance was warm.
+
+    Args:
+        resource_path: path of one resource to forget, all if None
+
+    """
+    if resource_path is None:
+        _verified_resources.clear()
     else:
-        logger.info(f"Table already exists: {table_ref.path}")
+        _verified_resources.pop(resource_path, None)
+    logger.info(f"Forgot verified infrastructure: {resource_path or 'all'}")
+
+
+@contextmanager
+def infrastructure_guard():
+    """Forgets all verified resources if the wrapped block raises NotFound.
+
+    The error is re-raised, so the retried invocation probes and recreates
+    the missing resources.
+
+    """
+    from google.cloud.exceptions import NotFound
+
+    try:
+        yield
+    except NotFound:
+        forget_infrastructure()
+        raise
+
+
+def ensure_infrastructure(bucket_name, dataset_name, tables):
+    """Creates the bucket, dataset and tables that are not known to exist.
+
+    Resources verified within ``INFRA_TTL_SECONDS`` are skipped. The rest
+    are probed at the same time, and once their dataset exists every table
+    is reconciled with its spec at the same time, so tables are checked for
+    drift once per TTL in a single concurrent pass.
+
+    Args:
+        bucket_name: name of GCS bucket to be created
+        dataset_name: name of dataset to be created
+        tables: list of ``TableSpec``
+
+    """
+    bucket_path = f"gs://{bucket_name}"
+    dataset_path = f"bq://{dataset_name}"
+    table_paths = {
+        table.table_name: f"{dataset_path}.{table.table_name}" for table in tables
+    }
+    pending_tables = [
+        table for table in tables if not _is_verified(table_paths[table.table_name])
+    ]
+    if (
+        _is_verified(bucket_path)
+        and _is_verified(dataset_path)
+        and not pending_tables
+    ):
+        logger.info("Infrastructure verified recently, skipping checks")
+        return
+
+    with ThreadPoolExecutor(max_workers=len(tables) + 1) as executor:
+        if not _is_verified(bucket_path):
+            bucket_future = executor.submit(create_bucket, bucket_name)
+        else:
+            bucket_future = None
+        if not _is_verified(dataset_path):
+            create_dataset(dataset_name)  # tables depend on the dataset
+            _verified_resources[dataset_path] = time.monotonic()
+        table_futures = {
+            table.table_name: executor.submit(reconcile_table, dataset_name, table)
+            for table in pending_tables
+        }
+        if bucket_future is not None:
+            bucket_future.result()
+            _verified_resources[bucket_path] = time.monotonic()
+        for table_name, table_future in table_futures.items():
+            table_future.result()
+            _verified_resources[table_paths[table_name]] = time.monotonic()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Module which collects cost metrics from finished BigQuery jobs.
+
+This module is responsible for:
+-Reading rows, bytes processed, bytes billed, slot-ms and cache hits from
+ load and query job objects the pipeline already holds, plus the bytes
+ their dry run estimated
+-Adding those metrics as attributes on trace spans
+-Summarizing what a run cost across all of its jobs
+
+Job objects carry their statistics once ``result()`` returns, so no extra
+``get_table`` round trip is needed to see how many rows were written.
+
+"""
+
+from lib.helper_functions import set_logger
+
+logger = set_logger(__name__)
+
+# metric name -> job attribute, missing attributes are skipped
+job_metric_attributes = {
+    "job_id": "job_id",
+    "rows_inserted": "output_rows",  # load jobs
+    "bytes_loaded": "output_bytes",  # load jobs
+    "dml_rows_affected": "num_dml_affected_rows",  # query jobs
+    "bytes_processed": "total_bytes_processed",  # query jobs
+    "bytes_estimated": "dry_run_bytes_processed",  # lib.query_runner dry runs
+    "bytes_billed": "total_bytes_billed",  # query jobs
+    "slot_ms": "slot_millis",  # query jobs
+    "cache_hit": "cache_hit",  # query jobs
+}
+
+# metrics added up across jobs in the run summary
+summed_metrics = (
+    "rows_inserted",
+    "bytes_loaded",
+    "dml_rows_affected",
+    "bytes_processed",
+    "bytes_estimated",
+    "bytes_billed",
+    "slot_ms",
+)
+
+
+def job_metrics(job):
+    """Returns the cost metrics of a finished load or query job.
+
+    Load jobs do not expose slot-ms as a property, so it is read from the
+    job statistics. Local loaders return a dict, which is passed through.
+
+    Args:
+        job: google.cloud.bigquery job, or dict of load stats
+
+    Returns:
+        dict object: ``metrics``
+
+    """
+    if isinstance(job, dict):
+        return {
+            "rows_inserted": job.get("output_rows"),
+            "seconds": job.get("seconds"),
+        }
+    metrics = {}
+    for metric_name, attribute in job_metric_attributes.items():
+        value = getattr(job, attribute, None)
+        if value is not None:
+            metrics[metric_name] = value
+    if "slot_ms" not in metrics:
+        statistics = getattr(job, "_properties", {}).get("statistics", {})
+        if "totalSlotMs" in statistics:
+            metrics["slot_ms"] = int(statistics["totalSlotMs"])
+    return metrics
+
+
+def add_span_metrics(span, metrics, prefix=""):
+    """Adds every metric as an attribute on a trace span.
+
+    Args:
+        span: opencensus span
+        metrics: dict of metric name to value
+        prefix: optional prefix for every attribute name
+
+    """
+    for metric_name, value in metrics.items():
+        if value is not None:
+            span.add_attribute(f"{prefix}{metric_name}", value)
+
+
+def record_job(span, job):
+    """Adds a job's cost metrics to its span and returns them.
+
+    Args:
+        span: opencensus span the job ran under
+        job: google.cloud.bigquery job, or dict of load stats
+
+    Returns:
+        dict object: ``metrics``
+
+    """
+    metrics = job_metrics(job)
+    add_span_metrics(span, metrics)
+    logger.info(f"Job metrics: {metrics}")
+    return metrics
+
+
+def summarize_jobs(jobs):
+    """Adds up cost metrics across every job in a run.
+
+    Args:
+        jobs: iterable of google.cloud.bigquery jobs or dicts of load stats
+
+    Returns:
+        dict object: ``run_summary``
+
+    """
+    run_summary = {f"total_{name}": 0 for name in summed_metrics}
+    run_summary["jobs"] = 0
+    run_summary["cache_hits"] = 0
+    for job in jobs:
+        metrics = job_metrics(job)
+        run_summary["jobs"] += 1
+        run_summary["cache_hits"] += int(bool(metrics.get("cache_hit")))
+        for name in summed_metrics:
+            run_summary[f"total_{name}"] += metrics.get(name) or 0
+    logger.info(f"Run summary: {run_summary}")
+    return run_summary
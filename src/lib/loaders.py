@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Module which loads a converted dataframe into a destination table.
+
+This module is responsible for:
+-Loading a dataframe into BigQuery as Parquet through a native load job
+-Loading a dataframe into a local SQLite stand-in for throughput tests
+-Choosing the loader by name, so callers do not depend on the destination
+
+Every loader takes the same arguments and appends the dataframe to the
+table: ``loader(results_df, project_id, dataset_name, table_name, schema)``,
+plus an optional ``job_id`` that makes a retried load find its first job.
+
+"""
+
+# built in python modules
+import hashlib
+import io
+import os
+import sqlite3
+import time
+
+from lib.arrow_ingest import is_arrow_table
+from lib.clients import get_bigquery_client
+from lib.compact_frames import write_parquet
+from lib.helper_functions import lazy_import, set_logger
+
+logger = set_logger(__name__)
+
+# gcp modules, imported on first use to keep cold starts short
+bigquery = lazy_import("google.cloud.bigquery")
+
+LOADER_ENV_VAR = "PIPELINE_LOADER"  # picks the loader without a code change
+SQLITE_PATH_ENV_VAR = "PIPELINE_SQLITE_PATH"  # database file for local loads
+SQLITE_PATH = "/tmp/pipeline.sqlite"
+LOAD_JOB_ATTEMPTS = 5  # failed jobs keep their ids, a retry takes the next one
+
+# BigQuery data types mapped to SQLite column affinities
+bq_to_sqlite_types = {
+    "STRING": "TEXT",
+    "TIMESTAMP": "TEXT",
+    "FLOAT": "REAL",
+    "INTEGER": "INTEGER",
+}
+
+
+def _attempt_job_ids(job_id, buffer):
+    """Yields the load job ids a retry tries in order, suffixed by attempt.
+
+    The ids end in a digest of the Parquet bytes, so a retry loading other
+    rows, e.g. after the api was fetched again, never finds the first job.
+    """
+    digest = hashlib.sha1(buffer.getvalue()).hexdigest()[:16]
+    for attempt in range(LOAD_JOB_ATTEMPTS):
+        yield f"{job_id}_{digest}_{attempt}"
+
+
+def bigquery_loader(
+    results_df, project_id, dataset_name, table_name, schema, job_id=None
+):
+    """Appends a dataframe to a BigQuery table with a Parquet load job.
+
+    The schema is sent explicitly and the index is left out, so the load
+    matches the existing partitioned table instead of being inferred.
+
+    With a ``job_id`` the load is idempotent: a retry that finds the job a
+    crashed run started waits on it instead of appending the rows again.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table with converted schema
+        project_id: name of project where you want to upload data
+        dataset_name: name of target dataset
+        table_name: name of target table
+        schema: list of google.cloud.bigquery.SchemaField
+        job_id: optional id fixed per run, e.g. built from the message id
+
+    Returns:
+        google.cloud.bigquery.job.LoadJob object: ``load_job``
+
+    """
+    from google.api_core.exceptions import Conflict
+
+    bigquery_client = get_bigquery_client()
+    table_ref = bigquery.TableReference.from_string(
+        f"{project_id}.{dataset_name}.{table_name}"
+    )
+    job_config = bigquery.LoadJobConfig()
+    job_config.source_format = bigquery.SourceFormat.PARQUET
+    job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+    job_config.schema = schema
+    buffer = io.BytesIO()
+    write_parquet(results_df, buffer, index=False)
+    job_ids = [None] if job_id is None else _attempt_job_ids(job_id, buffer)
+    for attempt_job_id in job_ids:
+        buffer.seek(0)
+        try:
+            load_job = bigquery_client.load_table_from_file(
+                buffer,
+                table_ref,
+                job_id=attempt_job_id,
+                location="US",
+                job_config=job_config,
+            )
+        except Conflict:  # the job already exists, a crashed run started it
+            load_job = bigquery_client.get_job(attempt_job_id, location="US")
+            if load_job.state == "DONE" and load_job.error_result:
+                continue  # it failed, the rows load under the next id
+            logger.info(f"Resuming load job: {attempt_job_id}")
+        load_job.result()  # waits for the load job to complete
+        logger.info(f"Loaded {load_job.output_rows} rows into: {table_ref.path}")
+        return load_job
+    raise RuntimeError(f"Every load job of {job_id} failed, see the job errors")
+
+
+def sqlite_loader(
+    results_df, project_id, dataset_name, table_name, schema, job_id=None
+):
+    """Appends a dataframe to a local SQLite table standing in for BigQuery.
+
+    The table is named ``<dataset_name>__<table_name>`` and created from the
+    BigQuery schema if it does not exist yet.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table with converted schema
+        project_id: unused, kept so every loader has the same arguments
+        dataset_name: name of target dataset
+        table_name: name of target table
+        schema: list of google.cloud.bigquery.SchemaField
+        job_id: unused, SQLite loads are not retried as jobs
+
+    Returns:
+        dict object: ``load_stats`` with ``output_rows`` and ``seconds``
+
+    """
+    sqlite_path = os.environ.get(SQLITE_PATH_ENV_VAR, SQLITE_PATH)
+    sqlite_table = f"{dataset_name}__{table_name}"
+    columns = ", ".join(
+        f'"{field.name}" {bq_to_sqlite_types[field.field_type]}' for field in schema
+    )
+    if is_arrow_table(results_df):
+        results_df = results_df.to_pandas()  # to_sql needs a dataframe
+    start = time.perf_counter()
+    with sqlite3.connect(sqlite_path) as connection:
+        connection.execute(f'CREATE TABLE IF NOT EXISTS "{sqlite_table}" ({columns})')
+        results_df.to_sql(sqlite_table, connection, if_exists="append", index=False)
+    load_stats = {
+        "output_rows": len(results_df),
+        "seconds": time.perf_counter() - start,
+    }
+    logger.info(f"Loaded {len(results_df)} rows into: {sqlite_path}/{sqlite_table}")
+    return load_stats
+
+
+loaders = {"bigquery": bigquery_loader, "sqlite": sqlite_loader}
+
+
+def get_loader(loader_name=None):
+    """Returns the loader function by name.
+
+    Args:
+        loader_name: key in ``loaders``, defaults to the ``PIPELINE_LOADER``
+            environment variable and then ``bigquery``
+
+    Returns:
+        function object: ``loader``
+
+    """
+    loader_name = loader_name or os.environ.get(LOADER_ENV_VAR, "bigquery")
+    return loaders[loader_name]
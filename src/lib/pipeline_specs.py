@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Module which turns the Pub/Sub message into pipeline specs.
+
+This module is responsible for:
+-Parsing a list of pipeline specs out of the Pub/Sub message
+-Filling every spec's optional fields with defaults derived from its tables
+-Loading the BigQuery schema from the module each spec names
+
+A message is JSON, either a list of specs or an object with a
+``pipelines`` list and an optional ``max_concurrency``::
+
+    {"max_concurrency": 2, "pipelines": [{"resource_id": "8v9j-bter",
+      "schema_module": "lib.schemas", "dataset_name": "chicago_traffic_demo",
+      "table_raw": "traffic_raw", "table_final": "traffic_final"}]}
+
+A spec with ``"shard_count": 4`` fans the run out over four worker
+messages, see ``lib.fan_out``.
+
+A message that is not JSON, e.g. the scheduler's plain text trigger, runs
+the Chicago traffic segments pipeline. Feeds are expected to share its
+``segmentid`` and ``_last_updt`` record keys.
+
+"""
+
+# built in python modules
+import importlib
+import json
+
+from lib.batched_loads import FLUSH_AGE_SECONDS, FLUSH_ROWS
+from lib.data_ingestion import RESOURCE_ID, SOCRATA_DOMAIN, WATERMARK_STATE_PATH
+from lib.helper_functions import set_logger
+from lib.query_runner import QUERY_BYTES_BUDGET
+from lib.record_index import STATE_PREFIX
+
+logger = set_logger(__name__)
+
+MAX_CONCURRENT_PIPELINES = 2  # pipelines running at the same time by default
+SHARD_TOPIC = "demo_topic"  # topic main.handler is deployed on, see README
+REQUIRED_FIELDS = ("resource_id", "dataset_name", "table_raw", "table_final")
+
+# the Chicago traffic segments feed, run when the message carries no specs
+default_spec = {
+    "resource_id": RESOURCE_ID,
+    "dataset_name": "chicago_traffic_demo",  # initial dataset
+    "table_raw": "traffic_raw",  # name of table to capture data
+    "table_staging": "traffic_staging",
+    "table_final": "traffic_final",
+    "table_desc": "Raw, public Chicago traffic data is appended \
+        to this table every 5 minutes",  # table description
+    "blob_prefix": "traffic_",
+    "state_prefix": STATE_PREFIX,
+    "watermark_state_path": WATERMARK_STATE_PATH,
+}
+
+
+def parse_message(pubsub_message):
+    """Returns the pipeline specs and concurrency a Pub/Sub message asks for.
+
+    Args:
+        pubsub_message: decoded message data
+
+    Returns:
+        list object: ``specs``
+        &
+        Integer object: ``max_concurrency``
+
+    """
+    try:
+        message = json.loads(pubsub_message)
+    except ValueError:
+        logger.info("Message carries no pipeline specs, running the default")
+        return [default_spec], MAX_CONCURRENT_PIPELINES
+    if isinstance(message, list):
+        message = {"pipelines": message}
+    if not isinstance(message, dict) or not message.get("pipelines"):
+        raise ValueError(f"Message has no list of pipelines: {pubsub_message}")
+    for spec in message["pipelines"]:
+        missing = [field for field in REQUIRED_FIELDS if field not in spec]
+        if missing:
+            raise ValueError(f"Pipeline spec is missing fields {missing}: {spec}")
+    max_concurrency = int(message.get("max_concurrency", MAX_CONCURRENT_PIPELINES))
+    return message["pipelines"], max(1, max_concurrency)
+
+
+def build_pipeline(spec, project_id, bucket_name):
+    """Fills a spec's optional fields and loads its schema.
+
+    Args:
+        spec: dict with at least ``REQUIRED_FIELDS``
+        project_id: project the tables are created in
+        bucket_name: raw data bucket, unless the spec names its own
+
+    Returns:
+        dict object: ``pipeline`` for ``main.build_stages``
+
+    """
+    table_raw = spec["table_raw"]
+    resource_id = spec["resource_id"]
+    pipeline = {
+        "project_id": project_id,
+        "domain": SOCRATA_DOMAIN,
+        "bucket_name": bucket_name,  # where raw data is stored
+        "schema_module": "lib.schemas",
+        "table_staging": f"{table_raw}_staging",
+        "table_desc": f"Raw, public data from {resource_id} is appended \
+            to this table",
+        "table_staging_desc": f"Unique records greater than or equal to \
+            current date from table: {table_raw}",
+        "table_final_desc": f"Unique, historical records \
+            accumulated from table: {table_raw}",
+        "blob_prefix": f"{table_raw}_",
+        # state objects of every feed live under their own folder
+        "state_prefix": f"{STATE_PREFIX}/{resource_id}",
+        "use_staging": False,  # merge straight from raw, skip staging
+        # share loaded record keys in a Bloom filter, which loses about 0.1%
+        # of new rows for good, see lib.record_index
+        "use_record_bloom": False,
+        # record finished stages per message, so a retry resumes after them
+        "checkpoint_stages": True,
+        # categoricals and downcast numerics in memory, same files and loads
+        "compact_frames": False,
+        # "pandas" converts rows in a dataframe, "arrow" in a pyarrow table
+        "ingest_engine": "pandas",
+        # "sodapy" client, "pooled" keep-alive gzip session reading JSON, or
+        # "csv" on the same session parsing the CSV export with Arrow
+        "socrata_transport": "sodapy",
+        # "direct" appends every run, "batched" stages rows in GCS and loads
+        # them together once flush_rows or flush_age_seconds is reached
+        "load_mode": "direct",
+        "flush_rows": FLUSH_ROWS,
+        "flush_age_seconds": FLUSH_AGE_SECONDS,
+        # delete raw objects once main.compact_handler compacted their day
+        "delete_compacted_sources": False,
+        # above 1 the run coordinates, publishing one segmentid range per
+        # shard to shard_topic, the topic this function is triggered by
+        "shard_count": 1,
+        "shard_topic": SHARD_TOPIC,
+        "shard": None,  # set on the specs a coordinator publishes to workers
+        # most bytes a dry run may estimate for a query, and whether a query
+        # over it is refused or only logged, "refuse" or "warn"
+        "query_bytes_budget": QUERY_BYTES_BUDGET,
+        "query_budget_action": "refuse",
+        # tuple of nulls expected for checking data outliers
+        "nulls_expected": ("_comments",),
+        # partition by the last updated field for faster querying
+        # and incremental loads
+        "partition_by": "_last_updt",
+        # cluster every table's partitions on the segment for queries that
+        # filter or merge on it
+        "cluster_by": ["segmentid"],
+        # raw and staging partitions only feed the merge, so they expire,
+        # final keeps every partition
+        "scratch_partition_expiration_days": 7,
+        # queries must filter on partition_by, so none scans a whole table
+        "require_partition_filter": True,
+    }
+    pipeline.update(spec)
+    pipeline["spec"] = dict(spec)  # as given, a coordinator republishes it
+    pipeline.setdefault(
+        "watermark_state_path", f"{pipeline['state_prefix']}/watermark.json"
+    )
+    pipeline["nulls_expected"] = tuple(pipeline["nulls_expected"])
+    pipeline["schema_bq"] = importlib.import_module(pipeline["schema_module"]).schema_bq
+    return pipeline
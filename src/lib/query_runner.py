@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Module which runs parameterized BigQuery SQL behind a dry-run cost guard.
+
+This module is responsible for:
+-Passing values to SQL as query parameters instead of formatting them in
+-Checking table names before they are formatted into SQL, the only part of
+ a statement that cannot be a parameter
+-Dry-running every statement first for the bytes it would process
+-Refusing, or warning about, statements estimated over a byte budget
+-Keeping the estimate on the job for ``lib.job_metrics``
+
+A dry run is free and returns in about the time of a metadata request, so
+a statement whose partition filter stopped pruning is caught before it
+scans, and bills, a whole table.
+
+"""
+
+# built in python modules
+from datetime import date, datetime
+import re
+
+from lib.clients import get_bigquery_client
+from lib.helper_functions import lazy_import, set_logger
+
+# gcp modules, imported on first use to keep cold starts short
+bigquery = lazy_import("google.cloud.bigquery")
+
+logger = set_logger(__name__)
+
+QUERY_BYTES_BUDGET = 10 * 1024**3  # bytes a statement may process, 10 GiB
+BUDGET_ACTIONS = ("refuse", "warn")  # what happens to a statement over budget
+QUERY_LOCATION = "US"  # must match the datasets queried and written to
+# project ids may hold dashes, dataset and table names only word characters
+identifier_pattern = re.compile(r"[\w-]+")
+# Python types mapped to the BigQuery type of their query parameter, bool
+# before int because bools are ints
+parameter_types = (
+    (bool, "BOOL"),
+    (int, "INT64"),
+    (float, "FLOAT64"),
+    (datetime, "TIMESTAMP"),
+    (date, "DATE"),
+    (str, "STRING"),
+)
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a dry run estimates a statement over its byte budget."""
+
+
+def table_path(project_id, dataset_name, table_name):
+    """Returns the quoted path of a table, after checking every part of it.
+
+    Args:
+        project_id: project of the table
+        dataset_name: dataset of the table
+        table_name: name of the table
+
+    Returns:
+        string object: ``path``, e.g. ```project.dataset.table```
+
+    """
+    for name in (project_id, dataset_name, table_name):
+        if not identifier_pattern.fullmatch(name):
+            raise ValueError(f"Not a BigQuery identifier: {name!r}")
+    return f"`{project_id}.{dataset_name}.{table_name}`"
+
+
+def query_parameters(parameters):
+    """Returns query parameters for a dict of parameter name to Python value.
+
+    Args:
+        parameters: dict of name to bool, int, float, datetime, date or str
+
+    Returns:
+        list object: ``query_parameters`` of ScalarQueryParameter
+
+    """
+    scalar_parameters = []
+    for name, value in parameters.items():
+        for python_type, bq_type in parameter_types:
+            if isinstance(value, python_type):
+                break
+        else:
+            raise TypeError(f"No query parameter type for {name}: {value!r}")
+        scalar_parameters.append(bigquery.ScalarQueryParameter(name, bq_type, value))
+    return scalar_parameters
+
+
+def dry_run_bytes(sql, job_config=None, location=QUERY_LOCATION):
+    """Returns the bytes a statement would process, without running it.
+
+    Args:
+        sql: BigQuery standard SQL
+        job_config: optional QueryJobConfig whose parameters the SQL uses
+        location: location of the datasets the statement reads
+
+    Returns:
+        Integer object: ``estimated_bytes``
+
+    """
+    dry_run_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    if job_config is not None:
+        dry_run_config.query_parameters = job_config.query_parameters
+    dry_run_job = get_bigquery_client().query(
+        sql, location=location, job_config=dry_run_config
+    )
+    return dry_run_job.total_bytes_processed or 0
+
+
+def run_query(
+    sql,
+    parameters=None,
+    job_config=None,
+    location=QUERY_LOCATION,
+    bytes_budget=QUERY_BYTES_BUDGET,
+    budget_action="refuse",
+):
+    """Dry-runs a statement, checks it against the budget and runs it.
+
+    The estimate is kept on the finished job as ``dry_run_bytes_processed``.
+
+    Args:
+        sql: BigQuery standard SQL, values referenced as ``@name``
+        parameters: optional dict of parameter name to Python value
+        job_config: optional QueryJobConfig, e.g. with a destination table
+        location: location of the datasets the statement reads and writes
+        bytes_budget: most bytes the statement may process, None for no limit
+        budget_action: ``refuse`` raises ``QueryBudgetExceeded`` for a
+            statement over budget, ``warn`` logs a warning and runs it
+
+    Returns:
+        google.cloud.bigquery.job.QueryJob object: ``query_job``
+
+    """
+    if budget_action not in BUDGET_ACTIONS:
+        raise ValueError(f"Unknown budget action: {budget_action}")
+    if job_config is None:
+        job_config = bigquery.QueryJobConfig()
+    if parameters:
+        job_config.query_parameters = query_parameters(parameters)
+    estimated_bytes = dry_run_bytes(sql, job_config, location)
+    if bytes_budget is not None and estimated_bytes > bytes_budget:
+        message = (
+            f"Statement would process {estimated_bytes} bytes, over the budget "
+            f"of {bytes_budget}: {' '.join(sql.split())}"
+        )
+        if budget_action == "refuse":
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    query_job = get_bigquery_client().query(
+        sql, location=location, job_config=job_config
+    )  # API request - starts the query
+    query_job.result()  # waits for job to complete
+    query_job.dry_run_bytes_processed = estimated_bytes
+    return query_job
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""Module which drops records already loaded by an earlier run.
+
+This module is responsible for:
+-Building ``(segmentid, _last_updt)`` keys for every record in a dataframe
+-Keeping recently loaded keys in a bounded, time-windowed in-process index
+-Optionally keeping a compact Bloom filter of today's keys in GCS, so cold
+ instances know what warm ones loaded
+-Reporting rows dropped and memory used as metrics
+
+The api refreshes about every 10 minutes and the pipeline runs every 5, so
+about half of every pull was already loaded by the previous run.
+
+Every feed keeps its own index and Bloom filter under its state prefix, so
+feeds loaded by the same instance never drop each other's records.
+
+The Bloom filter trades completeness for memory. About ``BLOOM_ERROR_RATE``
+of genuinely new rows test as seen and are dropped, and the watermark then
+moves past them, so they are never fetched again. The exact in-process
+index never drops a new row.
+
+"""
+
+# built in python modules
+import base64
+from collections import OrderedDict
+from datetime import date
+import hashlib
+import math
+import sys
+import threading
+import time
+
+from lib.arrow_ingest import is_arrow_table
+from lib.helper_functions import lazy_import, set_logger
+from lib.state_store import read_state, write_state
+
+logger = set_logger(__name__)
+
+# arrow modules, imported on first use
+pa = lazy_import("pyarrow")
+pc = lazy_import("pyarrow.compute")
+
+KEY_COLUMNS = ("segmentid", "_last_updt")
+MAX_KEYS = 200000  # least recently seen keys are evicted above this
+WINDOW_SECONDS = 3600  # keys older than this are evicted
+STATE_PREFIX = "state"  # folder of the feed's state objects in the bucket
+BLOOM_STATE_NAME = "record_keys_bloom.json"  # state object under the prefix
+BLOOM_CAPACITY = 300000  # keys per day before the false positive rate rises
+BLOOM_ERROR_RATE = 0.001  # chance a new record is wrongly dropped, for good
+
+_seen_keys = {}  # state prefix -> OrderedDict of key -> time it was last loaded
+_blooms = {}  # state prefix -> today's BloomFilter, loaded from GCS on first use
+_lock = threading.Lock()  # feeds run in parallel threads
+
+
+class BloomFilter:
+    """Fixed size Bloom filter over string keys, serializable to JSON."""
+
+    def __init__(self, capacity, error_rate, day=None, bits=None):
+        self.num_bits = max(
+            8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.day = day or date.today().isoformat()
+        self.bits = bits or bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        """Yields bit positions for a key using double hashing."""
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (first + i * second) % self.num_bits
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    def to_state(self):
+        return {
+            "day": self.day,
+            "bits": base64.b64encode(bytes(self.bits)).decode("ascii"),
+        }
+
+    @classmethod
+    def from_state(cls, state, capacity, error_rate):
+        """Returns the saved filter, or an empty one if it is from another day."""
+        if state.get("day") != date.today().isoformat():
+            return cls(capacity, error_rate)
+        bits = bytearray(base64.b64decode(state["bits"]))
+        bloom = cls(capacity, error_rate, day=state["day"], bits=bits)
+        if len(bits) != len(bloom.bits):  # capacity changed, start over
+            return cls(capacity, error_rate)
+        return bloom
+
+
+def record_keys(results_df):
+    """Returns a string key per row built from ``KEY_COLUMNS``.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table fetched from the api
+
+    Returns:
+        Series object: ``keys``, a list for pyarrow tables
+
+    """
+    if is_arrow_table(results_df):
+        # the same strings as astype(str), nulls included
+        columns = [results_df[column].cast("string") for column in KEY_COLUMNS]
+        return pc.binary_join_element_wise(
+            *columns, "|", null_handling="replace", null_replacement="nan"
+        ).to_pylist()
+    keys = results_df[KEY_COLUMNS[0]].astype(str)
+    for column in KEY_COLUMNS[1:]:
+        keys = keys + "|" + results_df[column].astype(str)
+    return keys
+
+
+def _evict_keys(seen_keys, now):
+    """Evicts keys older than the window, then the oldest above the size cap."""
+    while seen_keys:
+        key, seen_at = next(iter(seen_keys.items()))
+        if now - seen_at < WINDOW_SECONDS and len(seen_keys) <= MAX_KEYS:
+            break
+        seen_keys.popitem(last=False)
+
+
+def _get_bloom(bucket_name, state_prefix):
+    """Returns the feed's Bloom filter for today, loading it from the bucket once."""
+    bloom = _blooms.get(state_prefix)
+    if bloom is None or bloom.day != date.today().isoformat():
+        state = read_state(f"{state_prefix}/{BLOOM_STATE_NAME}", bucket_name)
+        bloom = BloomFilter.from_state(state, BLOOM_CAPACITY, BLOOM_ERROR_RATE)
+        _blooms[state_prefix] = bloom
+    return bloom
+
+
+def index_memory_bytes():
+    """Returns the approximate memory held by the key indexes and Bloom filters."""
+    num_bytes = sys.getsizeof(_seen_keys)
+    for seen_keys in list(_seen_keys.values()):
+        num_bytes += sys.getsizeof(seen_keys) + sum(
+            sys.getsizeof(key) for key in list(seen_keys)
+        )
+    for bloom in list(_blooms.values()):
+        num_bytes += len(bloom.bits)
+    return num_bytes
+
+
+def _seen_rows(keys, seen_keys, bloom):
+    """Flags keys seen before, earlier in the list or in the optional filter."""
+    seen = []
+    batch_keys = set()
+    for key in keys:
+        seen.append(
+            key in batch_keys
+            or key in seen_keys
+            or (bloom is not None and key in bloom)
+        )
+        batch_keys.add(key)
+    return seen
+
+
+def filter_seen_records(
+    results_df, bucket_name=None, use_bloom=False, state_prefix=STATE_PREFIX
+):
+    """Drops rows whose key was loaded recently or repeats within the frame.
+
+    Keys are not remembered here, call ``remember_records`` once the rows
+    are loaded so a failed run does not drop them on retry.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table fetched from the api
+        bucket_name: bucket holding the Bloom filter, local file if None
+        use_bloom: also drop rows found in today's Bloom filter. About
+            ``BLOOM_ERROR_RATE`` of new rows are false positives, which are
+            lost for good because the watermark moves past them
+        state_prefix: the feed's state folder, keeps feeds' keys apart
+
+    Returns:
+        Dataframe object: ``new_records_df``
+        &
+        dict object: ``index_metrics``
+
+    """
+    keys = record_keys(results_df)
+    with _lock:
+        seen_keys = _seen_keys.setdefault(state_prefix, OrderedDict())
+        _evict_keys(seen_keys, time.monotonic())
+        if is_arrow_table(results_df):
+            bloom = _get_bloom(bucket_name, state_prefix) if use_bloom else None
+            seen = pa.array(_seen_rows(keys, seen_keys, bloom), type=pa.bool_())
+        else:
+            seen = keys.isin(seen_keys.keys()) | keys.duplicated()
+            if use_bloom:
+                bloom = _get_bloom(bucket_name, state_prefix)
+                unseen_keys = keys[~seen]
+                seen.loc[unseen_keys.index] = [key in bloom for key in unseen_keys]
+        index_keys = len(seen_keys)
+    if is_arrow_table(results_df):
+        new_records_df = results_df.filter(pc.invert(seen))
+        rows_dropped = pc.sum(seen).as_py() or 0
+    else:
+        new_records_df = results_df[~seen.to_numpy()]
+        rows_dropped = seen.sum()
+    index_metrics = {
+        "rows_fetched": len(results_df),
+        "rows_dropped": int(rows_dropped),
+        "index_keys": index_keys,
+        "index_memory_bytes": index_memory_bytes(),
+    }
+    logger.info(f"Record key index metrics: {index_metrics}")
+    return new_records_df, index_metrics
+
+
+def remember_records(
+    results_df, bucket_name=None, use_bloom=False, state_prefix=STATE_PREFIX
+):
+    """Adds the keys of loaded rows to the index and optional Bloom filter.
+
+    Args:
+        results_df: pandas dataframe or pyarrow table that was loaded
+        bucket_name: bucket holding the Bloom filter, local file if None
+        use_bloom: also add keys to today's Bloom filter and save it
+        state_prefix: the feed's state folder, keeps feeds' keys apart
+
+    """
+    now = time.monotonic()
+    keys = record_keys(results_df)
+    with _lock:
+        seen_keys = _seen_keys.setdefault(state_prefix, OrderedDict())
+        for key in keys:
+            seen_keys[key] = now
+            seen_keys.move_to_end(key)
+        _evict_keys(seen_keys, now)
+        if use_bloom:
+            bloom = _get_bloom(bucket_name, state_prefix)
+            for key in keys:
+                bloom.add(key)
+            bloom_state = bloom.to_state()
+    if use_bloom:
+        write_state(bloom_state, f"{state_prefix}/{BLOOM_STATE_NAME}", bucket_name)
+    logger.info(f"Remembered {len(keys)} record keys")
@@ -2,7 +2,8 @@
 """This contains the bigquery and dataframe schemas for data warehouse setup.
 
 Change these values for your table schemas in scope.
-Data types defined in BigQuery are mapped to pandas dataframe data types.
+Data types defined in BigQuery are mapped to pandas dataframe data types,
+so the dataframe schema is derived from the BigQuery schema.
 If data types do not match, data will not be able to be uploaded to bigquery.
 
 """
@@ -116,20 +117,14 @@ schema_bq = [
     ),
 ]
 
-# apply a schema to pandas dataframe to match BigQuery for equivalent types
-schema_df = {
-    "_comments": "object",
-    "_direction": "object",
-    "_fromst": "object",
-    "_last_updt": "datetime64",
-    "_length": "float64",
-    "_lif_lat": "float64",
-    "_lit_lat": "float64",
-    "_lit_lon": "float64",
-    "_strheading": "object",
-    "_tost": "object",
-    "_traffic": "int64",
-    "segmentid": "int64",
-    "start_lon": "float64",
-    "street": "object",
+# BigQuery data types mapped to equivalent pandas dataframe data types
+bq_to_df_types = {
+    "STRING": "object",
+    "TIMESTAMP": "datetime64[ns]",
+    "FLOAT": "float64",
+    "INTEGER": "int64",
 }
+
+# apply a schema to pandas dataframe to match BigQuery for equivalent types
+# derived from schema_bq so the two schemas can never drift apart
+schema_df = {field.name: bq_to_df_types[field.field_type] for field in schema_bq}
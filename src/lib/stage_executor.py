@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""Module which runs pipeline stages as a dependency graph.
+
+This module is responsible for:
+-Describing a stage by its name, function, declared inputs and outputs
+-Running every stage as soon as its inputs exist, independent stages in
+ parallel on a thread pool
+-Giving every stage its own trace span under a parent span, profiled when
+ switched on through ``lib.tracing``
+-Stopping the pipeline early when a stage has nothing left to do
+-Resuming a retried run from its checkpoint, see ``lib.checkpoints``,
+ skipping stages that finished or that nothing left to run needs
+
+A stage function is called as ``func(span, **inputs)`` and returns a dict
+holding every name in its ``outputs``. A stage with side effects, e.g. a
+load job, carries a ``Checkpoint``: ``save(outputs)`` returns the JSON
+values recorded once it finishes, and ``restore(saved)`` rebuilds its
+outputs from the values every finished stage saved, or returns None if it
+cannot. A stage with only ``restore`` rebuilds outputs that another
+stage's side effect persisted, e.g. rows from the raw file it uploaded.
+
+"""
+
+# built in python modules
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from lib.helper_functions import set_logger
+from lib.tracing import profile_stage
+
+logger = set_logger(__name__)
+
+Stage = namedtuple(
+    "Stage", ["name", "func", "inputs", "outputs", "checkpoint"], defaults=[None]
+)
+Checkpoint = namedtuple("Checkpoint", ["save", "restore"])
+
+
+class StopPipeline(Exception):
+    """Raised by a stage to skip every stage that has not started yet."""
+
+
+def validate_stages(stages, initial_names=()):
+    """Checks that every input is produced exactly once and there is no cycle.
+
+    Args:
+        stages: list of Stage
+        initial_names: names available before any stage runs
+
+    """
+    producers = {name: "initial" for name in initial_names}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers:
+                raise ValueError(f"{output} is produced by more than one stage")
+            producers[output] = stage.name
+    for stage in stages:
+        missing = [name for name in stage.inputs if name not in producers]
+        if missing:
+            raise ValueError(f"Stage {stage.name} needs unknown inputs: {missing}")
+    available = set(initial_names)
+    remaining = list(stages)
+    while remaining:  # peel off runnable stages until none are left
+        runnable = [s for s in remaining if available.issuperset(s.inputs)]
+        if not runnable:
+            names = [stage.name for stage in remaining]
+            raise ValueError(f"Stages form a dependency cycle: {names}")
+        for stage in runnable:
+            available.update(stage.outputs)
+            remaining.remove(stage)
+
+
+def restore_stages(stages, run_checkpoint):
+    """Restores finished stages' outputs and picks the stages left to run.
+
+    A stage runs again if it was not restored and it is a sink, i.e. none
+    of its outputs are another stage's input, or a stage that runs needs
+    one of its outputs. Every other stage is skipped.
+
+    Args:
+        stages: list of Stage
+        run_checkpoint: ``lib.checkpoints.RunCheckpoint`` of the run
+
+    Returns:
+        dict object: ``restored`` outputs
+        &
+        list object: ``stages`` left to run, in the given order
+
+    """
+    saved = run_checkpoint.saved_values()
+    restored = {}
+    restored_names = set()
+    for stage in stages:
+        checkpoint = stage.checkpoint
+        if checkpoint is None or checkpoint.restore is None:
+            continue
+        if checkpoint.save is not None and stage.name not in run_checkpoint.stages:
+            continue  # never finished
+        outputs = checkpoint.restore(saved)
+        if outputs is not None:
+            restored.update(outputs)
+            restored_names.add(stage.name)
+    consumed = {name for stage in stages for name in stage.inputs}
+    to_run = {
+        stage.name
+        for stage in stages
+        if stage.name not in restored_names and consumed.isdisjoint(stage.outputs)
+    }
+    producers = {name: stage for stage in stages for name in stage.outputs}
+    needed = [stage for stage in stages if stage.name in to_run]
+    while needed:  # walk back to the producers of missing inputs
+        stage = needed.pop()
+        for name in stage.inputs:
+            producer = producers.get(name)
+            if name in restored or producer is None or producer.name in to_run:
+                continue
+            to_run.add(producer.name)
+            needed.append(producer)
+    if restored_names:
+        skipped = [stage.name for stage in stages if stage.name not in to_run]
+        logger.info(f"Restored {sorted(restored_names)}, skipping: {skipped}")
+    return restored, [stage for stage in stages if stage.name in to_run]
+
+
+def run_stages(stages, parent_span, initial=None, max_workers=4, checkpoint=None):
+    """Runs stages in dependency order, independent ones at the same time.
+
+    Args:
+        stages: list of Stage
+        parent_span: opencensus span every stage span is created under
+        initial: dict of values available before any stage runs
+        max_workers: maximum number of stages running at the same time
+        checkpoint: optional ``lib.checkpoints.RunCheckpoint`` finished
+            stages are restored from and recorded to
+
+    Returns:
+        dict object: ``results`` of every output produced
+
+    """
+    results = dict(initial or {})
+    validate_stages(stages, results.keys())
+    pending = list(stages)
+    if checkpoint is not None:
+        restored, pending = restore_stages(stages, checkpoint)
+        results.update(restored)
+        parent_span.add_attribute("stages_skipped", len(stages) - len(pending))
+    running = {}
+    stopped = False
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if not stopped:
+                for stage in [s for s in pending if results.keys() >= set(s.inputs)]:
+                    pending.remove(stage)
+                    future = executor.submit(_run_stage, stage, parent_span, results)
+                    running[future] = stage
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    outputs = future.result()
+                except StopPipeline as stop:
+                    logger.info(f"Stage {stage.name} stopped the pipeline: {stop}")
+                    stopped = True
+                    continue
+                except Exception as e:
+                    # let running stages finish, so their results are recorded
+                    logger.error(f"Stage {stage.name} failed: {e}")
+                    stopped = True
+                    error = error or e
+                    continue
+                results.update(outputs)
+                if checkpoint is not None and stage.checkpoint is not None:
+                    if stage.checkpoint.save is not None:
+                        checkpoint.record(stage.name, stage.checkpoint.save(outputs))
+    if error is not None:
+        raise error
+    if stopped:
+        skipped = [stage.name for stage in pending]
+        logger.info(f"Skipped stages: {skipped}")
+    return results
+
+
+def _run_stage(stage, parent_span, results):
+    """Runs one stage in its own span and checks its declared outputs."""
+    inputs = {name: results[name] for name in stage.inputs}
+    with parent_span.span(name=stage.name) as span, profile_stage(span, stage.name):
+        outputs = stage.func(span, **inputs) or {}
+    missing = [name for name in stage.outputs if name not in outputs]
+    if missing:
+        raise ValueError(f"Stage {stage.name} did not return outputs: {missing}")
+    return {name: outputs[name] for name in stage.outputs}
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""Module which persists small pipeline state objects between runs.
+
+This module is responsible for:
+-Reading a JSON state object from a google cloud storage bucket or local file
+-Writing a JSON state object to a google cloud storage bucket or local file
+-Updating a JSON state object in GCS only if nobody wrote it since it was read
+
+State is written to GCS when a bucket name is given. Without one, the state
+path is treated as a local file, which is useful for tests and local runs.
+
+"""
+
+# built in python modules
+import json
+import os
+
+from lib.clients import get_storage_client
+from lib.helper_functions import set_logger
+
+logger = set_logger(__name__)
+
+UPDATE_ATTEMPTS = 10  # concurrent writers an update retries through
+
+
+def read_state(state_path, bucket_name=None):
+    """Reads a JSON state object, returns an empty dict if none exists yet.
+
+    Args:
+        state_path: blob name in the bucket, or local file path
+        bucket_name: optional name of bucket holding the state object
+
+    Returns:
+        dict object: ``state``
+
+    """
+    if bucket_name is None:
+        if not os.path.isfile(state_path):
+            logger.info(f"No state found at: {state_path}")
+            return {}
+        with open(state_path) as state_file:
+            return json.load(state_file)
+
+    storage_client = get_storage_client()
+    blob = storage_client.bucket(bucket_name).blob(state_path)
+    if not blob.exists():
+        logger.info(f"No state found at: gs://{bucket_name}/{state_path}")
+        return {}
+    return json.loads(blob.download_as_bytes())
+
+
+def read_state_generation(state_path, bucket_name):
+    """Reads a JSON state object from GCS along with its generation.
+
+    Args:
+        state_path: blob name in the bucket
+        bucket_name: name of bucket holding the state object
+
+    Returns:
+        dict object: ``state``, empty if none exists yet
+        &
+        int object: ``generation``, 0 if none exists yet
+
+    """
+    blob = get_storage_client().bucket(bucket_name).get_blob(state_path)
+    if blob is None:
+        logger.info(f"No state found at: gs://{bucket_name}/{state_path}")
+        return {}, 0
+    # fails if the object was replaced since its metadata was read
+    payload = blob.download_as_bytes(if_generation_match=blob.generation)
+    return json.loads(payload), blob.generation
+
+
+def write_state(state, state_path, bucket_name=None, if_generation_match=None):
+    """Writes a JSON state object, replacing any previous version.
+
+    Args:
+        state: JSON serializable dict
+        state_path: blob name in the bucket, or local file path
+        bucket_name: optional name of bucket holding the state object
+        if_generation_match: optional GCS generation the object must still
+            have, 0 if it must not exist yet
+
+    Raises:
+        google.api_core.exceptions.PreconditionFailed: the generation changed
+
+    """
+    payload = json.dumps(state, sort_keys=True)
+    if bucket_name is None:
+        state_dir = os.path.dirname(state_path)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        # write then rename so a crash never leaves a half written file
+        temp_path = state_path + ".tmp"
+        with open(temp_path, "w") as state_file:
+            state_file.write(payload)
+        os.replace(temp_path, state_path)
+        logger.info(f"Saved state to: {state_path}")
+        return
+
+    storage_client = get_storage_client()
+    blob = storage_client.bucket(bucket_name).blob(state_path)
+    blob.upload_from_string(
+        payload,
+        content_type="application/json",
+        if_generation_match=if_generation_match,
+    )
+    logger.info(f"Saved state to: gs://{bucket_name}/{state_path}")
+
+
+def update_state(state_path, bucket_name, update):
+    """Applies ``update`` to a GCS state object and writes it back atomically.
+
+    The write only succeeds if the object was not written since it was
+    read, otherwise it is read and updated again, so concurrent runs never
+    drop each other's changes. ``update`` has to be safe to call again.
+
+    Args:
+        state_path: blob name in the bucket
+        bucket_name: name of bucket holding the state object
+        update: function that changes the state dict in place, returning
+            any value the caller needs
+
+    Returns:
+        dict object: ``state`` as written
+        &
+        ``update``'s return value
+
+    """
+    from google.api_core.exceptions import PreconditionFailed
+
+    for _ in range(UPDATE_ATTEMPTS):
+        try:
+            state, generation = read_state_generation(state_path, bucket_name)
+            result = update(state)
+            write_state(
+                state, state_path, bucket_name, if_generation_match=generation
+            )
+            return state, result
+        except PreconditionFailed:
+            logger.info(f"State changed while updating: {state_path}, retrying")
+    raise RuntimeError(
+        f"Gave up updating gs://{bucket_name}/{state_path} "
+        f"after {UPDATE_ATTEMPTS} concurrent writes"
+    )
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""Module which sets up tracing and opt-in profiling of pipeline stages.
+
+This module is responsible for:
+-Building the Stackdriver exporter and sampler once per warm instance
+-Starting a tracer per invocation that shares the exporter and sampler
+-Wrapping stage spans with cProfile and/or tracemalloc when asked to, and
+ storing the top frames and peak memory as span attributes or local files
+
+A tracer carries the trace id and sampling decision of one request, so it
+is cheap and built per invocation. The exporter owns the trace client and
+its background upload thread, which is what is worth reusing.
+
+Profiling is switched on with environment variables, so it can be turned
+on in production without a redeploy:
+-PIPELINE_PROFILE: comma separated modes, ``cprofile`` and/or ``tracemalloc``
+-PIPELINE_PROFILE_STAGES: comma separated stage names, all stages if unset
+-PIPELINE_PROFILE_DIR: directory to also write pstats and memory reports to
+
+"""
+
+# built in python modules
+from contextlib import contextmanager
+import cProfile
+import os
+import pstats
+import threading
+import tracemalloc
+
+from lib.helper_functions import _getToday, lazy_import, set_logger
+
+logger = set_logger(__name__)
+
+# opencensus modules, imported on first use to keep cold starts short
+# https://opencensus.io/exporters/supported-exporters/python/stackdriver/
+tracer_module = lazy_import("opencensus.trace.tracer")
+stackdriver_exporter = lazy_import("opencensus.trace.exporters.stackdriver_exporter")
+background_thread = lazy_import(
+    "opencensus.trace.exporters.transports.background_thread"
+)
+probability = lazy_import("opencensus.trace.samplers.probability")
+
+SAMPLING_RATE_ENV_VAR = "TRACE_SAMPLING_RATE"  # 0.0 to 1.0, defaults to 1.0
+PROFILE_ENV_VAR = "PIPELINE_PROFILE"
+PROFILE_STAGES_ENV_VAR = "PIPELINE_PROFILE_STAGES"
+PROFILE_DIR_ENV_VAR = "PIPELINE_PROFILE_DIR"
+PROFILE_TOP_FRAMES = 10  # frames kept per profile
+
+_exporters = {}  # project id -> exporter, lives as long as the instance
+_tracemalloc_lock = threading.Lock()  # tracemalloc is process wide
+_tracemalloc_users = 0
+
+
+def get_exporter(project_id):
+    """Returns the shared Stackdriver exporter for a project."""
+    if project_id not in _exporters:
+        _exporters[project_id] = stackdriver_exporter.StackdriverExporter(
+            project_id=project_id,
+            transport=background_thread.BackgroundThreadTransport,
+        )
+        logger.info(f"Created Stackdriver exporter for project: {project_id}")
+    return _exporters[project_id]
+
+
+def register_exporter(project_id, exporter):
+    """Replaces the shared exporter for a project, e.g. with an in-memory one.
+
+    Args:
+        project_id: project the traces would be exported to
+        exporter: opencensus exporter object
+
+    """
+    _exporters[project_id] = exporter
+
+
+def get_sampler(rate=None):
+    """Returns a probability sampler, the rate defaults to the environment.
+
+    Args:
+        rate: share of invocations to trace, 0.0 to 1.0
+
+    Returns:
+        opencensus sampler object: ``sampler``
+
+    """
+    if rate is None:
+        rate = float(os.environ.get(SAMPLING_RATE_ENV_VAR, "1.0"))
+    return probability.ProbabilitySampler(rate=rate)
+
+
+def new_tracer(project_id, rate=None):
+    """Returns a tracer for one invocation that reuses the shared exporter.
+
+    Args:
+        project_id: project the traces are exported to
+        rate: optional sampling rate, see ``get_sampler``
+
+    Returns:
+        opencensus tracer object: ``tracer``
+
+    """
+    return tracer_module.Tracer(
+        exporter=get_exporter(project_id), sampler=get_sampler(rate)
+    )
+
+
+def _profile_modes(stage_name):
+    """Returns the profiling modes switched on for a stage."""
+    modes = {
+        mode.strip()
+        for mode in os.environ.get(PROFILE_ENV_VAR, "").split(",")
+        if mode.strip()
+    }
+    stages = os.environ.get(PROFILE_STAGES_ENV_VAR)
+    if stages and stage_name not in {name.strip() for name in stages.split(",")}:
+        return set()
+    return modes
+
+
+def _write_artifact(stage_name, suffix, write):
+    """Writes a profile artifact to the profile directory if one is set."""
+    profile_dir = os.environ.get(PROFILE_DIR_ENV_VAR)
+    if not profile_dir:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f"{stage_name}_{_getToday()}.{suffix}")
+    write(path)
+    logger.info(f"Wrote {stage_name} profile to: {path}")
+
+
+def _write_lines(path, lines):
+    """Writes lines of text to a file."""
+    with open(path, "w") as artifact:
+        artifact.write("\n".join(lines))
+
+
+def _start_tracemalloc():
+    """Starts tracemalloc, shared by every stage being profiled."""
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, "reset_peak"):  # python 3.9+
+            tracemalloc.reset_peak()
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    """Stops tracemalloc once the last profiled stage is done."""
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+@contextmanager
+def profile_stage(span, stage_name):
+    """Profiles the wrapped block if profiling is switched on for the stage.
+
+    cProfile only sees the calling thread, so stages running in parallel do
+    not pollute each other. tracemalloc is process wide, so peak memory of
+    overlapping stages includes their neighbours' allocations.
+
+    Args:
+        span: opencensus span the results are added to
+        stage_name: name used to pick stages and name artifacts
+
+    """
+    modes = _profile_modes(stage_name)
+    if not modes:
+        yield
+        return
+
+    profiler = cProfile.Profile() if "cprofile" in modes else None
+    if "tracemalloc" in modes:
+        _start_tracemalloc()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            stats = pstats.Stats(profiler)
+            top_frames = [
+                f"{pstats.func_std_string(func)} {cumulative:.3f}s"
+                for func, (_, _, _, cumulative, _) in sorted(
+                    stats.stats.items(), key=lambda item: -item[1][3]
+                )[:PROFILE_TOP_FRAMES]
+            ]
+            for rank, frame in enumerate(top_frames, start=1):
+                span.add_attribute(f"profile.top_{rank}", frame)
+            _write_artifact(stage_name, "pstats", stats.dump_stats)
+        if "tracemalloc" in modes:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            _stop_tracemalloc()
+            span.add_attribute("memory.peak_bytes", peak_bytes)
+            top_lines = snapshot.statistics("lineno")[:PROFILE_TOP_FRAMES]
+            for rank, stat in enumerate(top_lines, start=1):
+                span.add_attribute(f"memory.top_{rank}", str(stat))
+            _write_artifact(
+                stage_name,
+                "memory.txt",
+                lambda path: _write_lines(path, [str(stat) for stat in top_lines]),
+            )
+            logger.info(f"Stage {stage_name} peak traced memory: {peak_bytes} bytes")
@@ -5,6 +5,11 @@ API Data Source: https://dev.socrata.com/foundry/data.cityofchicago.org/n4j6-wkk
 
 This Cloud Function is responsible for:
 -Tracing performance of subsets of function calls via spans
+-Running every pipeline spec in the Pub/Sub message, a few at a time
+-Resuming a retried message from the stages its earlier attempt finished
+-Fanning a run out as one message per shard, and running each shard as a
+ worker, the last one to finish running the final merge
+-Compacting a day of small raw objects into a few large ones, once a day
 -Defining and creating infrastructure such as dataset, tables, bucket
 -Ingesting raw data from an api call into google cloud storage
 -Converting a pandas dataframe raw data schema to match BigQuery
@@ -15,136 +20,676 @@ This Cloud Function is responsible for:
 """
 # decoding module for pubsub
 import base64
-
-# opencensus modules to trace function performance
-# https://opencensus.io/exporters/supported-exporters/python/stackdriver/
-import opencensus
-from opencensus.trace import tracer as tracer_module
-from opencensus.trace.exporters import stackdriver_exporter
-from opencensus.trace.exporters.transports.background_thread import (
-    BackgroundThreadTransport,
-)
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+import json
+import re
+import uuid
 
 # lib modules
+from lib.arrow_ingest import cast_table
+from lib.batched_loads import batched_load
 from lib.bq_api_data_functions import (
-    append_unique_records,
-    bq_table_num_rows,
+    current_partition_start,
+    merge_unique_records,
     query_unique_records,
 )
+from lib.checkpoints import RunCheckpoint, checkpoint_path, fetch_job, job_reference
+from lib.clients import client_stats, start_client_stats
+from lib.compaction import compact_day
 from lib.data_ingestion import (
-    check_null_outliers,
-    check_nulls,
-    convert_schema,
+    apply_schema,
+    compile_schema,
     create_results_df,
+    get_data_client,
+    latest_watermark,
+    read_raw_data_gcs,
+    read_watermark,
+    segment_bounds,
+    soql_where,
+    update_watermark,
     upload_raw_data_gcs,
     upload_to_gbq,
+    write_watermark,
+)
+from lib.data_profiler import (
+    build_thresholds,
+    profile_attributes,
+    profile_dataframe,
+    profile_table,
+)
+from lib.fan_out import (
+    claim_final_stage,
+    publish_specs,
+    report_shard,
+    shard_ranges,
+    shard_specs,
 )
 from lib.helper_functions import set_logger
-from lib.infrastructure_setup import create_bucket, create_dataset_table
+from lib.infrastructure_setup import (
+    TableSpec,
+    ensure_infrastructure,
+    infrastructure_guard,
+)
+from lib.job_metrics import add_span_metrics, record_job, summarize_jobs
+from lib.pipeline_specs import build_pipeline, default_spec, parse_message
+from lib.record_index import filter_seen_records, remember_records
+from lib.stage_executor import Checkpoint, Stage, StopPipeline, run_stages
+from lib.tracing import new_tracer
 
 logger = set_logger(__name__)
 
 
+def merge_into_final(pipeline, span, partition_start):
+    """Merges the raw table's new rows into the final table, via staging.
+
+    Args:
+        pipeline (dict): infrastructure variables for one data pipeline.
+        span: opencensus span the query spans are created under
+        partition_start: earliest ``_last_updt`` to merge, None for today
+
+    Returns:
+        list object: ``query_jobs`` that ran
+
+    """
+    project_id = pipeline["project_id"]
+    dataset_name = pipeline["dataset_name"]
+    merge_source = pipeline["table_raw"]
+    query_jobs = []
+    if pipeline["use_staging"]:
+        with span.span(name="query_unique_records") as span_staging:
+            staging_job = query_unique_records(
+                project_id,
+                dataset_name,
+                merge_source,
+                pipeline["table_staging"],
+                bytes_budget=pipeline["query_bytes_budget"],
+                budget_action=pipeline["query_budget_action"],
+            )
+            record_job(span_staging, staging_job)
+            query_jobs.append(staging_job)
+        merge_source = pipeline["table_staging"]
+    with span.span(name="merge_unique_records") as span_merge:
+        merge_job = merge_unique_records(
+            project_id,
+            dataset_name,
+            merge_source,
+            pipeline["table_final"],
+            partition_start=partition_start,
+            bytes_budget=pipeline["query_bytes_budget"],
+            budget_action=pipeline["query_budget_action"],
+        )
+        record_job(span_merge, merge_job)
+        query_jobs.append(merge_job)
+    return query_jobs
+
+
+def build_stages(pipeline, run_id=None):
+    """Describes the data pipeline as stages with declared inputs and outputs.
+
+    Stages that write to GCS or BigQuery carry a checkpoint, so a retried
+    run resumes after them instead of writing their results twice. The
+    load's job id is fixed per run, so a load that finished before its
+    checkpoint was recorded is found again instead of appending twice.
+
+    A pipeline with a ``shard_count`` above one is a coordinator, which
+    only plans the shards and publishes one message per shard. A pipeline
+    with a ``shard`` is a worker, which loads its shard into the raw table
+    and leaves the merge and watermark to ``finish_shard``.
+
+    Args:
+        pipeline (dict): infrastructure variables for one data pipeline.
+        run_id (str): id a coordinator's shards share, and the load's job
+            id is built from
+
+    Returns:
+        list object: ``stages`` for ``lib.stage_executor.run_stages``
+
+    """
+    project_id = pipeline["project_id"]
+    bucket_name = pipeline["bucket_name"]
+    dataset_name = pipeline["dataset_name"]
+    schema_bq = pipeline["schema_bq"]
+    use_record_bloom = pipeline["use_record_bloom"]
+    state_prefix = pipeline["state_prefix"]
+    watermark_state_path = pipeline["watermark_state_path"]
+    use_arrow = pipeline["ingest_engine"] == "arrow"
+    shard = pipeline["shard"]
+    # job ids take letters, digits, underscores and dashes only
+    load_job_id = run_id and re.sub(
+        r"[^\w-]", "_", f"load_{dataset_name}_{pipeline['table_raw']}_{run_id}"
+    )
+
+    def infrastructure_creation(span):
+        # create infrastructure not verified by an earlier warm invocation,
+        # and patch tables whose layout drifted from their spec
+        layout = {
+            "schema": schema_bq,
+            "partition_by": pipeline["partition_by"],
+            "clustering_fields": pipeline["cluster_by"],
+            "require_partition_filter": pipeline["require_partition_filter"],
+        }
+        scratch_expiration = pipeline["scratch_partition_expiration_days"]
+        tables = [
+            TableSpec(
+                pipeline["table_raw"],
+                pipeline["table_desc"],
+                partition_expiration_days=scratch_expiration,
+                **layout,
+            ),
+            TableSpec(
+                pipeline["table_final"], pipeline["table_final_desc"], **layout
+            ),  # a table for unique records final
+        ]
+        if pipeline["use_staging"]:
+            tables.append(
+                TableSpec(
+                    pipeline["table_staging"],
+                    pipeline["table_staging_desc"],
+                    partition_expiration_days=scratch_expiration,
+                    **layout,
+                )
+            )  # a table for unique records staging
+        ensure_infrastructure(bucket_name, dataset_name, tables)
+        return {"infrastructure": True}
+
+    def read_watermark_stage(span):
+        # only rows updated since the last successful run are fetched
+        if shard is not None:  # read once by the coordinator for every shard
+            return {"watermark": shard["watermark"]}
+        watermark = read_watermark(watermark_state_path, bucket_name=bucket_name)
+        return {"watermark": watermark}
+
+    def plan_shards(span, watermark):
+        # split the rows updated since the watermark into segmentid ranges
+        data_client, _ = get_data_client(
+            pipeline["socrata_transport"], pipeline["domain"]
+        )
+        bounds = segment_bounds(
+            data_client, pipeline["resource_id"], **soql_where(watermark)
+        )
+        if bounds is None:
+            raise StopPipeline("No rows updated since the last run, nothing to shard")
+        ranges = shard_ranges(*bounds, pipeline["shard_count"])
+        span.add_attribute("shards", len(ranges))
+        worker_specs = shard_specs(pipeline["spec"], run_id, ranges, watermark)
+        return {"worker_specs": worker_specs}
+
+    def publish_shards(span, worker_specs, infrastructure):
+        # publish once the infrastructure every worker loads into exists
+        message_ids = publish_specs(project_id, pipeline["shard_topic"], worker_specs)
+        return {"shards_published": len(message_ids)}
+
+    def create_dataframe(span, watermark):
+        # access data from API and create dataframe
+        data_client, data_format = get_data_client(
+            pipeline["socrata_transport"], pipeline["domain"]
+        )
+        api_df = create_results_df(
+            data_client=data_client,
+            watermark=watermark,
+            resource_id=pipeline["resource_id"],
+            compact=pipeline["compact_frames"],
+            engine=pipeline["ingest_engine"],
+            data_format=data_format,
+            schema_bq=schema_bq,
+            segment_range=shard and shard["segment_range"],
+        )
+        return {"api_df": api_df}
+
+    def filter_seen_records_stage(span, api_df):
+        # drop records an earlier run already loaded
+        if len(api_df) == 0:  # nothing updated since the watermark, no columns
+            raise StopPipeline("No rows updated since the last run, nothing to load")
+        results_df, index_metrics = filter_seen_records(
+            api_df,
+            bucket_name=bucket_name,
+            use_bloom=use_record_bloom,
+            state_prefix=state_prefix,
+        )
+        for metric_name, metric_value in index_metrics.items():
+            span.add_attribute(metric_name, metric_value)
+        if len(results_df) == 0:
+            raise StopPipeline("No new records since the last run, nothing to load")
+        return {"results_df": results_df}
+
+    def upload_raw_data_gcs_stage(span, results_df, infrastructure):
+        blob_name = upload_raw_data_gcs(
+            results_df,
+            bucket_name,
+            blob_prefix=pipeline["blob_prefix"],
+            blob_suffix=f"_shard{shard['index']}" if shard is not None else "",
+        )
+        return {"blob_name": blob_name}
+
+    def convert_schema(span, results_df):
+        # perform schema conversion on dataframe to match bigquery schema
+        if use_arrow:
+            results_df_transformed, cast_failures = cast_table(results_df, schema_bq)
+            logger.debug(f"Converted schema: {results_df_transformed.schema}")
+        else:
+            results_df_transformed, cast_failures = apply_schema(
+                results_df,
+                compile_schema(schema_bq),
+                compact=pipeline["compact_frames"],
+            )
+            logger.debug(f"Converted dtypes: {results_df_transformed.dtypes}")
+        return {"results_df_transformed": results_df_transformed}
+
+    def audit_null_columns(span, results_df_transformed):
+        # profile every column in one pass and print threshold exceptions
+        profile_rows = profile_table if use_arrow else profile_dataframe
+        profile, violations = profile_rows(
+            results_df_transformed,
+            build_thresholds(
+                [field.name for field in schema_bq], pipeline["nulls_expected"]
+            ),
+        )
+        for attribute_name, attribute_value in profile_attributes(profile).items():
+            span.add_attribute(attribute_name, attribute_value)
+        span.add_attribute("violations", ",".join(violations))
+        return {"violations": violations}
+
+    def upload_to_gbq_stage(span, results_df_transformed, infrastructure):
+        if pipeline["load_mode"] == "batched":
+            # stage rows in GCS, load them with other runs' rows when due
+            load_job, batch_metrics = batched_load(
+                results_df_transformed,
+                project_id,
+                dataset_name,
+                pipeline["table_raw"],
+                schema_bq,
+                bucket_name,
+                pipeline["state_prefix"],
+                pipeline["blob_prefix"],
+                flush_rows=pipeline["flush_rows"],
+                flush_age_seconds=pipeline["flush_age_seconds"],
+            )
+            add_span_metrics(span, batch_metrics)
+            partition_start = None
+            if load_job is not None:
+                record_job(span, load_job)
+                partition_start = current_partition_start(
+                    datetime.fromtimestamp(batch_metrics["flushed_since"], timezone.utc)
+                )
+            return {"load_job": load_job, "partition_start": partition_start}
+        # upload data to bigquery
+        load_job = upload_to_gbq(
+            results_df_transformed,
+            project_id,
+            dataset_name,
+            pipeline["table_raw"],
+            schema_bq,
+            job_id=load_job_id,
+        )
+        record_job(span, load_job)  # rows inserted without a get_table call
+        return {"load_job": load_job, "partition_start": None}
+
+    def preprocess_data(span, load_job, partition_start):
+        # Preprocess data for unique records accumulation
+        if load_job is None:  # rows are staged, nothing new in the raw table
+            return {"query_jobs": []}
+        return {"query_jobs": merge_into_final(pipeline, span, partition_start)}
+
+    def update_watermark_stage(
+        span, results_df, results_df_transformed, blob_name, query_jobs
+    ):
+        # advance the watermark only after the rows are fully loaded
+        update_watermark(
+            results_df_transformed, watermark_state_path, bucket_name=bucket_name
+        )
+        remember_records(
+            results_df,
+            bucket_name=bucket_name,
+            use_bloom=use_record_bloom,
+            state_prefix=state_prefix,
+        )
+        return {}
+
+    def restore_results_df(saved):
+        # the raw file holds exactly the rows the first attempt loaded
+        if "blob_name" not in saved:
+            return None
+        results_df = read_raw_data_gcs(
+            bucket_name, saved["blob_name"], engine=pipeline["ingest_engine"]
+        )
+        return {"results_df": results_df}
+
+    def save_load_job(outputs):
+        partition_start = outputs["partition_start"]
+        return {
+            "load_job": job_reference(outputs["load_job"]),
+            "partition_start": partition_start and partition_start.isoformat(),
+        }
+
+    def restore_with_raw_file(restore):
+        # loaded rows are only known if the raw file holds them, rows fetched
+        # again may differ, so the load and merge run again for those
+        return lambda saved: restore(saved) if "blob_name" in saved else None
+
+    def restore_load_job(saved):
+        partition_start = saved["partition_start"]
+        return {
+            "load_job": fetch_job(saved["load_job"]),
+            "partition_start": partition_start
+            and datetime.fromisoformat(partition_start),
+        }
+
+    first_stages = [
+        Stage(
+            "infrastructure_creation", infrastructure_creation, [], ["infrastructure"]
+        ),
+        Stage("read_watermark", read_watermark_stage, [], ["watermark"]),
+    ]
+    if shard is None and pipeline["shard_count"] > 1:
+        return first_stages + [
+            Stage("plan_shards", plan_shards, ["watermark"], ["worker_specs"]),
+            Stage(
+                "publish_shards",
+                publish_shards,
+                ["worker_specs", "infrastructure"],
+                ["shards_published"],
+                Checkpoint(
+                    lambda outputs: outputs,
+                    lambda saved: {"shards_published": saved["shards_published"]},
+                ),
+            ),
+        ]
+    load_stages = [
+        Stage("create_dataframe", create_dataframe, ["watermark"], ["api_df"]),
+        Stage(
+            "filter_seen_records",
+            filter_seen_records_stage,
+            ["api_df"],
+            ["results_df"],
+            Checkpoint(None, restore_results_df),
+        ),
+        Stage(
+            "upload_raw_data_gcs",
+            upload_raw_data_gcs_stage,
+            ["results_df", "infrastructure"],
+            ["blob_name"],
+            Checkpoint(
+                lambda outputs: {"blob_name": outputs["blob_name"]},
+                lambda saved: {"blob_name": saved["blob_name"]},
+            ),
+        ),
+        Stage(
+            "convert_schema",
+            convert_schema,
+            ["results_df"],
+            ["results_df_transformed"],
+        ),
+        Stage(
+            "audit_null_columns",
+            audit_null_columns,
+            ["results_df_transformed"],
+            ["violations"],
+            # restore only this stage's outputs, saved holds every stage's values
+            Checkpoint(
+                lambda outputs: outputs,
+                lambda saved: {"violations": saved["violations"]},
+            ),
+        ),
+        Stage(
+            "upload_to_gbq",
+            upload_to_gbq_stage,
+            ["results_df_transformed", "infrastructure"],
+            ["load_job", "partition_start"],
+            Checkpoint(save_load_job, restore_with_raw_file(restore_load_job)),
+        ),
+    ]
+    if shard is not None:  # the final stage runs once every shard is loaded
+        return first_stages + load_stages
+    final_stages = [
+        Stage(
+            "preprocess_data",
+            preprocess_data,
+            ["load_job", "partition_start"],
+            ["query_jobs"],
+            Checkpoint(
+                lambda outputs: {
+                    "query_jobs": [job_reference(job) for job in outputs["query_jobs"]]
+                },
+                restore_with_raw_file(
+                    lambda saved: {
+                        "query_jobs": [fetch_job(job) for job in saved["query_jobs"]]
+                    }
+                ),
+            ),
+        ),
+        Stage(
+            "update_watermark",
+            update_watermark_stage,
+            ["results_df", "results_df_transformed", "blob_name", "query_jobs"],
+            [],
+            Checkpoint(lambda outputs: {}, lambda saved: {}),
+        ),
+    ]
+    return first_stages + load_stages + final_stages
+
+
+def finish_shard(pipeline, results, parent_span, claimant):
+    """Reports a worker's shard, and runs the final stage after the last one.
+
+    The last worker to report merges every shard's rows from the raw table
+    into the final table in one statement, and advances the watermark to
+    the latest row of any shard. A shard with nothing new reports too, so
+    the final stage never waits on it.
+
+    Args:
+        pipeline (dict): infrastructure variables of a worker's pipeline.
+        results (dict): outputs of the worker's stages
+        parent_span: opencensus span the shard spans are created under
+        claimant: id of the worker's message
+
+    Returns:
+        list object: ``query_jobs`` of the final stage, empty for other workers
+
+    """
+    shard = pipeline["shard"]
+    bucket_name = pipeline["bucket_name"]
+    state_prefix = pipeline["state_prefix"]
+    load_job = results.get("load_job")
+    partition_start = results.get("partition_start")
+    with parent_span.span(name="report_shard") as span:
+        span.add_attribute("shard", shard["index"])
+        # a resumed worker restores results_df from its raw file, not the
+        # converted rows, so the report is built from the fetched ones
+        results_df = results.get("results_df")
+        report = {
+            "rows": 0 if results_df is None else len(results_df),
+            "watermark": None if results_df is None else latest_watermark(results_df),
+            "loaded": load_job is not None,
+            "partition_start": partition_start and partition_start.isoformat(),
+        }
+        reports = report_shard(bucket_name, state_prefix, shard, report)
+        if load_job is not None:
+            remember_records(
+                results_df,
+                bucket_name=bucket_name,
+                use_bloom=pipeline["use_record_bloom"],
+                state_prefix=state_prefix,
+            )
+    if reports is None or not claim_final_stage(
+        bucket_name, state_prefix, shard["run_id"], claimant
+    ):
+        return []
+
+    with parent_span.span(name="final_stage") as span:
+        span.add_attribute("shard_rows", sum(report["rows"] for report in reports))
+        query_jobs = []
+        loaded = [report for report in reports if report["loaded"]]
+        if loaded:
+            # a direct load fills today's partition, a batched flush may be older
+            partition_start = min(
+                (
+                    datetime.fromisoformat(report["partition_start"])
+                    if report["partition_start"]
+                    else current_partition_start()
+                )
+                for report in loaded
+            )
+            query_jobs = merge_into_final(pipeline, span, partition_start)
+        watermarks = [report["watermark"] for report in reports if report["watermark"]]
+        if watermarks:
+            write_watermark(
+                max(watermarks), pipeline["watermark_state_path"], bucket_name
+            )
+    return query_jobs
+
+
+def run_pipeline(pipeline, parent_span, message_id=None):
+    """Runs one pipeline's stages in its own span and returns its jobs.
+
+    Args:
+        pipeline (dict): infrastructure variables for one data pipeline.
+        parent_span: opencensus span the pipeline span is created under
+        message_id: Pub/Sub message id, the run is checkpointed under it
+
+    Returns:
+        list object: ``jobs`` the pipeline ran
+
+    """
+    with parent_span.span(name=f"pipeline_{pipeline['resource_id']}") as span:
+        span.add_attribute("resource_id", pipeline["resource_id"])
+        span.add_attribute("table_final", pipeline["table_final"])
+        checkpoint = None
+        if message_id is not None and pipeline["checkpoint_stages"]:
+            checkpoint = RunCheckpoint(
+                checkpoint_path(pipeline["state_prefix"], message_id),
+                bucket_name=pipeline["bucket_name"],
+            )
+        # a coordinator's shards share its id, a worker claims the final
+        # stage with it, so a retry of the message keeps the same id
+        run_id = message_id or uuid.uuid4().hex
+        # independent stages, e.g. the raw GCS upload and the schema
+        # conversion, run at the same time so latency follows the critical path
+        results = run_stages(
+            build_stages(pipeline, run_id=run_id),
+            span,
+            checkpoint=checkpoint,
+        )
+
+        # summarize what the pipeline cost from the jobs it already holds
+        jobs = list(results.get("query_jobs", []))
+        if results.get("load_job") is not None:
+            jobs.insert(0, results["load_job"])
+        if pipeline["shard"] is not None:
+            jobs.extend(finish_shard(pipeline, results, span, run_id))
+        add_span_metrics(span, summarize_jobs(jobs))
+    return jobs
+
+
 # explains why to use pubsub as middleware
 # https://cloud.google.com/scheduler/docs/start-and-stop-compute-engine-instances-on-a-schedule
 def handler(event, context):
     """Entry point function that orchestrates the data pipeline from start to finish.
 
-    Triggered from a message on a Cloud Pub/Sub topic.
+    Triggered from a message on a Cloud Pub/Sub topic. The message may carry
+    a list of pipeline specs, see ``lib.pipeline_specs``. They run in one
+    invocation, a few at a time, sharing clients and warm caches. A retry of
+    the same message resumes every pipeline from its checkpoint.
 
     Args:
         event (dict): Event payload.
         context (google.cloud.functions.Context): Metadata for the event.
 
     """
-    # instantiate trace exporter
     project_id = (
         "iconic-range-220603"
     )  # capture the project id to where this data will land
-    exporter = stackdriver_exporter.StackdriverExporter(
-        project_id=project_id, transport=BackgroundThreadTransport
-    )
-    # instantiate tracer
-    tracer = tracer_module.Tracer(exporter=exporter)
+    # per invocation tracer, the exporter is shared by the warm instance
+    tracer = new_tracer(project_id)
 
-    with tracer.span(name="get_kpis") as span_get_kpis:
-        # prints a message from the pubsub trigger
+    start_client_stats()  # count clients and connections created by this run
+    # Pub/Sub keeps the event id across retries and redeliveries of a message
+    message_id = getattr(context, "event_id", None)
+    # forget cached infrastructure if a resource disappeared mid-run
+    with tracer.span(name="get_kpis") as span_get_kpis, infrastructure_guard():
+        # the message from the pubsub trigger configures the pipelines
         pubsub_message = base64.b64decode(event["data"]).decode("utf-8")
-        print(pubsub_message)  # can be used to configure dynamic pipeline
+        logger.info(f"Pub/Sub message: {pubsub_message}")
 
         with span_get_kpis.span(name="infrastructure_var_setup"):
             # define infrastructure variables
-            bucket_name = (
-                "chicago_traffic_raw"
-            )  # capture bucket name where raw data will be stored
-            dataset_name = "chicago_traffic_demo"  # initial dataset
-            table_raw = "traffic_raw"  # name of table to capture data
-            table_desc = "Raw, public Chicago traffic data is appended \
-                to this table every 5 minutes"  # table description
-            table_staging = "traffic_staging"
-            table_staging_desc = f"Unique records greater than or equal to \
-                current date from table: {table_raw}"
-            table_final = "traffic_final"
-            table_final_desc = f"Unique, historical records \
-                accumulated from table: {table_raw}"
-            nulls_expected = (
-                "_comments"
-            )  # tuple of nulls expected for checking data outliers
-            partition_by = (
-                "_last_updt"
-            )  # partition by the last updated field for faster querying
-            # and incremental loads
-            from lib.schemas import schema_bq, schema_df  # import schemas
-
-        with span_get_kpis.span(name="infrastructure_creation") as span_infra_create:
-            # create infrastructure
-            with span_infra_create.span(name="bucket_creation"):
-                create_bucket(bucket_name)
-            with span_infra_create.span(name="dataset_table_creation"):
-                create_dataset_table(
-                    dataset_name, table_raw, table_desc, schema_bq, partition_by
-                )  # create raw table
-                create_dataset_table(
-                    dataset_name,
-                    table_staging,
-                    table_staging_desc,
-                    schema_bq,
-                    partition_by,
-                )  # create a table for unique records staging
-                create_dataset_table(
-                    dataset_name, table_final, table_final_desc, schema_bq, partition_by
-                )  # create a table for unique records final
-
-        with span_get_kpis.span(name="ingest_raw_data") as span_ingest_raw:
-            with span_ingest_raw.span(name="create_dataframe"):
-                # access data from API, create dataframe, and upload raw csv
-                results_df = create_results_df()
-            with span_ingest_raw.span(name="upload_raw_data_gcs"):
-                upload_raw_data_gcs(results_df, bucket_name)
-
-        with span_get_kpis.span(name="convert_schema"):
-            # perform schema conversion on dataframe to match bigquery schema
-            results_df_transformed = convert_schema(results_df, schema_df)
-            print(results_df_transformed.dtypes)
-
-        with span_get_kpis.span(name="audit_null_columns"):
-            # check if there are any nulls in the columns and print exceptions
-            null_columns = check_nulls(results_df_transformed)
-            null_outliers = check_null_outliers(null_columns, nulls_expected)
-
-        with span_get_kpis.span(name="upload_to_gbq"):
-            # upload data to bigquery
-            upload_to_gbq(results_df_transformed, project_id, dataset_name, table_raw)
-            bq_table_num_rows(dataset_name, table_raw)
-
-        with span_get_kpis.span(name="preprocess_data") as span_prep_data:
-            # Preprocess data for unique records accumulation
-            with span_prep_data.span(name="query_unique_records"):
-                query_unique_records(project_id, dataset_name, table_raw, table_staging)
-                bq_table_num_rows(dataset_name, table_staging)
-            with span_prep_data.span(name="append_unique_records"):
-                append_unique_records(
-                    project_id, dataset_name, table_staging, table_final
-                )
-                bq_table_num_rows(dataset_name, table_final)
+            specs, max_concurrency = parse_message(pubsub_message)
+            pipelines = [
+                build_pipeline(spec, project_id, "chicago_traffic_raw")
+                for spec in specs
+            ]
+        span_get_kpis.add_attribute("pipelines", len(pipelines))
+
+        # every pipeline runs even if another fails, the first error is
+        # raised afterwards so Pub/Sub retries the invocation
+        jobs = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [
+                executor.submit(run_pipeline, pipeline, span_get_kpis, message_id)
+                for pipeline in pipelines
+            ]
+            for pipeline, future in zip(pipelines, futures):
+                try:
+                    jobs.extend(future.result())
+                except Exception as e:
+                    logger.error(f"Pipeline {pipeline['resource_id']} failed: {e}")
+                    errors.append(e)
+
+        # summarize what the run cost across every pipeline
+        add_span_metrics(span_get_kpis, summarize_jobs(jobs))
+
+        for stat_name, stat_value in client_stats().items():
+            span_get_kpis.add_attribute(stat_name, stat_value)
+        if errors:
+            raise errors[0]
         logger.info("Data Pipeline Fully Realized!")
+
+
+def compact_handler(event, context):
+    """Entry point function that compacts a day of raw objects per pipeline.
+
+    Triggered once a day from a message on a Cloud Pub/Sub topic. The message
+    carries pipeline specs the same way as for ``handler``, plus an optional
+    ``day`` in YYYY-MM-DD format. Yesterday is compacted by default.
+
+    Args:
+        event (dict): Event payload.
+        context (google.cloud.functions.Context): Metadata for the event.
+
+    """
+    project_id = "iconic-range-220603"
+    tracer = new_tracer(project_id)
+
+    with tracer.span(name="compact_raw_objects") as span_compact:
+        pubsub_message = base64.b64decode(event["data"]).decode("utf-8")
+        logger.info(f"Pub/Sub message: {pubsub_message}")
+        try:
+            message = json.loads(pubsub_message)
+        except ValueError:
+            message = None
+        if isinstance(message, dict) and "pipelines" not in message:
+            specs = [default_spec]  # only a day to compact, e.g. a backfill
+        else:
+            specs, _ = parse_message(pubsub_message)
+        day = datetime.now(timezone.utc).date() - timedelta(days=1)
+        if isinstance(message, dict) and "day" in message:
+            day = date.fromisoformat(message["day"])
+        span_compact.add_attribute("day", day.isoformat())
+
+        # one day at a time, a day of every feed would not fit in memory
+        for spec in specs:
+            pipeline = build_pipeline(spec, project_id, "chicago_traffic_raw")
+            with span_compact.span(name=f"compact_{pipeline['resource_id']}") as span:
+                manifest = compact_day(
+                    pipeline["bucket_name"],
+                    pipeline["blob_prefix"],
+                    day,
+                    delete_sources=pipeline["delete_compacted_sources"],
+                    schema_bq=pipeline["schema_bq"],
+                )
+                if manifest is not None:
+                    span.add_attribute("rows", manifest["rows"])
+                    span.add_attribute("sources", len(manifest["sources"]))
+                    span.add_attribute("parts", len(manifest["parts"]))
+        logger.info(f"Compacted raw objects for {day}")
@@ -0,0 +1,9 @@
+"""Puts the function source and the local service stand-ins on the path."""
+
+# built in python modules
+import os
+import sys
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(tests_dir, "..", "src"))
+sys.path.insert(0, os.path.join(tests_dir, "..", "benchmarks"))
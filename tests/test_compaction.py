@@ -0,0 +1,79 @@
+"""Tests of compacting a day of raw objects written by both ingest paths."""
+
+# built in python modules
+from datetime import date, datetime, timedelta
+import io
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from lib import clients
+from lib.arrow_ingest import cast_table, records_to_table
+from lib.compaction import compact_day
+from lib.schemas import schema_bq
+from local_services import FilesystemStorageClient
+from synthetic_data import make_traffic_records
+
+BUCKET_NAME = "chicago_traffic_raw"
+BLOB_PREFIX = "traffic_"
+DAY = date(2019, 4, 2)
+NUM_ROWS = 200
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    storage_client = FilesystemStorageClient(str(tmp_path))
+    monkeypatch.setitem(clients._clients, "storage", storage_client)
+    bucket = storage_client.bucket(BUCKET_NAME)
+    bucket.create()
+    return bucket
+
+
+def upload_raw_object(bucket, run_time, write):
+    buffer = io.BytesIO()
+    write(buffer)
+    buffer.seek(0)
+    name = f"{BLOB_PREFIX}{run_time.strftime('%Y%m%d%H%M%S')}.gzip"
+    bucket.blob(name).upload_from_file(buffer)
+
+
+def test_compact_day_casts_json_and_csv_objects_to_the_schema(bucket):
+    json_time = datetime(2019, 4, 2, 15, 0)
+    csv_time = json_time + timedelta(minutes=5)
+    json_records = make_traffic_records(NUM_ROWS, seed=0, start=json_time)
+    csv_records = make_traffic_records(NUM_ROWS, seed=1, start=csv_time)
+    # the JSON path writes every column as a string
+    upload_raw_object(
+        bucket,
+        json_time,
+        lambda buffer: pd.DataFrame.from_records(json_records).to_parquet(
+            buffer, engine="pyarrow", compression="gzip"
+        ),
+    )
+    # the CSV path writes a table already cast to the schema
+    upload_raw_object(
+        bucket,
+        csv_time,
+        lambda buffer: pq.write_table(
+            cast_table(records_to_table(csv_records), schema_bq)[0],
+            buffer,
+            compression="gzip",
+        ),
+    )
+
+    manifest = compact_day(BUCKET_NAME, BLOB_PREFIX, DAY, schema_bq=schema_bq)
+
+    assert manifest["rows"] == 2 * NUM_ROWS
+    compacted_df = pd.concat(
+        [
+            pd.read_parquet(io.BytesIO(bucket.blob(part["name"]).download_as_bytes()))
+            for part in manifest["parts"]
+        ],
+        ignore_index=True,
+    )
+    assert len(compacted_df) == 2 * NUM_ROWS
+    assert pd.api.types.is_integer_dtype(compacted_df["segmentid"])
+    assert pd.api.types.is_datetime64_any_dtype(compacted_df["_last_updt"])
+    assert pd.api.types.is_integer_dtype(compacted_df["_traffic"])
+    assert compacted_df["segmentid"].is_monotonic_increasing
@@ -0,0 +1,102 @@
+"""Tests of the paged Socrata fetch against the local Socrata stand-in."""
+
+# built in python modules
+from collections import Counter
+import threading
+
+import pandas as pd
+import pytest
+
+from lib.data_ingestion import (
+    SOCRATA_DOMAIN,
+    SOCRATA_URL_ENV_VAR,
+    _build_socrata_client,
+    create_results_df,
+    fetch_all_pages,
+    latest_watermark,
+)
+from local_services import serve_socrata
+from synthetic_data import make_traffic_records
+
+RESOURCE_ID = "8v9j-bter"
+NUM_ROWS = 2500  # more than the 2,000 rows an unpaged request returned
+
+
+class FlakyClient:
+    """Wraps a Socrata client so the first request of one page fails."""
+
+    def __init__(self, data_client, fail_offset):
+        self.data_client = data_client
+        self.fail_offset = fail_offset
+        self.calls = Counter()  # requests per $offset, None for the count
+        self.lock = threading.Lock()
+
+    def get(self, resource_id, **kwargs):
+        offset = kwargs.get("offset")
+        with self.lock:
+            self.calls[offset] += 1
+            first_call = self.calls[offset] == 1
+        if offset == self.fail_offset and first_call:
+            raise ConnectionError(f"Injected failure of the page at {offset}")
+        return self.data_client.get(resource_id, **kwargs)
+
+
+@pytest.fixture(scope="module")
+def records():
+    return make_traffic_records(NUM_ROWS)
+
+
+@pytest.fixture(scope="module")
+def socrata_url(records):
+    server = serve_socrata(records)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture
+def data_client(socrata_url, monkeypatch):
+    monkeypatch.setenv(SOCRATA_URL_ENV_VAR, socrata_url)
+    return _build_socrata_client(SOCRATA_DOMAIN)
+
+
+def test_fetch_all_pages_keeps_offset_order(data_client, records):
+    results = fetch_all_pages(data_client, RESOURCE_ID, page_size=300, max_workers=4)
+
+    assert [record["segmentid"] for record in results] == [
+        record["segmentid"] for record in records
+    ]
+
+
+def test_failed_page_is_retried_on_its_own(data_client, records):
+    flaky_client = FlakyClient(data_client, fail_offset=1000)
+
+    results = fetch_all_pages(flaky_client, RESOURCE_ID, page_size=500, max_workers=4)
+
+    assert results == records
+    assert flaky_client.calls == {None: 1, 0: 1, 500: 1, 1000: 2, 1500: 1, 2000: 1}
+
+
+def test_create_results_df_fetches_every_page(data_client, records):
+    results_df = create_results_df(data_client, page_size=1000, max_workers=2)
+
+    assert len(results_df) == NUM_ROWS > 2000
+    assert results_df["segmentid"].tolist() == [
+        record["segmentid"] for record in records
+    ]
+
+
+def test_watermark_selects_rows_updated_after_it(data_client, records):
+    # the feed's values are text, so the watermark has to compare as text
+    watermark = latest_watermark(
+        create_results_df(data_client, page_size=1000).iloc[: NUM_ROWS // 2]
+    )
+
+    results_df = create_results_df(data_client, page_size=1000, watermark=watermark)
+
+    expected = [
+        record["segmentid"]
+        for record in records
+        if pd.Timestamp(record["_last_updt"]) > pd.Timestamp(watermark)
+    ]
+    assert 0 < len(expected) < NUM_ROWS
+    assert results_df["segmentid"].tolist() == expected
@@ -0,0 +1,74 @@
+"""Tests of the SQLite loader standing in for BigQuery load jobs."""
+
+# built in python modules
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from lib.arrow_ingest import cast_table, records_to_table
+from lib.data_ingestion import apply_schema, compile_schema, upload_to_gbq
+from lib.loaders import (
+    LOADER_ENV_VAR,
+    SQLITE_PATH_ENV_VAR,
+    bigquery_loader,
+    get_loader,
+    sqlite_loader,
+)
+from lib.schemas import schema_bq
+from synthetic_data import make_traffic_records
+
+NUM_ROWS = 500
+
+
+@pytest.fixture
+def sqlite_path(tmp_path, monkeypatch):
+    sqlite_path = str(tmp_path / "pipeline.sqlite")
+    monkeypatch.setenv(SQLITE_PATH_ENV_VAR, sqlite_path)
+    return sqlite_path
+
+
+def table_rows(sqlite_path):
+    with sqlite3.connect(sqlite_path) as connection:
+        return connection.execute(
+            "SELECT count(*), count(DISTINCT segmentid), min(_last_updt) "
+            'FROM "chicago_traffic_demo__traffic_raw"'
+        ).fetchone()
+
+
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+def test_upload_to_gbq_appends_with_the_sqlite_loader(sqlite_path, engine):
+    records = make_traffic_records(NUM_ROWS)
+    if engine == "arrow":
+        results_df, _ = cast_table(records_to_table(records), schema_bq)
+    else:
+        results_df, _ = apply_schema(
+            pd.DataFrame.from_records(records), compile_schema(schema_bq)
+        )
+
+    for _ in range(2):
+        load_stats = upload_to_gbq(
+            results_df,
+            "project",
+            "chicago_traffic_demo",
+            "traffic_raw",
+            schema_bq,
+            loader="sqlite",
+        )
+        assert load_stats["output_rows"] == NUM_ROWS
+        assert load_stats["seconds"] > 0
+
+    num_rows, num_segments, first_updt = table_rows(sqlite_path)
+    assert (num_rows, num_segments) == (2 * NUM_ROWS, NUM_ROWS)
+    # loaded as converted timestamps, not the api's text
+    assert pd.Timestamp(first_updt) == min(
+        pd.Timestamp(record["_last_updt"]) for record in records
+    )
+
+
+def test_loader_is_picked_by_environment(monkeypatch):
+    monkeypatch.delenv(LOADER_ENV_VAR, raising=False)
+    assert get_loader() is bigquery_loader
+    monkeypatch.setenv(LOADER_ENV_VAR, "sqlite")
+    assert get_loader() is sqlite_loader
+    assert get_loader("bigquery") is bigquery_loader
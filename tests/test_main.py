@@ -0,0 +1,58 @@
+"""Tests of which stages a retried message restores and which run again."""
+
+from lib.checkpoints import RunCheckpoint
+from lib.pipeline_specs import build_pipeline, default_spec
+from lib.stage_executor import restore_stages
+import main
+
+PROJECT_ID = "iconic-range-220603"
+BUCKET_NAME = "chicago_traffic_raw"
+
+
+def retried_run(tmp_path, spec, finished_stages):
+    """Returns what a retry of a run that finished ``finished_stages`` restores."""
+    run_checkpoint = RunCheckpoint(str(tmp_path / "checkpoint.json"))
+    for stage_name, values in finished_stages.items():
+        run_checkpoint.record(stage_name, values)
+    pipeline = build_pipeline(spec, PROJECT_ID, BUCKET_NAME)
+    restored, pending = restore_stages(
+        main.build_stages(pipeline, run_id="message-1"),
+        RunCheckpoint(run_checkpoint.state_path),
+    )
+    return restored, [stage.name for stage in pending]
+
+
+def test_load_runs_again_when_the_raw_file_was_not_recorded(tmp_path):
+    # the load and the audit finished, the raw upload crashed before recording
+    restored, pending = retried_run(
+        tmp_path,
+        default_spec,
+        {
+            "audit_null_columns": {"violations": []},
+            "upload_to_gbq": {
+                "load_job": {"job_id": "load_1", "location": "US"},
+                "partition_start": None,
+            },
+        },
+    )
+
+    assert restored == {"violations": []}
+    assert "upload_to_gbq" in pending
+    assert {"upload_raw_data_gcs", "preprocess_data", "update_watermark"} <= set(
+        pending
+    )
+
+
+def test_coordinator_restarts_without_publishing_again(tmp_path):
+    restored, pending = retried_run(
+        tmp_path,
+        dict(default_spec, shard_count=2),
+        {
+            "publish_shards": {"shards_published": 2},
+            "stray_stage": {"worker_specs": [], "watermark": "2019-04-02"},
+        },
+    )
+
+    assert restored == {"shards_published": 2}
+    assert "plan_shards" not in pending
+    assert "publish_shards" not in pending
@@ -0,0 +1,127 @@
+"""Tests of the dry-run budget guard in front of every BigQuery statement."""
+
+# built in python modules
+from datetime import datetime, timezone
+import logging
+
+from google.cloud import bigquery
+import pytest
+
+from lib import clients
+from lib.job_metrics import job_metrics, record_job, summarize_jobs
+from lib.query_runner import (
+    QueryBudgetExceeded,
+    dry_run_bytes,
+    run_query,
+    table_path,
+)
+
+SQL = "SELECT * FROM `project.dataset.table` WHERE day = @day AND rows > @rows"
+
+
+class FakeJob:
+    """Finished query job with the statistics ``lib.job_metrics`` reads."""
+
+    def __init__(self, total_bytes_processed=None):
+        self.job_id = "fake_job"
+        self.total_bytes_processed = total_bytes_processed
+
+    def result(self):
+        return []
+
+
+class FakeBigQueryClient:
+    """Answers dry runs with canned bytes and records every statement run."""
+
+    def __init__(self, estimated_bytes):
+        self.estimated_bytes = estimated_bytes
+        self.dry_runs = []
+        self.queries = []  # (sql, job_config) of statements actually run
+
+    def query(self, sql, location=None, job_config=None):
+        statements = self.dry_runs if job_config.dry_run else self.queries
+        statements.append((sql, job_config))
+        return FakeJob(total_bytes_processed=self.estimated_bytes)
+
+
+class FakeSpan:
+    """Span that keeps its attributes."""
+
+    def __init__(self):
+        self.attributes = {}
+
+    def add_attribute(self, name, value):
+        self.attributes[name] = value
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    fake_client = FakeBigQueryClient(estimated_bytes=5000)
+    monkeypatch.setitem(clients._clients, "bigquery", fake_client)
+    return fake_client
+
+
+def test_dry_run_bytes_returns_the_estimate(fake_client):
+    assert dry_run_bytes(SQL) == 5000
+    assert fake_client.queries == []
+
+
+def test_refuse_raises_and_runs_nothing(fake_client):
+    with pytest.raises(QueryBudgetExceeded, match="5000 bytes"):
+        run_query(SQL, bytes_budget=4999, budget_action="refuse")
+
+    assert len(fake_client.dry_runs) == 1
+    assert fake_client.queries == []
+
+
+def test_warn_logs_and_runs_the_statement(fake_client, caplog):
+    with caplog.at_level(logging.WARNING, logger="lib.query_runner"):
+        query_job = run_query(SQL, bytes_budget=4999, budget_action="warn")
+
+    assert "over the budget of 4999" in caplog.text
+    assert [sql for sql, _ in fake_client.queries] == [SQL]
+    assert query_job.dry_run_bytes_processed == 5000
+
+
+def test_values_are_sent_as_typed_parameters(fake_client):
+    day = datetime(2019, 4, 2, tzinfo=timezone.utc)
+
+    run_query(SQL, parameters={"day": day, "rows": 10, "street": "Pulaski"})
+
+    [(_, job_config)] = fake_client.queries
+    assert job_config.query_parameters == [
+        bigquery.ScalarQueryParameter("day", "TIMESTAMP", day),
+        bigquery.ScalarQueryParameter("rows", "INT64", 10),
+        bigquery.ScalarQueryParameter("street", "STRING", "Pulaski"),
+    ]
+    # the dry run is estimated with the same values
+    [(_, dry_run_config)] = fake_client.dry_runs
+    assert dry_run_config.query_parameters == job_config.query_parameters
+    assert "Pulaski" not in fake_client.queries[0][0]
+
+
+def test_estimate_is_on_the_span_and_in_the_metrics(fake_client):
+    span = FakeSpan()
+
+    query_job = run_query(SQL)
+    metrics = record_job(span, query_job)
+
+    assert metrics["bytes_estimated"] == 5000
+    assert span.attributes["bytes_estimated"] == 5000
+    assert job_metrics(query_job)["bytes_estimated"] == 5000
+    assert summarize_jobs([query_job, query_job])["total_bytes_estimated"] == 10000
+
+
+def test_unknown_budget_action_is_refused(fake_client):
+    with pytest.raises(ValueError):
+        run_query(SQL, budget_action="ignore")
+
+    assert fake_client.dry_runs == []
+
+
+def test_table_path_refuses_injected_names():
+    assert table_path("my-project", "dataset", "table") == (
+        "`my-project.dataset.table`"
+    )
+    with pytest.raises(ValueError):
+        table_path("project", "dataset", "table`; DROP TABLE x; --")